@@ -2,8 +2,17 @@
 Comparators
 
 These tools enable quick comparison of sets of exchanges to see if they match
+
+For regression testing at scale, ExchangeDiff loads two sets of exchanges into columnar arrays, joins them through a
+hash index on _exch_key, and compares values with vectorized relative-tolerance tests.  It produces a structured report
+instead of a printed verdict.  compare_lcis() streams process-by-process LCI comparisons between two origins, and
+lci_regression() reduces that stream to one summary row per reference exchange.
 """
-from math import isclose
+
+import numpy as np
+from pandas import DataFrame, MultiIndex
+
+from antelope import EntityNotFound
 
 
 def _rx_key(rx):
@@ -54,6 +63,135 @@ def compare_exchanges(s1, s2):
     return d1, d2
 
 
+def _exchange_columns(exchanges):
+    """
+    :param exchanges:
+    :return: list of exchanges, list of keys, array of values (None is NaN)
+    """
+    exchs = list(exchanges)
+    keys = [_exch_key(x) for x in exchs]
+    values = np.array([np.nan if x.value is None else x.value for x in exchs], dtype=float)
+    return exchs, keys, values
+
+
+def _within_tol(a, b, rel_tol, abs_tol):
+    """
+    Vectorized math.isclose (symmetric in a and b)
+    """
+    return np.abs(a - b) <= np.maximum(rel_tol * np.maximum(np.abs(a), np.abs(b)), abs_tol)
+
+
+class ExchangeDiff(object):
+    """
+    A structured comparison of two sets of dependent exchanges.  As in compare_exchange_values(), each exchange in s2
+    is compared with the exchange in s1 that has the same key (where s1 has duplicate keys, the last one is used).
+    Key-level differences are reported as in compare_exchanges().
+    """
+    def __init__(self, s1, s2, rel_tol=1e-6, abs_tol=0.0):
+        self.rel_tol = rel_tol
+        self.abs_tol = abs_tol
+        self._x1, self._k1, self._v1 = _exchange_columns(s1)
+        self._x2, self._k2, self._v2 = _exchange_columns(s2)
+
+        self._index1 = index1 = {k: i for i, k in enumerate(self._k1)}
+        self._pos = np.fromiter((index1.get(k, -1) for k in self._k2), dtype=int, count=len(self._k2))
+        self._found = self._pos >= 0
+
+        ref = np.full(len(self._k2), np.nan)
+        ref[self._found] = self._v1[self._pos[self._found]]
+        self._ref = ref
+        self._close = np.zeros(len(self._k2), dtype=bool)
+        self._close[self._found] = _within_tol(self._v2[self._found], ref[self._found], rel_tol, abs_tol)
+
+        keys2 = set(self._k2)
+        self._only_1 = set(k for k in index1.keys() if k not in keys2)
+
+    @property
+    def n1(self):
+        return len(self._k1)
+
+    @property
+    def n2(self):
+        return len(self._k2)
+
+    @property
+    def n_keys1(self):
+        """
+        number of distinct keys in s1
+        """
+        return len(self._index1)
+
+    @property
+    def only_1(self):
+        """
+        keys present in s1 but not s2
+        """
+        return set(self._only_1)
+
+    @property
+    def only_2(self):
+        """
+        keys present in s2 but not s1
+        """
+        return set(self._k2[i] for i in np.flatnonzero(~self._found))
+
+    @property
+    def n_changed(self):
+        return int((self._found & ~self._close).sum())
+
+    @property
+    def passed(self):
+        return bool(self._close.all()) and len(self._only_1) == 0
+
+    @property
+    def max_rel_diff(self):
+        if not self._found.any():
+            return 0.0
+        a = self._v2[self._found]
+        b = self._ref[self._found]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d = np.abs(a - b) / np.maximum(np.abs(a), np.abs(b))
+        d = d[~np.isnan(d)]
+        return float(d.max()) if len(d) else 0.0
+
+    def failures(self):
+        """
+        Same contents as the return value of compare_exchange_values()
+        :return: list of (s2 exchange, s1 value) for changed values, (s2 exchange, None) for missing keys
+        """
+        fail = []
+        for i in np.flatnonzero(~self._close):
+            fail.append((self._x2[i], self._ref[i] if self._found[i] else None))
+        return fail
+
+    def summary(self):
+        return {'n1': self.n1, 'n2': self.n2, 'only_1': len(self._only_1), 'only_2': int((~self._found).sum()),
+                'changed': self.n_changed, 'max_rel_diff': self.max_rel_diff, 'passed': self.passed}
+
+    def to_dataframe(self, all_rows=False):
+        """
+        One row per differing exchange (or per exchange, with all_rows=True), with columns flow, direction,
+        termination, value_1, value_2, status.  Status is one of 'same', 'changed', 'only_1', 'only_2'.
+        :param all_rows: [False]
+        :return:
+        """
+        status = np.where(self._found, np.where(self._close, 'same', 'changed'), 'only_2')
+        rows = []
+        for i in range(len(self._k2)):
+            if all_rows or status[i] != 'same':
+                rows.append(self._k2[i] + (self._ref[i], self._v2[i], status[i]))
+        for k in sorted(self._only_1, key=str):
+            rows.append(k + (self._v1[self._index1[k]], np.nan, 'only_1'))
+        return DataFrame(rows, columns=['flow', 'direction', 'termination', 'value_1', 'value_2', 'status'])
+
+    def __str__(self):
+        if self.passed:
+            return 'PASS (%d)' % self.n1
+        return 'DIFFERENT (%d only in 1, %d only in 2, %d changed / %d)' % (len(self._only_1),
+                                                                           int((~self._found).sum()),
+                                                                           self.n_changed, self.n1)
+
+
 def compare_exchange_values(s1, s2, rel_tol=1e-6):
     """
     The exchanges are unordered, so it's nontrivial to test two sets of results against one another.
@@ -67,17 +205,75 @@ def compare_exchange_values(s1, s2, rel_tol=1e-6):
     :return: a list of failed exchanges, expressed as 2-tuples: (bad_exch, good_val) or (bad_exch, None). 0-length
      return set indicates success
     """
-    c = {_exch_key(x): x.value for x in s1}
-    fail = []
-    for s in s2:
-        try:
-            v = c[_exch_key(s)]
-            if not isclose(v, s.value, rel_tol=rel_tol):
-                fail.append((s, v))
-        except KeyError:
-            fail.append((s, None))
+    diff = ExchangeDiff(s1, s2, rel_tol=rel_tol)
+    fail = diff.failures()
     if len(fail) == 0:
-        print('PASS (%d)' % len(c))
+        print('PASS (%d)' % diff.n_keys1)
     else:
-        print('DIFFERENT (%d / %d)' % (len(fail), len(c)))
+        print('DIFFERENT (%d / %d)' % (len(fail), diff.n_keys1))
     return fail
+
+
+def compare_lcis(q1, q2, processes=None, rel_tol=1e-6, abs_tol=0.0):
+    """
+    Generate LCI comparisons between two origins, one reference exchange at a time.  LCIs are requested directly from
+    the queries (not through the process refs, which would cache them), so only one pair is held in memory at a time.
+    :param q1: query for the baseline origin
+    :param q2: query for the origin under test
+    :param processes: [None] iterable of processes or external refs in q1; default q1.processes()
+    :param rel_tol:
+    :param abs_tol:
+    :return: generates (process external_ref, reference flow external_ref, ExchangeDiff or None if missing from q2)
+    """
+    if processes is None:
+        processes = q1.processes()
+    for p in processes:
+        if not hasattr(p, 'entity_type'):
+            p = q1.get(p)
+        try:
+            q2.get(p.external_ref)
+        except EntityNotFound:
+            for rx in p.references():
+                yield p.external_ref, rx.flow.external_ref, None
+            continue
+        for rx in p.references():
+            lci1 = q1.lci(p.external_ref, rx.flow.external_ref)
+            lci2 = q2.lci(p.external_ref, rx.flow.external_ref)
+            yield p.external_ref, rx.flow.external_ref, ExchangeDiff(lci1, lci2, rel_tol=rel_tol, abs_tol=abs_tol)
+
+
+def lci_regression(q1, q2, processes=None, rel_tol=1e-6, abs_tol=0.0, failures_only=False):
+    """
+    Consume compare_lcis() and report one row per reference exchange.  Only the summaries are retained.
+    :param q1:
+    :param q2:
+    :param processes:
+    :param rel_tol:
+    :param abs_tol:
+    :param failures_only: [False] omit passing rows
+    :return: DataFrame indexed by (process, ref_flow)
+    """
+    rows = []
+    index = []
+    count = failed = 0
+    for process, ref_flow, diff in compare_lcis(q1, q2, processes=processes, rel_tol=rel_tol, abs_tol=abs_tol):
+        count += 1
+        if diff is None:
+            row = {'passed': False, 'missing': True}
+        else:
+            row = diff.summary()
+            row['missing'] = False
+        if not row['passed']:
+            failed += 1
+        elif failures_only:
+            continue
+        rows.append(row)
+        index.append((process, ref_flow))
+    if failed == 0:
+        print('PASS (%d)' % count)
+    else:
+        print('DIFFERENT (%d / %d)' % (failed, count))
+    df = DataFrame(rows, columns=['n1', 'n2', 'only_1', 'only_2', 'changed', 'max_rel_diff', 'passed', 'missing'])
+    if index:
+        df.index = MultiIndex.from_tuples(index, names=('process', 'ref_flow'))
+    return df
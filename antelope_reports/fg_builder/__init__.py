@@ -19,8 +19,10 @@ def create_grids(cat, fg, ei_version, *grids, levels=LEVELS, chooser=True, **kwa
      - 'path' - where to serialize the lookup file
      - 'reset' - whether to blow away an existing lookup file
      - 'local' - if present, prefix to prepend to ecoinvent origins.
+     - 'index' - [False] scan each system model once instead of querying each grid geography
     :return:
     """
     egl = EcoinventGrids(cat, version=ei_version, levels=levels, **kwargs)
+    egl.lookup_locations(*grids)  # saved once
     for region in grids:
         egl.create_loc_grids(fg, region, rshort=region, chooser=chooser)
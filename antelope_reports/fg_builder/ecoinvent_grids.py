@@ -3,10 +3,14 @@ import os
 import re
 from antelope import UnknownOrigin
 
+from ..util import atomic_write
+
 
 SYSTEM_MODELS = ('cutoff', 'apos', 'conseq', 'undefined')
 LEVELS = ('low', 'medium', 'high')
 
+ELEC_MARKET = '^market( group)? for electricity'
+
 
 class DataPersistenceError(Exception):
     pass
@@ -20,16 +24,23 @@ class EcoinventGrids(object):
     """
     Creates a special-purpose JSON file that maps grid geography, system model, and voltage level to external_ref
     for a given Ecoinvent version.
+
+    In index mode, the electricity market processes of each system model are scanned once and indexed by geography,
+    model, and level in memory; every location is then looked up from the index, and the whole index is written to the
+    JSON file in a single save.
     """
     _version = None
     _file = None
     _j = None
+    _index = None
+    _index_names = None
+    _index_models = None
 
     def _print(self, *args):
         print('%s: ' % self.__class__.__name__, end='')
         print(*args)
 
-    def __init__(self, cat, version, path=None, levels=None, reset=False, local=None):
+    def __init__(self, cat, version, path=None, levels=None, reset=False, local=None, index=False):
         """
         
         :param cat: Catalog that knows about ecoinvent 
@@ -38,11 +49,17 @@ class EcoinventGrids(object):
         :param levels: which grid levels to use (default is all, i.e. ('low', 'medium', 'high'))
         :param reset: 
         :param local: [None] If present, prefix to pre-pend to the origin query (e.g. 'local.ecoinvent...')
+        :param index: [False] If True, look up locations from an in-memory geography index built with one scan of
+         each system model, instead of querying each location separately
         """
         self._cat = cat
         self._version = version
         self._levels = levels or LEVELS
         self._local = local
+        self._use_index = bool(index)
+        self._index = None
+        self._index_names = None
+        self._index_models = None
         filename = 'ecoinvent_grids_%s.json' % version
         if path is None:
             self._file = filename
@@ -90,8 +107,11 @@ class EcoinventGrids(object):
                 raise DataPersistenceError('Keys missing: %s' % self._file)
 
     def save(self):
-        with open(self._file, 'w') as fp:
-            json.dump(self._j, fp, indent=2)
+        """
+        Written to a temp file and moved into place, so an interrupted save cannot leave a truncated file behind
+        :return:
+        """
+        atomic_write(self._file, lambda fp: json.dump(self._j, fp, indent=2))
 
     def locations(self, loc, model=None):
         if model is None:
@@ -106,21 +126,105 @@ class EcoinventGrids(object):
             Name=('^market( group)? for electricity.*%s voltage' % _l),
             SpatialScope='^%s$' % _g))  # should be an exact match
 
-    def _lookup_location(self, g):
+    '''
+    geography index
+    '''
+    @staticmethod
+    def _level_regex(level):
+        return '%s.*%s voltage' % (ELEC_MARKET, level)
+
+    def _scan_model(self, model):
+        """
+        One query for all electricity markets in the system model, sorted into {geography: {level: [external_ref]}}
+        using the same name patterns as the per-location query
+        :param model:
+        :return:
+        """
+        idx = dict()
+        for p in self._cat.query(self._org(model)).processes(Name=ELEC_MARKET):
+            for l in LEVELS:
+                if re.search(self._level_regex(l), p['Name'], flags=re.IGNORECASE):
+                    idx.setdefault(p['SpatialScope'], dict()).setdefault(l, []).append(p.external_ref)
+        return idx
+
+    def build_index(self):
+        """
+        Scan each available system model once and build the in-memory index of geography -> model -> level ->
+        [external_ref].  Geographies are keyed in lowercase.
+        :return:
+        """
+        self._index = dict()
+        self._index_names = dict()
+        models = list(self.models)
+        for m in models:
+            idx = self._scan_model(m)
+            self._print('%s: indexed %d geographies' % (self._org(m), len(idx)))
+            for g, lvls in idx.items():
+                self._index.setdefault(g.lower(), dict())[m] = lvls
+                self._index_names.setdefault(g.lower(), g)
+        self._index_models = models
+
+    @property
+    def geographies(self):
+        if self._index is None:
+            self.build_index()
+        return sorted(self._index_names.values())
+
+    def _indexed_location(self, g):
+        """
+        Geographies are matched exactly but without regard to case, as the SpatialScope='^g$' query does
+        :param g:
+        :return:
+        """
+        if self._index is None:
+            self.build_index()
+        ig = self._index.get(g.lower(), dict())
+        return {m: {l: list(ig.get(m, dict()).get(l, [])) for l in self.levels} for m in self._index_models}
+
+    def _lookup_location(self, g, save=True):
+        """
+        :param g:
+        :param save: [True] save the JSON file if the location has changed
+        :return: True if the location was added or updated
+        """
         curr_g = self._j.get(g, None)
-        new_g = {m: {l: self._get_em(g, m, l) for l in self.levels} for m in self.models}
+        if self._use_index:
+            new_g = self._indexed_location(g)
+        else:
+            new_g = {m: {l: self._get_em(g, m, l) for l in self.levels} for m in self.models}
         if len(new_g) == 0:
             raise ValueError('No valid models found')
         if curr_g == new_g:
             self._print('Location %s: no change' % g)
-            return  # nothing to do
+            return False  # nothing to do
         else:
             if curr_g is None:
                 self._print('adding location %s' % g)
             else:
                 self._print('updating location %s' % g)
             self._j[g] = new_g
+            if save:
+                self.save()
+            return True
+
+    def lookup_locations(self, *locs, reset=False):
+        """
+        Look up several locations and save the JSON file once at the end, if anything changed.  With no locations
+        specified in index mode, every indexed geography is stored.
+        :param locs:
+        :param reset: [False] re-lookup locations that are already known
+        :return: number of locations added or updated
+        """
+        if len(locs) == 0 and self._use_index:
+            locs = self.geographies
+        changed = 0
+        for loc in locs:
+            if reset or (loc not in self._j):
+                if self._lookup_location(loc, save=False):
+                    changed += 1
+        if changed:
             self.save()
+        return changed
 
     def grids_by_location(self, loc, reset=False, show=False):
         """
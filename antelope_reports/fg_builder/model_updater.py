@@ -2,6 +2,8 @@ from antelope_core.entities.xlsx_editor import XlsxUpdater
 from antelope_foreground.entities.fragments import InvalidParentChild
 from antelope import EntityNotFound, UnknownOrigin
 
+from ..unit_conversion import observe_converted
+
 
 from pandas import to_numeric
 
@@ -245,7 +247,7 @@ class XlsxForegroundUpdater(XlsxUpdater):
             if f is None:
                 raise KeyError('Unable to find this frag! %s' % frag)
             if frag.get('exchange_value') is not None:
-                self.ar.observe(f, exchange_value=float(frag['exchange_value']), units=frag.get('units'))
+                observe_converted(self.ar, f, exchange_value=float(frag['exchange_value']), units=frag.get('units'))
             if frag.get('termination') is None:
                 if len(list(f.child_flows)) == 0:
                     f.clear_termination()
@@ -314,7 +316,7 @@ class XlsxForegroundUpdater(XlsxUpdater):
             knob = self._fg[rowdata.pop('parameter', None)]
             if knob:
                 if update_default:
-                    self._fg.observe(knob, exchange_value=rowdata.pop('default'), units=units)
+                    observe_converted(self._fg, knob, exchange_value=rowdata.pop('default'), units=units)
 
 
 
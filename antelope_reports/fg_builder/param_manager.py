@@ -1,10 +1,17 @@
+from ..unit_conversion import conversion_cache, observe_converted
+
+
 class ParamManager(object):
     """
     The parameters sheet has the following columns- square brackets indicate optional:
     (origin) (parameter) [flow_name] [flow_unit] [default].... scenario names
+
+    The sheet is read once into an indexed table (see `table`), with the knob or child flow for each of the
+    foreground's rows resolved up front.  All scenarios can then be applied or written in a single pass.
     """
     _sheet = None
     _sheetname = None
+    _table = None
 
     _reserved_names = ('origin', 'parameter', 'flow_name', 'flow_unit',  'default')
 
@@ -23,6 +30,7 @@ class ParamManager(object):
 
     def _update(self):
         self._sheet = self._xlsx[self._sheetname]
+        self._table = None  # re-read on next access
 
     @property
     def scenarios(self):
@@ -53,22 +61,52 @@ class ParamManager(object):
         self._xlsx.write_dataframe('parameters', df, clear_sheet=True, fillna='', write_index=False)
         self._update()
 
-    def _get_rows(self):
+    '''
+    Indexed table
+    '''
+    @property
+    def columns(self):
+        return [k.value for k in self._sheet.row(0)]
+
+    @property
+    def table(self):
+        """
+        The parameters sheet as a DataFrame, indexed by 0-indexed sheet row (header excluded). Cell values are stored
+        as-is (dtype object) and the '_node' column holds the resolved knob or child flow for rows belonging to the
+        current foreground (None otherwise).  The table is read on first access and discarded when the sheet is
+        re-read.
+        :return:
+        """
+        if self._table is None:
+            self._table = self._load_table()
+        return self._table
+
+    def _load_table(self):
+        from pandas import DataFrame
+
+        columns = self.columns
+        n = len(columns)
+        data = []
         for r in range(1, self._sheet.nrows):
-            row = self._sheet.row_dict(r)
-            if 'parameter' not in row:
-                continue
-            if row.pop('origin', None) != self._fg.origin:
+            row = [k.value for k in self._sheet.row(r)][:n]
+            data.append(row + [None] * (n - len(row)))
+        df = DataFrame(data, columns=columns, index=range(1, self._sheet.nrows), dtype=object)
+
+        nodes = []
+        for r, row in df.iterrows():
+            if row.get('origin') != self._fg.origin or row.get('parameter') is None:
+                nodes.append(None)
                 continue
-            yield row
+            nodes.append(self._resolve_node(row['parameter'], row.get('flow_name')))
+        df['_node'] = nodes
+        return df
 
-    def _get_knob_or_child_flow(self, row):
-        param = row.pop('parameter')
+    def _resolve_node(self, param, flow_name=None):
         kn = self._fg[param]
         if kn is None:
             print('Skipping unknown parameter %s/%s' % (self._fg.origin, param))
             return None
-        cf = self._fg[row.pop('flow_name', None)]
+        cf = self._fg[flow_name]
         if cf:
             try:
                 return next(kn.children_with_flow(cf))
@@ -77,61 +115,112 @@ class ParamManager(object):
                 return None
         return kn
 
+    def _nodes(self):
+        """
+        Generates (sheet row, row data, knob) for every resolved row in the table
+        :return:
+        """
+        df = self.table
+        for r, row in df[df['_node'].notnull()].iterrows():
+            yield r, row, row['_node']
+
+    @staticmethod
+    def _scenario_value(kn, scenario, unit):
+        val = kn.exchange_value(scenario)
+        if val == kn.observed_ev:
+            return ''
+        if unit is None or unit == kn.flow.unit:
+            return val
+        return val * conversion_cache.convert(kn.flow.reference_entity, to=unit)
+
+    def write_scenarios(self, *scenarios):
+        """
+        Write the specified scenario columns to the spreadsheet in a single rectangular update. Scenarios that are not
+        already present in the sheet are appended as new columns.  Rows that do not belong to the current foreground
+        are left untouched.  If no scenarios are specified, all scenarios in the sheet are written.
+        :param scenarios:
+        :return:
+        """
+        if len(scenarios) == 0:
+            scenarios = list(self.scenarios)
+        for sc in scenarios:
+            if sc in self._reserved_names:
+                raise ValueError('Invalid scenario name: %s' % sc)
+
+        columns = self.columns
+        cols = dict()
+        for sc in scenarios:
+            if sc in columns:
+                cols[sc] = columns.index(sc)
+            elif sc not in cols:
+                cols[sc] = len(columns) + len([k for k in cols.values() if k >= len(columns)])
+        c0 = min(cols.values())
+        width = max(cols.values()) - c0 + 1
+
+        header = [None] * width
+        for sc, c in cols.items():
+            if c >= len(columns):
+                header[c - c0] = sc
+
+        # None cells are ignored by the sheet API, so only the managed cells are overwritten
+        data = {r: [None] * width for r in range(1, self._sheet.nrows)}
+        count = 0
+        for r, row, kn in self._nodes():
+            unit = row.get('flow_unit')
+            for sc, c in cols.items():
+                data[r][c - c0] = self._scenario_value(kn, sc, unit)
+            count += 1
+
+        print('Writing %d items to %s, scenarios %s' % (count, self._sheetname, list(cols.keys())))
+        self._xlsx.write_rectangle_by_rows(self._sheetname,
+                                           [header] + [data[r] for r in range(1, self._sheet.nrows)],
+                                           start_row=0, start_col=c0)
+        self._update()
+
     def write_scenario(self, scenario):
         """
         Write the specified column to the spreadsheet
         :param scenario:
         :return:
         """
-        if scenario in self.scenarios:
-            col = next(i for i, k in enumerate(self._sheet.row(0)) if k.value == scenario)
-            data = []
-            start_row = 1
-        else:
-            col = self._sheet.ncols
-            data = [scenario]
-            start_row = 0
-        for r in range(1, self._sheet.nrows):
-            row = self._sheet.row_dict(r)
-            if row.get('origin') == self._fg.origin:
-                kn = self._get_knob_or_child_flow(row)
-                if kn is None:
-                    data.append(None)
-                    continue
+        self.write_scenarios(scenario)
 
-                unit = row['flow_unit']
-                val = kn.exchange_value(scenario)
-                if val == kn.observed_ev:
-                    data.append('')
-                else:
-                    if unit == kn.flow.unit:
-                        data.append(val)
-                    else:
-                        cf = kn.flow.reference_entity.convert(to=unit)
-                        data.append(val * cf)
-            else:
-                data.append(None)
-        print('Writing %d items to %s, scenario %s' % (len(list(filter(None, data))) - 1 + start_row, self._sheetname,
-                                                       scenario))
-        self._xlsx.write_column(self._sheetname, col, data, start_row=start_row)
-        self._update()
+    @staticmethod
+    def _is_missing(v):
+        return v is None or v == '' or v == 'NA'
 
-    def apply_parameters(self):
-        # self._fg.clear_scenarios(terminations=False)  # well, that's foolish
-        count = 0
-        for row in self._get_rows():
-            kn = self._get_knob_or_child_flow(row)
-            if kn is None:
-                continue
+    def apply_scenarios(self, *scenarios, clear_missing=False):
+        """
+        Apply the named scenario columns to the foreground in one pass over the indexed table. If no scenarios are
+        specified, all scenarios in the sheet are applied.
+        :param scenarios:
+        :param clear_missing: [False] if True, blank entries clear the knob's exchange value for that scenario;
+         otherwise blank and 'NA' entries are skipped
+        :return: the number of parameter settings applied
+        """
+        if len(scenarios) == 0:
+            scenarios = list(self.scenarios)
+        for sc in scenarios:
+            if sc in self._reserved_names:
+                raise ValueError('Invalid scenario name: %s' % sc)
+        scenarios = [sc for sc in scenarios if sc in self.table.columns]
 
-            unit = row.pop('flow_unit', None)
-            for k, v in row.items():
-                if k in self._reserved_names:
-                    continue
-                if v is None or v == 'NA':
+        count = 0
+        for r, row, kn in self._nodes():
+            unit = row.get('flow_unit')
+            for sc in scenarios:
+                v = row[sc]
+                if self._is_missing(v):
+                    if clear_missing and v is None:
+                        kn.set_exchange_value(sc, None)
                     continue
-                self._fg.observe(kn, exchange_value=float(v), scenario=k,  units=unit)
+                observe_converted(self._fg, kn, exchange_value=float(v), scenario=sc, units=unit)
                 count += 1
+        return count
+
+    def apply_parameters(self):
+        # self._fg.clear_scenarios(terminations=False)  # well, that's foolish
+        count = self.apply_scenarios()
         print('Applied %d parameter settings from %s' % (count, self._sheetname))
 
     def apply_scenario(self, scenario):
@@ -140,19 +229,5 @@ class ParamManager(object):
         :param scenario:
         :return:
         """
-        if scenario in self._reserved_names:
-            raise ValueError('Invalid scenario name: %s' % scenario)
-        count = 0
-        for row in self._get_rows():
-            kn = self._get_knob_or_child_flow(row)
-            if kn is None:
-                continue
-
-            unit = row.pop('flow_unit', None)
-            val = row.pop(scenario)
-            if val is None:
-                kn.set_exchange_value(scenario, None)
-            else:
-                self._fg.observe(kn, exchange_value=val, scenario=scenario, units=unit)
-                count += 1
+        count = self.apply_scenarios(scenario, clear_missing=True)
         print('Applied %d parameter settings from %s, scenario %s' % (count, self._sheetname, scenario))
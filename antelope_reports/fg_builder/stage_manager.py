@@ -1,4 +1,5 @@
 from synonym_dict import SynonymDict, TermExists
+from collections import deque
 
 
 class StageManager(object):
@@ -10,6 +11,10 @@ class StageManager(object):
     Read-only just reads in the table and executes a mapping of the input string to the selected column
     Writable mode takes a list of stage names as inputs and updates the existing mappings, then writes it to the sheet
     (if supported)
+
+    For aggregation, the synonym mappings are compiled into a flat dict per map column (keyed by case-folded term
+    when ignore_case is set), which is rebuilt after any change to the mappings.  Use agg_key() to obtain a fast
+    callable for LcaModelRunner aggregation.
     """
 
     _xlsx = None
@@ -19,14 +24,42 @@ class StageManager(object):
     skip_values = {None, 0, 'NA'}
 
     @classmethod
-    def from_fragment(cls, frag):
+    def from_fragment(cls, frag, xlsx, sheetname='stage_names', scenario=None, **kwargs):
         """
         Creates (or updates) a StageManager spreadsheet based on the stages encountered in one fragment and its
         child fragments
         :param frag:
+        :param xlsx: a writable xlrd-like
+        :param sheetname: ['stage_names']
+        :param scenario: [None] scenario specification for the traversal
+        :param kwargs: passed to StageManager constructor (write is forced True)
+        :return: the StageManager
+        """
+        kwargs['write'] = True
+        sm = cls(xlsx, sheetname=sheetname, **kwargs)
+        sm.add_fragment_stages(frag, scenario=scenario)
+        return sm
+
+    @staticmethod
+    def fragment_stages(frag, scenario=None):
+        """
+        Generates the distinct stage names produced by a fragment and all its subfragments, in order of first
+        appearance, from a single traversal.  Stage names are determined by model_runner.get_stage_name, which is
+        also the default key used in aggregation.
+        :param frag:
+        :param scenario:
         :return:
         """
-        return NotImplemented
+        from ..model_runner import get_stage_name
+        seen = set()
+        queue = deque(frag.traverse(scenario))
+        while queue:
+            ff = queue.popleft()
+            sn = get_stage_name(ff)
+            if sn not in seen:
+                seen.add(sn)
+                yield sn
+            queue.extend(ff.subfragments)
 
     def __init__(self, xlsx, sheetname='stage_names', write=True, default_name='StageName', ignore_case=True):
         self._xlsx = xlsx
@@ -44,6 +77,8 @@ class StageManager(object):
         self._mappings = dict()
         self._sd = SynonymDict(ignore_case=ignore_case)
         self._sd._ignore_case = ignore_case
+        self._ignore_case = bool(ignore_case)
+        self._compiled = dict()
 
         self.read_mappings()
 
@@ -65,6 +100,7 @@ class StageManager(object):
             for k in self.keys:
                 self._mappings[k].pop(col_name, None)
             self._maps.remove(col_name)
+            self._invalidate()
 
     def _create_or_update_entry(self, row, default=None):
         if default is None:
@@ -93,19 +129,82 @@ class StageManager(object):
             row = self._sheet.row_dict(i)
             key = self._create_or_update_entry(row)
             self._mappings[key] = row
+        self._invalidate()
 
-    def map_stage_name(self, term, column=1):
+    '''
+    compiled lookup
+    '''
+    def _invalidate(self):
+        self._compiled.clear()  # in place, so that outstanding agg_key callables see the change
+
+    def _fold(self, term):
+        if self._ignore_case and isinstance(term, str):
+            return term.casefold()
+        return term
+
+    def _target(self, column):
         if isinstance(column, str):
-            target = column
-        else:
-            target = self._maps[int(column)]
-        try:
-            key = self._sd[term]
-            mapp = self._mappings[key]
+            return column
+        return self._maps[int(column)]
+
+    def _compile(self, target):
+        """
+        Flatten the synonym mappings for one map column into a dict of term -> mapped value.  Terms whose entry does not
+        specify the column are omitted, so that lookups fall back to the term itself.
+        :param target: column name
+        :return:
+        """
+        table = dict()
+        for key, mapp in self._mappings.items():
+            if target not in mapp:
+                continue
             value = mapp[target]
-            return value
+            for t in self._sd.synonyms(key):
+                table[self._fold(t)] = value
+            table[self._fold(key)] = value
+        self._compiled[target] = table
+        return table
+
+    def compiled(self, column=1):
+        """
+        Return the compiled term -> value lookup table for the named map column
+        :param column: column name or index into the map columns [default 1]
+        :return: dict
+        """
+        target = self._target(column)
+        try:
+            return self._compiled[target]
         except KeyError:
-            return term
+            return self._compile(target)
+
+    def map_stage_name(self, term, column=1):
+        return self.compiled(column).get(self._fold(term), term)
+
+    def agg_key(self, column=1, key=None):
+        """
+        Returns a callable that maps an entity to its stage name in the named map column, suitable for use as an
+        LcaModelRunner agg_key.  The callable reads the shared compiled tables, so it remains valid after the
+        mappings are updated.
+        :param column: column name or index into the map columns [default 1]
+        :param key: function to extract the stage name from an entity [default: model_runner.get_stage_name]
+        :return:
+        """
+        if key is None:
+            from ..model_runner import get_stage_name
+            key = get_stage_name
+        target = self._target(column)
+        compiled = self._compiled
+        fold = self._fold
+
+        def _agg_key(entity):
+            term = key(entity)
+            try:
+                return compiled[target][fold(term)]
+            except KeyError:
+                # unknown term, or the table was invalidated
+                return self.map_stage_name(term, target)
+
+        return _agg_key
 
     def retrieve(self, lookup, col=None):
         try:
@@ -126,6 +225,7 @@ class StageManager(object):
             return  # nothing to do
         else:
             self._maps.append(col)
+            self._invalidate()
 
     def update_mapping(self, term, **kwargs):
         try:
@@ -140,6 +240,7 @@ class StageManager(object):
         for col, val in kwargs.items():
             self.add_map_column(col)
         self._mappings[key] = d
+        self._invalidate()
 
     def add_synonym(self, term, synonym):
         """
@@ -149,6 +250,7 @@ class StageManager(object):
         :return:
         """
         self._sd.add_synonym(term, synonym)
+        self._invalidate()
 
     def prune_keys(self, keys):
         s = set(keys)
@@ -159,6 +261,62 @@ class StageManager(object):
         for k in p:
             print('Removing %s' % k)
             self._mappings.pop(k)
+        if p:
+            self._invalidate()
+
+    def add_stages(self, *stages):
+        """
+        Add stage names that are not already known (by any synonym) as new entries with no mappings.
+        :param stages:
+        :return: list of keys for newly added entries
+        """
+        new = []
+        for stage in stages:
+            if stage is None or stage in self._sd:
+                continue
+            self.update_mapping(stage)
+            new.append(self._sd[stage])
+        return new
+
+    def add_fragment_stages(self, frag, scenario=None, write=None):
+        """
+        Discover the stages produced by a fragment (see fragment_stages()) and merge new ones into the mappings.
+        If writable, the new entries are appended to the sheet in a single write.
+        :param frag:
+        :param scenario:
+        :param write: [None] default: write if the StageManager is writable
+        :return: list of keys for newly added entries
+        """
+        new = self.add_stages(*self.fragment_stages(frag, scenario=scenario))
+        print('%s: %d new stages' % (frag, len(new)))
+        if write is None:
+            write = self._w
+        if write and new:
+            self.append_mappings(new)
+        return new
+
+    def _row_gen(self, _key, columns=None):
+        if columns is None:
+            columns = self._maps[1:]
+        yield _key
+        _map = self._mappings[_key]
+        for col in columns:
+            yield _map.get(col)
+
+    def append_mappings(self, keys):
+        """
+        Append entries for the named keys to the end of the sheet in one bulk write, without rewriting existing
+        rows.  Map columns that are not yet in the sheet header are not written- use write_mappings() for that.
+        :param keys:
+        :return:
+        """
+        if not self._w:
+            raise AttributeError('Non-writeable')
+        columns = [k.value for k in self._sheet.row(0)][1:]
+        start_row = max(self._sheet.nrows, 1)
+        self._xlsx.write_rectangle_by_rows(self._sheetname, [list(self._row_gen(k, columns)) for k in keys],
+                                           start_row=start_row)
+        self._sheet = self._xlsx.sheet_by_name(self._sheetname)
 
     def write_mappings(self):
         if not self._w:
@@ -168,18 +326,9 @@ class StageManager(object):
 
         self._xlsx.write_row(self._sheetname, 0, self._maps)
 
-        def _row_gen(_key):
-            yield _key
-            for col in self._maps[1:]:
-                _map = self._mappings[_key]
-                if col in _map:
-                    yield _map[col]
-                else:
-                    yield None
-
         def _table_gen():
             for _k in self.keys:
-                yield _row_gen(_k)
+                yield self._row_gen(_k)
 
         self._xlsx.write_rectangle_by_rows(self._sheetname, _table_gen(), start_row=1)
 
@@ -5,8 +5,19 @@ activity, and a "measure" which is an optional dependent exchange for which the
 just use the reference flow), and also documentary information (title and docstring).
 
 The equivalency can then be queried by supplying an LCIA quantity, which returns the total score per unit of measure.
+
+LCIA totals are memoized per (comparison activity, quantity), in a dict that can be shared among equivalencies.  The
+EquivalencyGenerator shares one such dict among all its equivalencies, evaluates them against many quantities in a
+single batch, and can persist the dict to a JSON file so that reports do not re-run the LCIA in every session.
 """
+import json
+import os
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pandas import DataFrame
+
+from ..util import atomic_write
 
 EquivSpec = namedtuple('EquivSpec', ('title', 'origin', 'external_ref', 'measure', 'docstring'))  # measure = "how many (unit)"
 
@@ -18,29 +29,33 @@ class Equivalency:
     """
 
     @classmethod
-    def from_spec(cls, cat, e_spec: EquivSpec, ref_flow=None):
+    def from_spec(cls, cat, e_spec: EquivSpec, ref_flow=None, cache=None):
         """
         The EquivSpec provides a concise programmatic way of specifying equivalencies.
         :param cat:
         :param e_spec:
         :param ref_flow:
+        :param cache: [None] shared dict of LCIA totals
         :return:
         """
         rx = cat.query(e_spec.origin).get(e_spec.external_ref).reference(ref_flow)
-        return cls(e_spec.title, rx, measure=e_spec.measure, docstring=e_spec.docstring)
+        return cls(e_spec.title, rx, measure=e_spec.measure, docstring=e_spec.docstring, cache=cache)
 
-    def __init__(self, title, rx, measure=None, docstring=None, **kwargs):
+    def __init__(self, title, rx, measure=None, docstring=None, cache=None, **kwargs):
         """
 
         :param title: short title
         :param rx: Reference exchange
         :param measure: Dependent exchange for unit comparison [if None, uses the reference]
         :param docstring: annotation text
+        :param cache: [None] dict of LCIA totals keyed by cache_key(); may be shared among equivalencies
         :param kwargs: not currently used
         """
         self.title = title
         self._rx = rx
         self._meas = measure
+        self._lci = None
+        self._cache = dict() if cache is None else cache
 
         if measure is None:
             self._mx = self.rx
@@ -80,9 +95,43 @@ class Equivalency:
     def external_ref(self):
         return self._e.external_ref
 
-    def query_lcia(self, quantity):
-        res = quantity.do_lcia(self._e.lci(ref_flow=self.rx))
-        return res.total() / self.measure
+    def cache_key(self, quantity):
+        """
+        LCIA totals are keyed by the comparison activity's origin, external_ref and reference flow, and by the
+        quantity's link.  The measure is applied afterwards, so it is not part of the key.
+        :param quantity:
+        :return:
+        """
+        return self.origin, self.external_ref, self.ref_flow.external_ref, quantity.link
+
+    def refresh_lci(self):
+        """
+        Retrieve the comparison activity's LCI again, and drop its cached LCIA totals so that they are recomputed
+        against the new LCI.
+        :return:
+        """
+        self._lci = list(self._e.lci(ref_flow=self.rx))
+        prefix = self.origin, self.external_ref, self.ref_flow.external_ref
+        for key in [k for k in list(self._cache.keys()) if k[:3] == prefix]:
+            self._cache.pop(key, None)
+
+    def lcia_total(self, quantity, refresh=False):
+        """
+        The LCIA score of the comparison activity's reference flow, computed once per quantity.  The LCI is retrieved
+        once and reused for all quantities; use refresh_lci() to retrieve it again.
+        :param quantity:
+        :param refresh: [False] recompute the score (from the LCI already retrieved)
+        :return:
+        """
+        key = self.cache_key(quantity)
+        if refresh or key not in self._cache:
+            if self._lci is None:
+                self._lci = list(self._e.lci(ref_flow=self.rx))
+            self._cache[key] = quantity.do_lcia(self._lci).total()
+        return self._cache[key]
+
+    def query_lcia(self, quantity, refresh=False):
+        return self.lcia_total(quantity, refresh=refresh) / self.measure
 
 
 class EquivalencyGenerator:
@@ -90,13 +139,28 @@ class EquivalencyGenerator:
     A handy tool for a limited set of circumstances.  Allows a user to retain a collection of LCIA quantities
     mapped to specific equivalencies.
     """
-    def __init__(self, cat):
+    def __init__(self, cat, cache_file=None):
+        """
+
+        :param cat:
+        :param cache_file: [None] JSON file of LCIA totals; loaded if it exists, and written by save_cache()
+        """
         self.cat = cat
         self.qs = []
         self._entries = dict()
+        self._equivs = dict()  # maps EquivSpec to Equivalency, so that each comparison is only built once
+        self._cache = dict()
+        self._cache_file = cache_file
+        if cache_file is not None and os.path.exists(cache_file):
+            self.load_cache(cache_file)
+
+    def _equivalency(self, equiv_spec):
+        if equiv_spec not in self._equivs:
+            self._equivs[equiv_spec] = Equivalency.from_spec(self.cat, equiv_spec, cache=self._cache)
+        return self._equivs[equiv_spec]
 
     def add_equiv(self, q, equiv_spec):
-        equiv = Equivalency.from_spec(self.cat, equiv_spec)
+        equiv = self._equivalency(equiv_spec)
         if not hasattr(q, 'entity_type'):
             q = self.cat.get_canonical(q)
         if q not in self.qs:
@@ -111,3 +175,64 @@ class EquivalencyGenerator:
     def entries(self):
         for k in sorted(self._entries.keys()):
             yield k
+
+    @property
+    def equivalencies(self):
+        for e in self._equivs.values():
+            yield e
+
+    def evaluate(self, quantities=None, max_workers=None, refresh=False):
+        """
+        Score every registered equivalency against every quantity, in one pass.  Only (equivalency, quantity) pairs
+        that are not already cached are computed; each equivalency's LCI is retrieved once.  If the generator has a
+        cache file, it is updated afterwards.
+        :param quantities: [None] defaults to the registered quantities
+        :param max_workers: [None] if given, compute missing scores in a thread pool (one task per equivalency)
+        :param refresh: [False] retrieve each equivalency's LCI again (once) and recompute all its scores
+        :return: DataFrame of equivalencies (by title) x quantities (by external_ref), in LCIA units per unit measure
+        """
+        if quantities is None:
+            quantities = list(self.qs)
+        else:
+            quantities = [q if hasattr(q, 'entity_type') else self.cat.get_canonical(q) for q in quantities]
+        equivs = list(self._equivs.values())
+
+        def _score_all(_e):
+            if refresh:
+                _e.refresh_lci()
+            return [_e.query_lcia(q) for q in quantities]
+
+        missing = sum(1 for e in equivs for q in quantities if refresh or e.cache_key(q) not in self._cache)
+        if missing:
+            print('Computing %d equivalency scores' % missing)
+        if max_workers and len(equivs) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                data = list(pool.map(_score_all, equivs))
+        else:
+            data = [_score_all(e) for e in equivs]
+
+        if missing and self._cache_file is not None:
+            self.save_cache()
+        return DataFrame(data, index=[e.title for e in equivs], columns=[q.external_ref for q in quantities])
+
+    def save_cache(self, filename=None):
+        """
+        Write the cached LCIA totals to a JSON file (atomically)
+        :param filename: [None] defaults to the generator's cache file
+        :return:
+        """
+        filename = filename or self._cache_file
+        if filename is None:
+            raise ValueError('No cache file specified')
+        j = [list(k) + [v] for k, v in self._cache.items()]
+        atomic_write(filename, lambda fp: json.dump({'scores': j}, fp, indent=2))
+        print('Saved %d equivalency scores to %s' % (len(j), filename))
+
+    def load_cache(self, filename):
+        with open(filename) as fp:
+            j = json.load(fp)
+        for origin, external_ref, ref_flow, method, value in j.get('scores', []):
+            self._cache[origin, external_ref, ref_flow, method] = value
+
+    def clear_cache(self):
+        self._cache.clear()
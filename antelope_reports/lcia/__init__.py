@@ -8,12 +8,12 @@ across methods and data sources.
 
 from .lcia_eval import LciaEval
 from .flow_comparator import FlowComparator
-# from .screening import process_screen, substance_screen, show_top_n
+from .screening import process_screen, substance_screen, show_top_n
 from .xlsx_lcia import QdbGSheetClient
 from .traci import traci_2_combined_eutrophication
+from .synonyms import load_synonym_sets
 
 from antelope import EntityNotFound
-from synonym_dict import MergeError
 
 
 S3_QDB_SHEET_ID = '1gBi9690IcMRf4B8oAgGQm02yaj459i4vHDmMH2SXlVE'
@@ -24,33 +24,17 @@ class Scope3Qdb(QdbGSheetClient):
         super(Scope3Qdb, self).__init__(fg, S3_QDB_SHEET_ID, credential_file=credential_file, **kwargs)
 
 
-def add_synonym_sets(cat, list_of_sets):
+def add_synonym_sets(cat, list_of_sets, cache_file=None, refresh=False):
     """
-    An algorithm for adding / merging sets of synonyms
+    An algorithm for adding / merging sets of synonyms.  Overlapping sets are grouped before the term manager is
+    touched, and each group is applied in one call; see synonyms.load_synonym_sets()
     :param cat:
     :param list_of_sets:
+    :param cache_file: [None] JSON file to cache the computed synonym groups
+    :param refresh: [False] ignore an existing cache file
     :return:
     """
-    for terms in list_of_sets:
-        try:
-            cat.lcia_engine.add_terms('flow', *terms)
-        except MergeError:
-            t = list(terms)
-            lost = []
-            while 1:
-                # this is clearly broken
-                try:
-                    cat.lcia_engine.get_flowable(t[0])
-                except KeyError:
-                    try:
-                        lost.append(t.pop(0))
-                    except IndexError:
-                        print('somehow we found no terms to add in %s' % lost)
-                        break
-                    continue
-                break
-            if t:
-                cat.lcia_engine.merge_flowables(*t)
+    return load_synonym_sets(cat, list_of_sets, cache_file=cache_file, refresh=refresh)
 
 
 class AdvancedLcia(object):
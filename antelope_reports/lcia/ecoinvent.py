@@ -3,28 +3,56 @@ Load flowable synonyms from an ecoinvent archive
 """
 from synonym_dict import TermExists, MergeError
 
+from .synonyms import load_synonym_sets
 
-def load_ecoinvent_synonyms(cat, ecoinvent_origin, interface='exchange', merge_strategy=None):
+
+def _ecoinvent_flows(cat, ecoinvent_origin, interface):
+    ar = cat.get_archive(ecoinvent_origin, interface)
+    if ar.__class__.__name__ == 'EcospoldV2Archive':
+        # raise TypeError(ar, 'Wrong archive type')
+        ar.load_flows()  # this loads synonyms
+    else:
+        print('Warning: unsupported archive type')
+    return ar.entities_by_type('flow')
+
+
+def load_ecoinvent_synonyms(cat, ecoinvent_origin, interface='exchange', merge_strategy=None, bulk=False,
+                            cache_file=None, refresh=False):
     """
     this will not work when ecoinvent is accessed remotely-- entities_by_type would only get loaded flows...
     getting every flow will require at least one API call (to synonyms) for every flow already gotten...
     Better to get synonym info from a Qdb.
 
+    In bulk mode, the flows' synonym sets are grouped and applied directly to the term manager (see
+    synonyms.load_synonym_sets()) instead of passing each flow through LciaEngine.add_flow_terms().  This is much faster
+    but skips everything add_flow_terms() does besides adding terms: flows are not registered in the engine's
+    _flow_map, overlapping flowables are always merged (no 'graft' or other merge_strategy semantics), biogenic CO2
+    flows are not renamed, and flowables are not recorded by origin.  In bulk mode only, the groups can be cached to a
+    file, so that later calls do not open the archive at all.
+
     :param cat:
     :param ecoinvent_origin: origin + interface that accesses a fully-complemented EcospoldV2Archive (with MasterData)
     :param interface: default 'exchange'
     :param merge_strategy: valid values: 'graft', 'prune', 'distinct', 'merge'.  None = use term manager default.
-    :return: a list of flows that were not able to be loaded
+     Ignored when loading in bulk.
+    :param bulk: [False] load synonym sets in bulk, as described above
+    :param cache_file: [None] bulk mode only: JSON file in which to cache the synonym groups
+    :param refresh: [False] bulk mode only: ignore an existing cache file and re-read the archive
+    :return: a list of flows (or, in bulk mode, synonym groups) that were not able to be loaded
     """
+    if bulk:
+        if merge_strategy is not None:
+            print('Bulk synonym loading: ignoring merge_strategy %s' % merge_strategy)
+        result = load_synonym_sets(cat, lambda: [tuple(f.synonyms) for f in _ecoinvent_flows(cat, ecoinvent_origin,
+                                                                                              interface)],
+                                   cache_file=cache_file, refresh=refresh)
+        return result['failures']
+    if cache_file is not None:
+        print('Synonym cache file is only used in bulk mode: ignoring %s' % cache_file)
+
     broken = []
     count = 0
-    ar = cat.get_archive(ecoinvent_origin, interface)
-    if ar.__class__.__name__ == 'EcospoldV2Archive':
-        # raise TypeError(ar, 'Wrong archive type')
-        ar.load_flows()  # this loads synonyms
-    else:
-        print('Warning: unsupported archive type')
-    for f in ar.entities_by_type('flow'):
+    for f in _ecoinvent_flows(cat, ecoinvent_origin, interface):
         try:
             cat.lcia_engine.add_flow_terms(f, merge_strategy=merge_strategy)
             count += 1
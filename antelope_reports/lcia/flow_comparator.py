@@ -1,3 +1,4 @@
+from pandas import DataFrame
 
 
 class FlowComparator(object):
@@ -14,26 +15,53 @@ class FlowComparator(object):
     returns 3 sets: flowables unique to q1, common to both, unique to q2
     records: terms encountered in queries that are not recognized flowables
 
+    > fc.compare(q1, q2, q3, ...)
+    returns a membership table (flowables x queries) and an overlap matrix (queries x queries) in one pass
+
+    Term lookups are memoized: each distinct name is looked up in the term manager only once.  Call clear_cache() if
+    the term manager's flowables change.
     """
 
     def __init__(self, tm):
         self._tm = tm
         self._unknown_flows = dict()
+        self._flowables = dict()  # name -> flowable; unknown names map to themselves
+        self._unknown_names = set()
+
+    def clear_cache(self):
+        self._flowables = dict()
+        self._unknown_names = set()
+
+    def _get_flowable(self, _flowable):
+        if _flowable not in self._flowables:
+            try:
+                self._flowables[_flowable] = self._tm.get_flowable(_flowable)
+            except KeyError:
+                self._flowables[_flowable] = _flowable
+                self._unknown_names.add(_flowable)
+        return self._flowables[_flowable]
 
     def _lcia_get_flowable(self, _flowable, _origin):
         if _origin not in self._unknown_flows:
             self._unknown_flows[_origin] = set()
-        try:
-            return self._tm.get_flowable(_flowable)
-        except KeyError:
+        fb = self._get_flowable(_flowable)
+        if _flowable in self._unknown_names:
             self._unknown_flows[_origin].add(_flowable)
-            return _flowable
+        return fb
 
-    def _map_item(self, item):
+    def resolve_flowables(self, names, origin=None):
+        """
+        Bulk lookup: names are de-duplicated before lookup
+        :param names: iterable of flowable names
+        :param origin: [None] origin to which unrecognized names are attributed
+        :return: dict of name -> flowable (or the name itself, if it is not recognized)
         """
+        return {n: self._lcia_get_flowable(n, origin) for n in set(names)}
 
+    def _item_name(self, item):
+        """
         :param item:
-        :return:
+        :return: name, origin
         """
         if hasattr(item, 'entity_type'):
             if item.entity_type == 'characterization':
@@ -53,30 +81,74 @@ class FlowComparator(object):
         else:
             fb = str(item)
             og = None
+        return fb, og
+
+    def _map_item(self, item):
+        """
+
+        :param item:
+        :return:
+        """
+        fb, og = self._item_name(item)
         return fb, self._lcia_get_flowable(fb, og)
 
-    def distinct_flowables(self, _q):
+    @staticmethod
+    def _query_items(_q):
+        """
+        :param _q:
+        :return: items, name of query
+        """
         if hasattr(_q, 'factors'):
-            fs = (self._map_item(k) for k in _q.factors())
-            _n = _q.name
+            return _q.factors(), _q.name
         elif hasattr(_q, 'flows'):
-            fs = (self._map_item(k) for k in _q.flows())
             if hasattr(_q, 'origin'):
                 _n = _q.origin
             elif hasattr(_q, 'ref'):
                 _n = _q.ref
             else:
                 _n = _q.__class__.__name__
-        else:
-            fs = (self._map_item(k) for k in _q)
-            _n = _q.__class__.__name__
+            return _q.flows(), _n
+        return _q, _q.__class__.__name__
 
-        ff, ss = zip(*fs)
-        bb = set(ss)
+    def _distinct_flowables(self, _q):
+        items, _n = self._query_items(_q)
+        names = [self._item_name(k) for k in items]
+        by_origin = dict()
+        for fb, og in names:
+            by_origin.setdefault(og, set()).add(fb)
+        mapping = dict()
+        for og, fbs in by_origin.items():
+            mapping.update(self.resolve_flowables(fbs, og))
+        bb = set(mapping.values())
 
-        print('%s: %d factors; %d names; %d flowables' % (_n, len(ff), len(set(ff)), len(bb)))
+        print('%s: %d factors; %d names; %d flowables' % (_n, len(names), len(mapping), len(bb)))
 
-        return bb
+        return _n, bb
+
+    def distinct_flowables(self, _q):
+        return self._distinct_flowables(_q)[1]
+
+    def compare(self, *queries):
+        """
+        N-way comparison: each query's flowables are computed once.
+        :param queries: quantities, archives, or lists of fragments or exchanges (as for sort_flowables)
+        :return: membership DataFrame (flowables x queries, boolean); overlap DataFrame (queries x queries, count of
+         common flowables, with each query's number of flowables on the diagonal)
+        """
+        sets = []
+        names = []
+        for q in queries:
+            _n, bb = self._distinct_flowables(q)
+            if _n in names:
+                _n = '%s_%d' % (_n, len(names))
+            names.append(_n)
+            sets.append(bb)
+        flowables = sorted(set().union(*sets), key=str)
+        membership = DataFrame({n: [f in bb for f in flowables] for n, bb in zip(names, sets)},
+                               index=[str(f) for f in flowables])
+        m = membership.values.astype(int)
+        overlap = DataFrame(m.T @ m, index=names, columns=names)
+        return membership, overlap
 
     def sort_flowables(self, _q1, _q2):
         """
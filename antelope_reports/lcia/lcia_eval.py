@@ -3,54 +3,280 @@ lcia_eval.py
 
 Generate information about consistency and completeness of LCI and LCIA methods.
 """
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pandas import DataFrame, MultiIndex, concat
+
 from antelope import ExchangeRef
 
+from .screening import screen
+
+
+def _context_tuple(cx):
+    """
+    A lowercase tuple of compartment names, from a context, a list, or a string
+    :param cx:
+    :return:
+    """
+    if cx is None:
+        return ()
+    if hasattr(cx, 'as_list'):
+        return tuple(str(k).lower() for k in cx.as_list())
+    if isinstance(cx, (tuple, list)):
+        return tuple(str(k).lower() for k in cx)
+    return str(cx).lower(),
+
 
 class LciaEval(object):
     """
     The way this works is: we create two lists. One, of processes; the other, of LCIA methods.
-    When we add a process to the list, we create a *unit mask* which has the same exchanges as the process's
-    LCI, but all with unit magnitudes.  Then we create a "negative sort" which is initialized with all the contents of
-    the unit mask.  Every time we add an LCIA method, we intersect the negative sort with the zeros of the resulting
-    computation.  After all the lcia methods are added, what remains in the negative sort is the un-matched exchanges.
-    Then we can look at those lists and decide what to do.
+
+    Coverage is computed with matrices. Each process's LCI is reduced to a set of (flowable, context) keys, forming a
+    boolean incidence matrix of processes x keys.  Each LCIA method's factors are reduced the same way, and a key
+    is characterized by a method if the method has a factor for the key's flowable in the key's context or one of its
+    parent contexts. This forms a characterization matrix of methods x keys.  Hits are the matrix product; what is
+    characterized by no method is the un-matched residual.  Then we can look at those lists and decide what to do.
+
+    Flowables and contexts are resolved by the term manager (tm, e.g. cat.lcia_engine) to their canonical forms, as in
+    do_lcia(), so that coverage reflects the engine's own matching.  Without a term manager, keys are formed from
+    lowercased flow names, synonyms, and compartment names, which only approximates the engine's matching.
+
+    With unit_mask=True, the LCI used for scores has unit magnitudes.
+
+    With max_workers, LCI retrieval, factor retrieval, and (process, method) LCIA evaluations are dispatched to a
+    thread pool.  Retrieved LCIs are memoized in lci_cache, which may be shared among instances.
     """
 
-    def __init__(self, unit_mask=False):
+    def __init__(self, unit_mask=False, max_workers=None, lci_cache=None, tm=None):
+        """
+        :param unit_mask: [False]
+        :param max_workers: [None]
+        :param lci_cache: [None] dict mapping (process link, reference flow) to LCI exchanges.  Supply the same dict
+         to several instances to share retrieved LCIs among them.
+        :param tm: [None] term manager used to resolve flowables and contexts, e.g. cat.lcia_engine
+        """
+        self._tm = tm
+        self._max_workers = max_workers
+        if lci_cache is None:
+            lci_cache = dict()
+        self._lci_cache = lci_cache
         self._rxs = []
         self._methods = []
         self._factors = dict()
 
         self._unit_mask = bool(unit_mask)
         self._lci = dict()  # maps process link to list of exchanges
-        self._negative_sort = dict()  # maps process link to set of zero exchanges
         self._run = dict()
 
-    def _run_lcia(self, rx, refresh=None):
-        if len(self._methods):
-            print('Running LCIA for %s' % rx.process.link)
-        for q in self._methods:
-            if (rx, q.link) in self._run:
-                continue
-            print(' -- LCIA %s: ' % q.link, end='')
-            if rx.entity_type == 'fragment':
-                res = rx.fragment_lcia(q, refresh=refresh).flatten()
-            else:
-                res = q.do_lcia(self._lci[rx], refresh=refresh)
+        self._keys = dict()  # maps (flowable, context) key to column index
+        self._key_terms = []  # column index -> set of flowable terms
+        self._key_contexts = []  # column index -> the key's context followed by its parents
+        self._p_cols = dict()  # maps rx to set of column indices
+        self._m_keys = dict()  # maps method link to set of (flowable term, context) factor keys
+        self._c = None  # characterization matrix, rebuilt when keys or methods change
+
+    '''
+    matrix construction
+    '''
+    def _flowable_terms(self, flow):
+        """
+        :param flow: a flow, or a flowable term
+        :return: the canonical flowable name (as a one-element set), or an empty set if the term manager does not
+         know the flow; without a term manager, the lowercased name and synonyms
+        """
+        if self._tm is not None:
+            try:
+                return {str(self._tm.get_flowable(flow, strict=False))}
+            except KeyError:
+                return set()
+        if hasattr(flow, 'name'):
+            terms = {str(flow.name).lower()}
+            try:
+                terms |= set(str(k).lower() for k in flow.synonyms)
+            except (AttributeError, TypeError):
+                pass
+            return terms
+        return {str(flow).lower()}
+
+    def _context_chain(self, cx):
+        """
+        :param cx: a context, compartment list, or name
+        :return: tuple of the canonical context followed by its parents (or, without a term manager, of lowercased
+         compartment tuples, most specific first)
+        """
+        if self._tm is not None:
+            chain = []
+            c = self._tm[cx]
+            while c is not None:
+                chain.append(c)
+                c = c.parent
+            return tuple(chain) or (None, )
+        t = _context_tuple(cx)
+        return tuple(t[:i] for i in range(len(t), -1, -1))
+
+    @staticmethod
+    def _context_name(c):
+        if c is None:
+            return ''
+        if hasattr(c, 'as_list'):
+            return '; '.join(str(k) for k in c.as_list())
+        return '; '.join(c)
+
+    def _column(self, x):
+        flow = x.flow
+        terms = self._flowable_terms(flow)
+        chain = self._context_chain(getattr(x, 'termination', None))
+        if self._tm is not None and len(terms) > 0:
+            fb = next(iter(terms))
+        else:
+            fb = str(flow.name).lower()
+        key = (fb, chain[0])
+        if key not in self._keys:
+            self._keys[key] = len(self._key_terms)
+            self._key_terms.append(terms)
+            self._key_contexts.append(chain)
+            self._c = None
+        return self._keys[key]
+
+    def _factor_key(self, cf):
+        terms = self._flowable_terms(cf.flowable)
+        fb = next(iter(terms)) if len(terms) > 0 else str(cf.flowable).lower()
+        return fb, self._context_chain(cf.context)[0]
+
+    def _characterized(self, m_keys, col):
+        for cx in self._key_contexts[col]:
+            for term in self._key_terms[col]:
+                if (term, cx) in m_keys:
+                    return True
+        return False
+
+    @property
+    def incidence(self):
+        """
+        :return: boolean array of processes x keys
+        """
+        p = np.zeros((len(self._rxs), len(self._keys)), dtype=bool)
+        for i, rx in enumerate(self._rxs):
+            p[i, list(self._p_cols[rx])] = True
+        return p
+
+    @property
+    def characterization(self):
+        """
+        :return: boolean array of methods x keys
+        """
+        if self._c is None or self._c.shape != (len(self._methods), len(self._keys)):
+            c = np.zeros((len(self._methods), len(self._keys)), dtype=bool)
+            for i, q in enumerate(self._methods):
+                m_keys = self._m_keys[q.link]
+                for col in self._keys.values():
+                    c[i, col] = self._characterized(m_keys, col)
+            self._c = c
+        return self._c
+
+    def hits(self):
+        """
+        :return: integer array of methods x processes: number of LCI keys characterized by each method
+        """
+        return self.characterization.astype(int) @ self.incidence.T.astype(int)
+
+    def misses(self):
+        """
+        :return: integer array of methods x processes: number of LCI keys not characterized by each method
+        """
+        return self.incidence.sum(axis=1)[np.newaxis, :] - self.hits()
+
+    def residual(self):
+        """
+        :return: boolean array of processes x keys: LCI keys that are characterized by none of the methods
+        """
+        return self.incidence & ~self.characterization.any(axis=0)[np.newaxis, :]
+
+    '''
+    DataFrame outputs
+    '''
+    def _process_index(self):
+        return MultiIndex.from_tuples([(p.process.origin, p.process.name, p.flow.name) for p in self._rxs],
+                                      names=('origin', 'process', 'flow'))
 
-            deets = list(res.details())
-            print('%d hits, %d zeros; ' % (len(deets), len(list(res.zeros()))), end='')
-            self._negative_sort[rx] &= set(res.zeros())
-            print('%d remain' % len(self._negative_sort[rx]))
+    def coverage(self):
+        """
+        :return: DataFrame of methods x processes with columns for hits and misses of each process
+        """
+        index = [q.link for q in self._methods]
+        return concat({'hits': DataFrame(self.hits(), index=index, columns=self._process_index()),
+                       'misses': DataFrame(self.misses(), index=index, columns=self._process_index())}, axis=1)
+
+    def unmatched(self):
+        """
+        :return: DataFrame listing, for each process, the LCI keys characterized by none of the methods
+        """
+        keys = sorted(self._keys.keys(), key=lambda k: self._keys[k])
+        res = self.residual()
+        rows = []
+        for i, rx in enumerate(self._rxs):
+            for col in np.flatnonzero(res[i]):
+                rows.append({'process': rx.process.link, 'flowable': keys[col][0],
+                             'context': self._context_name(keys[col][1])})
+        return DataFrame(rows, columns=['process', 'flowable', 'context'])
+
+    def _map(self, func, items):
+        if self._max_workers and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+                return list(pool.map(func, items))
+        return [func(k) for k in items]
+
+    def _evaluate(self, rx, q, refresh=None):
+        if rx.entity_type == 'fragment':
+            return rx.fragment_lcia(q, refresh=refresh).flatten()
+        return q.do_lcia(self._lci[rx], refresh=refresh)
+
+    def _run_pairs(self, pairs, refresh=None):
+        """
+        Evaluate the (rx, method) pairs that are not already in _run
+        :param pairs:
+        :param refresh:
+        :return:
+        """
+        pairs = [(rx, q) for rx, q in pairs if (rx, q.link) not in self._run]
+        if len(pairs) == 0:
+            return
+        print('Running LCIA for %d process-method pairs' % len(pairs))
+        results = self._map(lambda pair: self._evaluate(pair[0], pair[1], refresh=refresh), pairs)
+        for (rx, q), res in zip(pairs, results):
             self._run[rx, q.link] = res
 
-    def _show_line(self, method, num=False):
+    def _run_lcia(self, rx, refresh=None):
+        self._run_pairs([(rx, q) for q in self._methods], refresh=refresh)
+
+    def scores(self):
+        """
+        Run any LCIA computations not yet performed
+        :return: DataFrame of methods x processes with LCIA scores
+        """
+        self._run_lcia_for_all_processes()
+        return DataFrame([[self._run[rx, q.link].total() for rx in self._rxs] for q in self._methods],
+                         index=[q.link for q in self._methods], columns=self._process_index())
+
+    def screen(self, n=10):
+        """
+        Contribution screening of the known processes against the known methods.  Any LCIA results not yet computed
+        are run first (as in scores()); the screen then reuses them.  See screening.screen()
+        :param n: [10]
+        :return: processes DataFrame, substances DataFrame
+        """
+        self._run_lcia_for_all_processes()
+        return screen(self._rxs, self._methods, n=n, lci=lambda node, rx: self._lci[rx],
+                      lcia=lambda node, rx, q: self._run.get((rx, q.link)))
+
+    def _show_line(self, method, num=False, hits=None):
         print('%30.30s ' % method.name, end='')
-        for rx in self._rxs:
+        for i, rx in enumerate(self._rxs):
             if num:
                 print(' %8.3g  ' % self._run[rx, method.link].total(), end='')
             else:
-                print(' %8d  ' % len(list(self._run[rx, method.link].details())), end='')
+                print(' %8d  ' % hits[i], end='')
         # I hate myself for taking the time to do this right now
         d = '  (%d)        ' % len(self._factors[method.link])
         print('%10.10s %s' % (d, method['Indicator'], ))
@@ -61,6 +287,8 @@ class LciaEval(object):
         :param data: True: report LCIA scores. False: report counts
         :return:
         """
+        if data:
+            self._run_lcia_for_all_processes()
         print('%30.30s ' % '', end='')
         for i in range(len(self._rxs)):
             print('   [%02d]     ' % i, end='')
@@ -84,34 +312,90 @@ class LciaEval(object):
 
         print('%30.30s ' % '', end='')
         for p in self._rxs:
-            print('   %5d   ' % len(self._lci[p]), end='')
+            print('   %5d   ' % len(self._p_cols[p]), end='')
         print()
 
-        for k in self._methods:
-            self._show_line(k, num=data)
+        hits = self.hits()
+        for i, k in enumerate(self._methods):
+            self._show_line(k, num=data, hits=hits[i])
 
         print('%30.30s ' % '', end='')
-        for p in self._rxs:
-            print('   %5d   ' % len(self._negative_sort[p]), end='')
+        for n in self.residual().sum(axis=1):
+            print('   %5d   ' % n, end='')
         print()
 
-    def recompute(self):
+    def clear_lci_cache(self):
+        """
+        Forget all memoized LCIs (including those of other instances sharing the cache).  LCIs already assigned to
+        processes are kept until recompute(refresh_lci=True).
+        :return:
+        """
+        self._lci_cache.clear()
+
+    def recompute(self, refresh_lci=False):
+        """
+        Discard and re-run all LCIA results
+        :param refresh_lci: [False] also discard memoized LCIs and retrieve each process's LCI again
+        :return:
+        """
+        if refresh_lci:
+            self.clear_lci_cache()
+            lcis = self._map(lambda rx: self._retrieve_lci(rx.process, rx), self._rxs)
+            for rx, lci in zip(self._rxs, lcis):
+                self._set_lci(rx, lci)
         self._run = dict()
         self._run_lcia_for_all_processes(refresh=True)
 
     def _run_lcia_for_all_processes(self, refresh=None):
-        for p in self._rxs:
-            self._run_lcia(p, refresh=refresh)
+        self._run_pairs([(rx, q) for rx in self._rxs for q in self._methods], refresh=refresh)
+
+    @staticmethod
+    def _fragment_flows(fragment):
+        """
+        :param fragment:
+        :return: reference exchange, list of exchanges of the fragment's unit flows that terminate in contexts
+        """
+        ios, internal = fragment.unit_flows()
+        io = ios[0]
+        rx = ExchangeRef(fragment, io.fragment.flow, io.fragment.direction, value=io.magnitude, is_reference=True)
+        lci = [ExchangeRef(fragment, k.fragment.flow, k.fragment.direction, value=k.magnitude,
+                           termination=k.term.term_node) for k in internal if k.term.is_context]
+        return rx, lci
+
+    def _retrieve_lci(self, process, rx):
+        """
+        The LCI of a fragment is computed each time; a process's LCI is memoized in the lci cache
+        :param process:
+        :param rx:
+        :return: list of exchanges (a copy, which the caller is free to keep)
+        """
+        if process.entity_type == 'fragment':
+            return self._fragment_flows(process)[1]
+        key = (process.link, rx.flow.external_ref)
+        if key not in self._lci_cache:
+            self._lci_cache[key] = list(process.lci(ref_flow=rx.flow))
+        return list(self._lci_cache[key])
+
+    def _set_lci(self, rx, lci):
+        if self._unit_mask:
+            # create a false inventory with 1 for everything
+            lci = [ExchangeRef(x.process, x.flow, x.direction, value=1.0, termination=x.termination) for x in lci]
+        self._lci[rx] = lci
+        self._p_cols[rx] = set(self._column(x) for x in lci)
 
-    def add_process(self, *rx_or_processes):
+    def add_process(self, *rx_or_processes, run=True):
+        """
+        :param rx_or_processes: processes, reference exchanges, or fragments
+        :param run: [True] evaluate every known method on the new processes.  Pass False to defer LCIA until scores
+         are requested (coverage does not require it)
+        :return:
+        """
+        specs = []
+        seen = set()
         for rx_or_p in rx_or_processes:
             if rx_or_p.entity_type == 'fragment':
                 process = rx_or_p
-                ios, internal = process.unit_flows()
-                io = ios[0]
-                rx = ExchangeRef(process, io.fragment.flow, io.fragment.direction, value=io.magnitude, is_reference=True)
-                lci = [ExchangeRef(process, k.fragment.flow, k.fragment.direction, value=k.magnitude,
-                                   termination=k.term.term_node) for k in internal if k.term.is_context]
+                rx, lci = self._fragment_flows(process)
             else:
                 if rx_or_p.entity_type == 'process':
                     process = rx_or_p
@@ -119,30 +403,45 @@ class LciaEval(object):
                 else:
                     rx = rx_or_p
                     process = rx.process
+                lci = None
 
-                if rx in self._rxs:
-                    raise ValueError('Process already added')
+            if rx in self._lci or rx in seen:
+                raise ValueError('Process already added: %s' % process.link)
+            seen.add(rx)
+            specs.append((process, rx, lci))
 
-                lci = list(process.lci(ref_flow=rx.flow))
+        lcis = self._map(lambda spec: spec[2] if spec[2] is not None else self._retrieve_lci(spec[0], spec[1]), specs)
 
-            if self._unit_mask:
-                # create a false inventory with 1 for everything
-                lci = [ExchangeRef(x.process, x.flow, x.direction, value=1.0, termination=x.termination) for x in lci]
-            self._lci[rx] = lci
-            self._negative_sort[rx] = set(lci)
+        for (process, rx, _), lci in zip(specs, lcis):
+            self._set_lci(rx, lci)
             self._rxs.append(rx)
-            print('Adding Process %s: %d exchanges' % (process.link, len(set(lci))))
-            self._run_lcia(rx)
+            print('Adding Process %s: %d exchanges (%d keys)' % (process.link, len(set(lci)), len(self._p_cols[rx])))
 
-    def add_lcia(self, *lcias):
+        if run:
+            self._run_pairs([(rx, q) for _, rx, _ in specs for q in self._methods])
+
+    def add_lcia(self, *lcias, run=True):
+        """
+        :param lcias: LCIA methods
+        :param run: [True] evaluate the new methods on every known process; pairs already run are skipped.  Pass False
+         to defer LCIA until scores are requested
+        :return:
+        """
+        seen = set()
         for lcia in lcias:
-            if lcia in self._methods:
-                raise ValueError('LCIA method already added')
+            if lcia.link in self._factors or lcia.link in seen:
+                raise ValueError('LCIA method already added: %s' % lcia.link)
+            seen.add(lcia.link)
 
+        factors = self._map(lambda q: list(q.factors()), lcias)
+        for lcia, cfs in zip(lcias, factors):
             self._methods.append(lcia)
-            self._factors[lcia.link] = list(lcia.factors())
+            self._factors[lcia.link] = cfs
+            self._m_keys[lcia.link] = set(self._factor_key(cf) for cf in cfs)
+            self._c = None
 
-            self._run_lcia_for_all_processes()
+        if run:
+            self._run_pairs([(rx, q) for rx in self._rxs for q in lcias])
 
     '''
     Now, what outputs do we want?
@@ -0,0 +1,356 @@
+"""
+A local, file-backed stand-in for GoogleSheetReader.
+
+LocalWorkbook implements the same read/write interface as the xlstools google sheet client (sheet_names,
+sheet_by_name, create_sheet, write_row, write_rectangle_by_rows, clear_region, ...), holding all sheets in memory
+and reading from / saving to either an .xlsx file or a directory of CSV files (one file per sheet).  It allows the
+Qdb client to be exercised offline, without credentials or network access.
+
+As with the google sheets API, None values are ignored on write, and empty strings are read back as None.
+
+SnapshotWorkbook is a LocalWorkbook backed by a compact SQLite snapshot of another workbook (see write_snapshot()).
+Only the list of sheet names is read at startup; each sheet's rows are loaded the first time the sheet is accessed.
+"""
+import csv
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+from xlstools.xlrd_like import XlrdCellLike, XlrdSheetLike, XlrdWriteWorkbook
+
+from ..util import atomic_write
+
+
+def _cell_value(value):
+    """
+    Interpret a stored value the way GSheetCell does: blank is None, numeric strings are floats
+    :param value:
+    :return:
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        if len(value) == 0:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+class LocalSheet(XlrdSheetLike):
+    def __init__(self, name, data):
+        """
+        A static copy of the sheet's contents, like the GSheetEmulator (later writes are not reflected)
+        :param name:
+        :param data: list of row lists
+        """
+        self._name = name
+        self._data = [list(row) for row in data]
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def nrows(self):
+        return len(self._data)
+
+    @property
+    def ncols(self):
+        if len(self._data) == 0:
+            return 0
+        return max(len(row) for row in self._data)
+
+    def row(self, row):
+        return [XlrdCellLike(k) for k in self._data[row]]
+
+    def get_rows(self):
+        for i in range(self.nrows):
+            yield self.row(i)
+
+    def col(self, col):
+        return [XlrdCellLike(row[col] if col < len(row) else None) for row in self._data]
+
+    def cell(self, row, col):
+        return XlrdCellLike(self._data[row][col])
+
+
+class LocalWorkbook(XlrdWriteWorkbook):
+    """
+    In-memory workbook with optional .xlsx or CSV-directory persistence.  Changes are only written to disk when
+    save() is called.  write_count records the number of write operations (the equivalent of API requests) performed
+    since the workbook was loaded.
+    """
+    def __init__(self, path=None):
+        self._path = path
+        self._sheets = dict()
+        self.write_count = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    @property
+    def filename(self):
+        return self._path
+
+    def __contains__(self, item):
+        return item in self.sheet_names()
+
+    def _load_csv(self, name, filename):
+        with open(filename, newline='') as fp:
+            self._sheets[name] = [[_cell_value(v) for v in row] for row in csv.reader(fp)]
+
+    def load(self, path):
+        """
+        Replace the workbook contents with the contents of an .xlsx file, a single .csv file, or a directory of .csv
+        files
+        :param path:
+        :return:
+        """
+        self._sheets = dict()
+        if os.path.isdir(path):
+            for fn in sorted(os.listdir(path)):
+                name, ext = os.path.splitext(fn)
+                if ext.lower() == '.csv':
+                    self._load_csv(name, os.path.join(path, fn))
+        elif path.lower().endswith('.csv'):
+            self._load_csv(os.path.splitext(os.path.basename(path))[0], path)
+        else:
+            import openpyxl
+            book = openpyxl.load_workbook(path, data_only=True)
+            for ws in book.worksheets:
+                self._sheets[ws.title] = [[_cell_value(v) for v in row] for row in ws.iter_rows(values_only=True)]
+                self._trim(ws.title)
+        self._path = path
+
+    def sheet_names(self):
+        return list(self._sheets.keys())
+
+    def sheet_by_name(self, name):
+        try:
+            return LocalSheet(name, self._data(name))
+        except KeyError:
+            raise KeyError('Unable to open sheet %s' % name)
+
+    def sheet_by_index(self, index):
+        return self.sheet_by_name(self.sheet_names()[index])
+
+    def sheets(self):
+        return [self.sheet_by_name(name) for name in self.sheet_names()]
+
+    def create_sheet(self, sheetname, **kwargs):
+        if sheetname not in self:
+            self._sheets[sheetname] = []
+        return self.sheet_by_name(sheetname)
+
+    def _data(self, sheet):
+        return self._sheets[sheet]
+
+    def _trim(self, sheet):
+        data = self._data(sheet)
+        for row in data:
+            while row and row[-1] is None:
+                row.pop()
+        while data and len(data[-1]) == 0:
+            data.pop()
+
+    def _put(self, sheet, row, col, value):
+        if value is None:
+            return
+        if value == '':
+            value = None
+        data = self._data(sheet)
+        while len(data) <= row:
+            data.append([])
+        r = data[row]
+        while len(r) <= col:
+            r.append(None)
+        r[col] = value
+
+    def write_cell(self, sheet, row, col, value, **kwargs):
+        self._put(sheet, row, col, value)
+        self._trim(sheet)
+        self.write_count += 1
+
+    def write_row(self, sheet, row, values, start_col=0, **kwargs):
+        for i, v in enumerate(values):
+            self._put(sheet, row, start_col + i, v)
+        self._trim(sheet)
+        self.write_count += 1
+
+    def write_col(self, sheet, col, values, start_row=0, **kwargs):
+        for i, v in enumerate(values):
+            self._put(sheet, start_row + i, col, v)
+        self._trim(sheet)
+        self.write_count += 1
+
+    def write_rectangle_by_rows(self, sheet, row_gen, start_row=0, start_col=0, **kwargs):
+        n = 0
+        for i, row in enumerate(row_gen):
+            for j, v in enumerate(row):
+                self._put(sheet, start_row + i, start_col + j, v)
+            n += 1
+        if n == 0:
+            print('write_rectangle: no data provided')
+            return
+        self._trim(sheet)
+        self.write_count += 1
+
+    def clear_region(self, sheet, start_row=0, start_col=0, end_row=None, end_col=None, **kwargs):
+        """
+        Clear the region.  Input args are 0-indexed and inclusive, as in GoogleSheetReader
+        :param sheet: must exist
+        :param start_row:
+        :param start_col:
+        :param end_row: defaults to last row
+        :param end_col: defaults to last column
+        :return:
+        """
+        data = self._data(sheet)
+        for i, row in enumerate(data):
+            if i < start_row or (end_row is not None and i > end_row):
+                continue
+            for j in range(start_col, len(row)):
+                if end_col is not None and j > end_col:
+                    break
+                row[j] = None
+        self._trim(sheet)
+        self.write_count += 1
+
+    def save(self, path=None):
+        """
+        Write the workbook to disk (atomically).  A path ending in .xlsx is written as a workbook; anything else is
+        taken to be a directory, which receives one CSV file per sheet.
+        :param path: [None] defaults to the path the workbook was loaded from
+        :return:
+        """
+        path = path or self._path
+        if path is None:
+            raise ValueError('No path specified')
+        if path.lower().endswith('.xlsx'):
+            import openpyxl
+
+            def _write_xlsx(_tmp):
+                book = openpyxl.Workbook()
+                book.remove(book.active)
+                for name in self.sheet_names():
+                    ws = book.create_sheet(name)
+                    for row in self._data(name):
+                        ws.append(row)
+                book.save(_tmp)
+
+            atomic_write(path, _write_xlsx, mode=None)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name in self.sheet_names():
+                def _write_csv(fp, _data=self._data(name)):
+                    csv.writer(fp).writerows(_data)
+                atomic_write(os.path.join(path, '%s.csv' % name), _write_csv, newline='')
+        self._path = path
+        print('Saved %d sheets to %s' % (len(self.sheet_names()), path))
+
+
+SNAPSHOT_SCHEMA = (
+    'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE sheets (name TEXT PRIMARY KEY, position INTEGER, nrows INTEGER)',
+    'CREATE TABLE rows (sheet TEXT, row INTEGER, data TEXT, PRIMARY KEY (sheet, row))'
+)
+
+
+def write_snapshot(workbook, filename, sheets=None):
+    """
+    Write the contents of an xlrd-like workbook to a SQLite snapshot file (atomically).  Each row is stored as a JSON
+    list of cell values.  Against a google sheet, this costs one request per sheet.
+    :param workbook:
+    :param filename:
+    :param sheets: [None] names of sheets to include; default all
+    :return: the number of rows written
+    """
+    if sheets is None:
+        sheets = workbook.sheet_names()
+
+    def _write(tmp):
+        n = 0
+        conn = sqlite3.connect(tmp)
+        try:
+            for stmt in SNAPSHOT_SCHEMA:
+                conn.execute(stmt)
+            conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                             (('source', str(workbook.filename)), ('created', datetime.now().isoformat())))
+            for pos, name in enumerate(sheets):
+                sheet = workbook.sheet_by_name(name)
+                rows = [json.dumps([k.value for k in row], default=str) for row in sheet.get_rows()]
+                conn.execute('INSERT INTO sheets VALUES (?, ?, ?)', (name, pos, len(rows)))
+                conn.executemany('INSERT INTO rows VALUES (?, ?, ?)', ((name, i, row) for i, row in enumerate(rows)))
+                n += len(rows)
+            conn.commit()
+        finally:
+            conn.close()
+        return n
+
+    count = atomic_write(filename, _write, mode=None)
+    print('Saved snapshot of %d sheets (%d rows) to %s' % (len(sheets), count, filename))
+    return count
+
+
+class SnapshotWorkbook(LocalWorkbook):
+    """
+    A LocalWorkbook read lazily from a SQLite snapshot.  Writes modify the in-memory copy only; use save() to write a
+    new snapshot (or save_as() for .xlsx / CSV output).
+    """
+    def __init__(self, filename):
+        super(SnapshotWorkbook, self).__init__()
+        self._path = filename
+        conn = sqlite3.connect(filename)
+        try:
+            self._meta = dict(conn.execute('SELECT key, value FROM meta'))
+            self._index = [k for k, in conn.execute('SELECT name FROM sheets ORDER BY position')]
+        finally:
+            conn.close()
+
+    @property
+    def meta(self):
+        return dict(self._meta)
+
+    @property
+    def loaded(self):
+        return list(self._sheets.keys())
+
+    def sheet_names(self):
+        return self._index + [k for k in self._sheets.keys() if k not in self._index]
+
+    def _data(self, sheet):
+        if sheet not in self._sheets:
+            if sheet not in self._index:
+                raise KeyError(sheet)
+            conn = sqlite3.connect(self._path)
+            try:
+                self._sheets[sheet] = [json.loads(k) for k, in conn.execute(
+                    'SELECT data FROM rows WHERE sheet = ? ORDER BY row', (sheet, ))]
+            finally:
+                conn.close()
+        return self._sheets[sheet]
+
+    def save(self, path=None):
+        """
+        Write the (possibly modified) workbook as a new snapshot
+        :param path: [None] defaults to the snapshot file
+        :return:
+        """
+        path = path or self._path
+        write_snapshot(self, path)
+        self._path = path
+
+    def save_as(self, path):
+        """
+        Write the workbook to an .xlsx file or a directory of CSV files
+        :param path:
+        :return:
+        """
+        for name in self.sheet_names():
+            self._data(name)
+        snapshot = self._path
+        super(SnapshotWorkbook, self).save(path)
+        self._path = snapshot
@@ -0,0 +1,207 @@
+"""
+Contribution screening
+
+Given many processes (or reference exchanges, or fragments) and many LCIA methods, find the substances and the
+processes that contribute most to each method's results.
+
+The computation is streamed: processes are visited one at a time, and each (process, method) LCIA result is reduced
+immediately to per-flowable totals and discarded.  Only the LCI of the current process, one running total per
+(method, flowable), and a heap of the top-n processes per method are held in memory, so a screen can be run over an
+entire background database.
+
+> procs, subs = screen(processes, methods, n=10)
+> show_top_n(subs)
+"""
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappushpop
+
+import numpy as np
+from pandas import DataFrame, MultiIndex
+
+from antelope_core.lcia_results import SummaryLciaResult
+
+
+def _reference(p):
+    """
+    :param p: a process, reference exchange, or fragment
+    :return: node, rx (None for fragments)
+    """
+    if p.entity_type == 'fragment':
+        return p, None
+    if p.entity_type == 'process':
+        return p, p.reference()
+    return p.process, p
+
+
+def _lcia_result(node, rx, q, lci):
+    if rx is None:
+        return node.fragment_lcia(q).flatten()
+    return q.do_lcia(lci)
+
+
+def flowable_contributions(res):
+    """
+    Reduce an LCIA result to totals by flowable.  Static summary components (e.g. fragment terminations with cached
+    scores, or remote results) have no flowable detail; each is reported under '(summary) <name>'.  A private result
+    is reported as a single '(private)' entry.
+    :param res: an LciaResult
+    :return: array of flowable names, array of results
+    """
+    if res.is_private:
+        return np.array(['(private)'], dtype=object), np.array([res.total()], dtype=float)
+    details = []
+    for c in res.components():
+        if isinstance(c, SummaryLciaResult):
+            details.append(('(summary) %s' % c.name, c.cumulative_result))
+        else:
+            details.extend((d.flowable, d.result) for d in c.details())
+    if len(details) == 0:
+        return np.array([], dtype=object), np.zeros(0)
+    names, values = zip(*details)
+    keys, inv = np.unique(np.array(names, dtype=object), return_inverse=True)
+    return keys, np.bincount(inv, weights=np.array(values, dtype=float))
+
+
+class _MethodScreen(object):
+    """
+    Running totals for one method: sum of results by flowable, and the n processes of largest magnitude
+    """
+    def __init__(self, n):
+        self._n = n
+        self._heap = []
+        self._seq = 0
+        self.total = 0.0
+        self.flowables = dict()
+
+    def add(self, node, keys, values, score):
+        score = float(score)
+        self.total += score
+        for k, v in zip(keys, values):
+            self.flowables[k] = self.flowables.get(k, 0.0) + v
+        item = (abs(score), self._seq, node, score)
+        self._seq += 1
+        if len(self._heap) < self._n:
+            heappush(self._heap, item)
+        else:
+            heappushpop(self._heap, item)
+
+    def top_processes(self):
+        return [(node, score) for _, _, node, score in sorted(self._heap, key=lambda x: (-x[0], x[1]))]
+
+    def top_flowables(self):
+        if len(self.flowables) == 0:
+            return []
+        keys = np.array(list(self.flowables.keys()), dtype=object)
+        values = np.array(list(self.flowables.values()))
+        order = np.argsort(-np.abs(values), kind='stable')[:self._n]
+        return list(zip(keys[order], values[order]))
+
+
+def _share(value, total):
+    if total == 0:
+        return np.nan
+    return value / total
+
+
+def _table(rows, columns):
+    index = MultiIndex.from_tuples([r[:2] for r in rows], names=('method', 'rank'))
+    return DataFrame([r[2:] for r in rows], index=index, columns=columns)
+
+
+def screen(processes, methods, n=10, lci=None, lcia=None, max_workers=None):
+    """
+    Compute the top-n processes and top-n substances (by magnitude of contribution) for each method, in a single
+    streaming pass over the processes.  Processes are ranked by their LCIA result totals.
+    :param processes: iterable of processes, reference exchanges, or fragments (may be a generator)
+    :param methods: LCIA methods
+    :param n: [10] number of processes and substances to report per method
+    :param lci: [None] function of (process, rx) that returns the LCI; default process.lci(ref_flow=rx.flow)
+    :param lcia: [None] function of (process, rx, method) that returns an LciaResult already computed, or None to
+     compute it.  If given, the LCI is only retrieved for processes that have some result missing.
+    :param max_workers: [None] if given, evaluate the methods for each process in a thread pool
+    :return: processes DataFrame, substances DataFrame; both indexed by (method link, rank)
+    """
+    methods = list(methods)
+    screens = [_MethodScreen(n) for _ in methods]
+    pool = ThreadPoolExecutor(max_workers=max_workers) if max_workers else None
+    count = 0
+    try:
+        for p in processes:
+            node, rx = _reference(p)
+            known = [None] * len(methods) if lcia is None else [lcia(node, rx, q) for q in methods]
+            if rx is None or all(r is not None for r in known):
+                inventory = None
+            elif lci is None:
+                inventory = list(node.lci(ref_flow=rx.flow))
+            else:
+                inventory = lci(node, rx)
+
+            def _contrib(q_res):
+                _q, _res = q_res
+                if _res is None:
+                    _res = _lcia_result(node, rx, _q, inventory)
+                keys, values = flowable_contributions(_res)
+                return keys, values, _res.total()
+
+            if pool is None:
+                results = [_contrib(k) for k in zip(methods, known)]
+            else:
+                results = list(pool.map(_contrib, zip(methods, known)))
+            for s, (keys, values, total) in zip(screens, results):
+                s.add(node, keys, values, total)
+            count += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print('Screened %d processes against %d methods' % (count, len(methods)))
+
+    p_rows = []
+    s_rows = []
+    for q, s in zip(methods, screens):
+        for i, (node, score) in enumerate(s.top_processes()):
+            p_rows.append((q.link, i + 1, node.link, getattr(node, 'name', str(node)), score, _share(score, s.total)))
+        for i, (flowable, value) in enumerate(s.top_flowables()):
+            s_rows.append((q.link, i + 1, flowable, value, _share(value, s.total)))
+    return (_table(p_rows, ['process', 'name', 'result', 'share']),
+            _table(s_rows, ['flowable', 'result', 'share']))
+
+
+def process_screen(processes, methods, n=10, **kwargs):
+    """
+    The n processes with the largest LCIA results for each method.  See screen()
+    :param processes:
+    :param methods:
+    :param n:
+    :param kwargs: lci, lcia, max_workers
+    :return: DataFrame indexed by (method link, rank) with columns 'process', 'name', 'result', 'share'
+    """
+    return screen(processes, methods, n=n, **kwargs)[0]
+
+
+def substance_screen(processes, methods, n=10, **kwargs):
+    """
+    The n flowables with the largest contributions to each method, summed over all processes.  See screen()
+    :param processes:
+    :param methods:
+    :param n:
+    :param kwargs: lci, lcia, max_workers
+    :return: DataFrame indexed by (method link, rank) with columns 'flowable', 'result', 'share'
+    """
+    return screen(processes, methods, n=n, **kwargs)[1]
+
+
+def show_top_n(df, n=None):
+    """
+    Print a screening result, method by method
+    :param df: output of process_screen() or substance_screen()
+    :param n: [None] show at most n entries per method
+    :return:
+    """
+    label = 'name' if 'name' in df.columns else 'flowable'
+    for method in df.index.get_level_values('method').unique():
+        print('\n%s' % method)
+        sub = df.loc[method]
+        if n is not None:
+            sub = sub.iloc[:n]
+        for rank, row in sub.iterrows():
+            print(' [%02d] %10.4g %6.1f%%  %s' % (rank, row['result'], 100 * row['share'], row[label]))
@@ -0,0 +1,178 @@
+"""
+Bulk synonym ingestion
+
+Adding synonym sets to the LCIA engine one at a time is slow, because each set that overlaps an existing flowable
+triggers a failed add, a merge, and a cascade of lookups.  Here the whole collection is processed up front:
+
+ 1. synonym_groups() joins sets that share a term, and sets whose terms already belong to the same flowable, using a
+    union-find pass.  The term manager is only read (one get_flowable() per distinct term).
+ 2. apply_synonym_groups() then makes exactly one term manager call per group: add_terms() for all-new groups, and
+    merge_flowables() for groups that touch one or more existing flowables.
+
+The groups can be cached to a JSON file, so that later sessions skip both the source data and the grouping pass:
+> load_synonym_sets(cat, list_of_sets, cache_file='synonyms.json')
+"""
+import json
+import os
+
+from synonym_dict import MergeError
+from synonym_dict.synonym_dict import ParentNotFound
+
+from ..util import atomic_write
+
+
+def _key(term):
+    """
+    Synonym dictionaries ignore case and leading / trailing whitespace
+    :param term:
+    :return:
+    """
+    return str(term).strip().lower()
+
+
+class _UnionFind(object):
+    def __init__(self):
+        self._parent = dict()
+
+    def find(self, k):
+        self._parent.setdefault(k, k)
+        root = k
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[k] != root:  # path compression
+            self._parent[k], k = root, self._parent[k]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self._parent[rb] = ra
+        return ra
+
+
+def _known_flowable(cat, term):
+    try:
+        return cat.lcia_engine.get_flowable(term)
+    except KeyError:
+        return None
+
+
+def synonym_groups(list_of_sets, cat=None, skip=('water',)):
+    """
+    Partition the terms of a collection of synonym sets into disjoint groups.  Two sets belong to the same group if
+    they share a term, or (if cat is given) if any of their terms already map to the same flowable.  Within a group,
+    terms are kept in first-seen order, so the first term of the first set is listed first.
+    :param list_of_sets: iterable of iterables of terms
+    :param cat: [None] catalog whose lcia_engine supplies existing flowables
+    :param skip: terms (and existing flowables named by them) that are never used to join sets.  The default mirrors
+     the LciaEngine's refusal to merge incoming terms with 'water'.
+    :return: list of lists of terms
+    """
+    skip = set(_key(k) for k in skip)
+    uf = _UnionFind()
+    order = dict()  # key -> first-seen term
+    for terms in list_of_sets:
+        keys = []
+        for t in terms:
+            if t is None or len(str(t).strip()) == 0:
+                continue
+            k = _key(t)
+            if k not in order:
+                order[k] = str(t).strip()
+            uf.find(k)
+            if k not in skip:
+                keys.append(k)
+        for k in keys[1:]:
+            uf.union(keys[0], k)
+
+    if cat is not None:
+        by_fb = dict()
+        for k, t in order.items():
+            if k in skip:
+                continue
+            fb = _known_flowable(cat, t)
+            if fb is None or _key(fb) in skip:
+                continue
+            if id(fb) in by_fb:
+                uf.union(by_fb[id(fb)], k)
+            else:
+                by_fb[id(fb)] = k
+
+    groups = dict()
+    for k, t in order.items():
+        groups.setdefault(uf.find(k), []).append(t)
+    return list(groups.values())
+
+
+def apply_synonym_groups(cat, groups):
+    """
+    Add each group of synonyms to the catalog's LCIA engine with a single call.  Groups with no known terms become new
+    flowables; otherwise the first known term is dominant and all other terms (and their flowables) are merged into it.
+    :param cat:
+    :param groups: as returned by synonym_groups()
+    :return: dict of counts: 'added', 'merged', 'unchanged', 'failed'; plus 'failures', a list of failed groups
+    """
+    result = {'added': 0, 'merged': 0, 'unchanged': 0, 'failed': 0, 'failures': []}
+    for terms in groups:
+        known = [(t, _known_flowable(cat, t)) for t in terms]
+        try:
+            dom = next(t for t, fb in known if fb is not None)
+        except StopIteration:
+            try:
+                cat.lcia_engine.add_terms('flow', *terms)
+                result['added'] += 1
+            except (MergeError, ParentNotFound):
+                result['failed'] += 1
+                result['failures'].append(terms)
+            continue
+        dom_fb = dict(known)[dom]
+        others = [t for t, fb in known if fb is not dom_fb]
+        if len(others) == 0:
+            result['unchanged'] += 1
+            continue
+        try:
+            cat.lcia_engine.merge_flowables(dom, *others)
+            result['merged'] += 1
+        except (MergeError, ParentNotFound):
+            result['failed'] += 1
+            result['failures'].append(terms)
+    print('synonym groups: %(added)d added, %(merged)d merged, %(unchanged)d unchanged, %(failed)d failed' % result)
+    return result
+
+
+def save_synonym_cache(groups, filename):
+    """
+    Write synonym groups to a JSON file (atomically)
+    :param groups:
+    :param filename:
+    :return:
+    """
+    atomic_write(filename, lambda fp: json.dump({'groups': groups}, fp))
+    print('Saved %d synonym groups to %s' % (len(groups), filename))
+
+
+def load_synonym_cache(filename):
+    with open(filename) as fp:
+        return json.load(fp)['groups']
+
+
+def load_synonym_sets(cat, list_of_sets, cache_file=None, refresh=False, skip=('water',)):
+    """
+    Group and apply a collection of synonym sets, optionally via a cache file.  If the cache file exists, its groups are
+    applied directly and list_of_sets is not consulted; otherwise the groups are computed and the cache is written.
+    :param cat:
+    :param list_of_sets: iterable of iterables of terms, or a function that returns one (only called if needed)
+    :param cache_file: [None]
+    :param refresh: [False] ignore an existing cache file
+    :param skip: see synonym_groups()
+    :return: see apply_synonym_groups()
+    """
+    if cache_file is not None and os.path.exists(cache_file) and not refresh:
+        groups = load_synonym_cache(cache_file)
+    else:
+        if callable(list_of_sets):
+            list_of_sets = list_of_sets()
+        groups = synonym_groups(list_of_sets, cat=cat, skip=skip)
+        if cache_file is not None:
+            save_synonym_cache(groups, cache_file)
+    return apply_synonym_groups(cat, groups)
@@ -1,8 +1,221 @@
 """
 Support operations for TRACI LCIA Methods
+
+The TRACI-specific builders are special cases of derive_quantity(), which constructs a new quantity from the union of
+the characterization factors of one or more source quantities, optionally filtered by flowable or by an arbitrary
+test, and with optional value overrides.  The factors of a derived quantity can be cached to a JSON file, so that later
+sessions re-create it without re-reading the source methods.  The cache file records the specification the quantity
+was built from, and is rebuilt if the specification changes.
 """
+import json
+import os
+
 from antelope import EntityNotFound
 
+from ..util import atomic_write
+
+
+CACHE_FORMAT = 2  # 2: contexts stored as full compartment paths
+
+
+class StaleDerivedQuantity(Exception):
+    """
+    The specification stored in a derived quantity cache file does not match the one requested
+    """
+    pass
+
+
+def _context_path(cx):
+    """
+    The full compartment path of a context, as a tuple (the leaf name alone is ambiguous, e.g. 'urban air' may appear
+    under more than one parent)
+    :param cx:
+    :return:
+    """
+    if cx is None:
+        return ()
+    if hasattr(cx, 'as_list'):
+        return tuple(cx.as_list())
+    if isinstance(cx, (tuple, list)):
+        return tuple(cx)
+    return str(cx),
+
+
+def derived_factors(sources, fg=None, flowables=None, cf_filter=None, override=None):
+    """
+    Collect the characterization factors for a derived quantity, as a list of
+    (flowable, ref_quantity, context, location, value, origin) tuples.  Factors are taken from the sources in order;
+    where two sources characterize the same flowable, ref quantity, context and location, the first one is kept.
+    :param sources: iterable of quantities whose factors are combined
+    :param fg: required if flowables is specified; used to resolve flowable synonyms
+    :param flowables: [None] iterable of flowable names or synonyms to include; default all
+    :param cf_filter: [None] a function of cf that returns True if the cf should be included
+    :param override: [None] a function of (cf, location) that returns the value to use; return None to omit the factor
+    :return:
+    """
+    if flowables is not None:
+        if fg is None:
+            raise ValueError('fg is required to filter by flowable')
+        flowables = set(fg.flowable(k) for k in flowables)
+    fb_memo = dict()
+
+    def _include(_cf):
+        if flowables is not None:
+            fb = str(_cf.flowable)
+            if fb not in fb_memo:
+                fb_memo[fb] = fg.flowable(_cf.flowable) in flowables
+            if not fb_memo[fb]:
+                return False
+        if cf_filter is not None:
+            return cf_filter(_cf)
+        return True
+
+    factors = dict()
+    conflicts = 0
+    for q in sources:
+        for cf in q.factors():
+            if not _include(cf):
+                continue
+            for loc in cf.locations:
+                value = cf[loc] if override is None else override(cf, loc)
+                if value is None:
+                    continue
+                key = (str(cf.flowable), cf.ref_quantity.external_ref, _context_path(cf.context), loc)
+                if key in factors:
+                    if factors[key][4] != value:
+                        conflicts += 1
+                    continue
+                factors[key] = (cf.flowable, cf.ref_quantity, cf.context, loc, value, cf.origin)
+    if conflicts:
+        print('%d conflicting factors ignored (first source wins)' % conflicts)
+    return list(factors.values())
+
+
+def _derivation_spec(name, ref_unit, flowables=None, spec=None, **kwargs):
+    """
+    The JSON form of everything that determines a derived quantity, other than its sources and any filter or
+    override functions (which should be described in spec)
+    :param name:
+    :param ref_unit:
+    :param flowables:
+    :param spec:
+    :param kwargs: properties of the quantity
+    :return: a dict that compares equal to its own JSON round-trip
+    """
+    d = {'format': CACHE_FORMAT,
+         'name': name,
+         'ref_unit': ref_unit,
+         'flowables': None if flowables is None else sorted(str(k) for k in flowables),
+         'properties': kwargs,
+         'spec': spec}
+    return json.loads(json.dumps(d, sort_keys=True, default=str))
+
+
+def save_derived_quantity(q, factors, filename, spec=None):
+    """
+    Serialize a derived quantity's metadata and factors to a JSON file (atomically).  Ref quantities are stored by
+    external_ref, and contexts by their full compartment path.
+    :param q:
+    :param factors: as returned by derived_factors()
+    :param filename:
+    :param spec: [None] JSON-serializable description of how the quantity was derived, checked on load
+    :return:
+    """
+    meta = dict()
+    for k in q.properties():
+        try:
+            json.dumps(q[k])
+        except TypeError:
+            continue
+        meta[k] = q[k]
+    j = {'external_ref': q.external_ref,
+         'name': q['Name'],
+         'ref_unit': q.unit,
+         'properties': meta,
+         'spec': spec,
+         'factors': [[str(fb), rq.external_ref, list(_context_path(cx)), loc, value, origin]
+                     for fb, rq, cx, loc, value, origin in factors]}
+    atomic_write(filename, lambda fp: json.dump(j, fp))
+    print('Saved %d factors for %s to %s' % (len(factors), q.external_ref, filename))
+
+
+def _apply_factors(q, factors):
+    for fb, rq, cx, loc, value, origin in factors:
+        q.characterize(flowable=fb, ref_quantity=rq, context=cx, value=value, location=loc, origin=origin)
+
+
+def load_derived_quantity(fg, filename, external_ref=None, spec=None):
+    """
+    Re-create a derived quantity in fg from a JSON file written by save_derived_quantity().  Each distinct ref
+    quantity is resolved once.
+    :param fg:
+    :param filename:
+    :param external_ref: [None] override the stored external_ref
+    :param spec: [None] if given, raise StaleDerivedQuantity unless it matches the spec stored in the file
+    :return:
+    """
+    with open(filename) as fp:
+        j = json.load(fp)
+    if spec is not None and j.get('spec') != spec:
+        raise StaleDerivedQuantity(filename)
+    external_ref = external_ref or j['external_ref']
+    props = {k: v for k, v in j['properties'].items() if k not in ('Name', 'referenceUnit', 'UnitConversion')}
+    q = fg.new_quantity(j['name'], ref_unit=j['ref_unit'], external_ref=external_ref, **props)
+    rqs = dict()
+    for rq in set(k[1] for k in j['factors']):
+        try:
+            rqs[rq] = fg.get_canonical(rq)
+        except EntityNotFound:
+            print('Ref quantity %s not found' % rq)
+    _apply_factors(q, ((fb, rqs[rq], cx if isinstance(cx, str) else tuple(cx), loc, value, origin)
+                       for fb, rq, cx, loc, value, origin in j['factors'] if rq in rqs))
+    return q
+
+
+def derive_quantity(fg, external_ref, name, ref_unit, sources, flowables=None, cf_filter=None, override=None,
+                    cache_file=None, refresh=False, spec=None, **kwargs):
+    """
+    Create a new quantity in fg whose factors are drawn from the source quantities (see derived_factors()).  If the
+    quantity already exists in fg, it is returned as-is.  If a cache file is given and exists, and was written with
+    the same name, unit, flowables, properties, and spec, the quantity is re-created from it without consulting the
+    sources; otherwise the quantity is built and the cache file is (re-)written.
+    :param fg: Foreground to contain the new quantity
+    :param external_ref:
+    :param name:
+    :param ref_unit:
+    :param sources: iterable of quantities, or a function that returns them (only called if the sources are needed)
+    :param flowables: [None] see derived_factors()
+    :param cf_filter: [None] see derived_factors()
+    :param override: [None] see derived_factors()
+    :param cache_file: [None] JSON file in which to cache the derived factors
+    :param refresh: [False] ignore an existing cache file and rebuild from the sources
+    :param spec: [None] JSON-serializable description of anything else that determines the factors, such as the
+     sources, cf_filter, or override, which cannot be compared directly.  A cache file written under a different
+     spec is rebuilt.
+    :param kwargs: properties of the new quantity
+    :return:
+    """
+    try:
+        return fg.get(external_ref)
+    except EntityNotFound:
+        pass
+
+    d_spec = _derivation_spec(name, ref_unit, flowables=flowables, spec=spec, **kwargs)
+    if cache_file is not None and os.path.exists(cache_file) and not refresh:
+        try:
+            return load_derived_quantity(fg, cache_file, external_ref=external_ref, spec=d_spec)
+        except StaleDerivedQuantity:
+            print('%s: specification has changed; rebuilding' % cache_file)
+
+    if callable(sources):
+        sources = sources()
+    factors = derived_factors(sources, fg=fg, flowables=flowables, cf_filter=cf_filter, override=override)
+    new_q = fg.new_quantity(name, ref_unit=ref_unit, external_ref=external_ref, **kwargs)
+    _apply_factors(new_q, factors)
+    if cache_file is not None:
+        save_derived_quantity(new_q, factors, cache_file, spec=d_spec)
+    return new_q
+
 
 def traci_2_replicate_nox_no2(q):
     """
@@ -15,7 +228,7 @@ def traci_2_replicate_nox_no2(q):
         q.characterize(flowable='nitrogen dioxide', ref_quantity=cf.ref_quantity, context=cf.context, value=cf.value)
 
 
-def traci_2_combined_eutrophication(traci, fg, external_ref='Eutrophication', omit_n2=True):
+def traci_2_combined_eutrophication(traci, fg, external_ref='Eutrophication', omit_n2=True, cache_file=None):
     """
     Construct a combined eutrophication indicator that is the union of the TRACI 2.1 Eutrophication Air and
     Eutrophication Water methods.
@@ -23,36 +236,27 @@ def traci_2_combined_eutrophication(traci, fg, external_ref='Eutrophication', om
     :param fg: Foreground to contain the new combined eutrophication method
     :param external_ref: ('Eutrophication') what external reference to assign to the newly created quantity
     :param omit_n2: [True] skip the CF on gaseous nitrogen
+    :param cache_file: [None] see derive_quantity()
     :return:
     """
-    old_euts = [traci.get(k) for k in ('Eutrophication Air', 'Eutrophication Water')]
-    try:
-        return fg.get(external_ref)
-    except EntityNotFound:
-        pass
-
-    new_eut = fg.new_quantity('Eutrophication Air + Water', ref_unit='kg N eq', external_ref=external_ref,
-                              Method='TRACI 2.1 - Reference',
-                              Category='Eutrophication', ShortName='Eutrophication', Indicator='kg N eq',
-                              uuid='69726949-4add-4605-8f40-61e56f2b412c',
-                              Comment="Union of TRACI 2.1 'Eutrophication Air' and 'Eutrophication Water'")
-    for eu in old_euts:
-        for cf in eu.factors():
-            if str(cf.flowable).lower() == 'nitrogen' and cf.context.name in ('air', 'to air'):
-                if omit_n2:
-                    print('Omitting gaseous nitrogen to air eutrophication\n%s' % cf)
-                    for loc in cf.locations:
-                        new_eut.characterize(flowable=cf.flowable, ref_quantity=cf.ref_quantity, context=cf.context,
-                                             value=0.0, location=loc, origin=cf.origin)
-                    continue
+    def _override(cf, loc):
+        if omit_n2 and str(cf.flowable).lower() == 'nitrogen' and cf.context.name in ('air', 'to air'):
+            print('Omitting gaseous nitrogen to air eutrophication\n%s' % cf)
+            return 0.0
+        return cf[loc]
 
-            for loc in cf.locations:
-                new_eut.characterize(flowable=cf.flowable, ref_quantity=cf.ref_quantity, context=cf.context,
-                                     value=cf[loc], location=loc, origin=cf.origin)
-    return new_eut
+    return derive_quantity(fg, external_ref, 'Eutrophication Air + Water', 'kg N eq',
+                           lambda: [traci.get(k) for k in ('Eutrophication Air', 'Eutrophication Water')],
+                           override=_override, cache_file=cache_file,
+                           spec={'builder': 'traci_2_combined_eutrophication', 'origin': traci.origin,
+                                 'omit_n2': bool(omit_n2)},
+                           Method='TRACI 2.1 - Reference',
+                           Category='Eutrophication', ShortName='Eutrophication', Indicator='kg N eq',
+                           uuid='69726949-4add-4605-8f40-61e56f2b412c',
+                           Comment="Union of TRACI 2.1 'Eutrophication Air' and 'Eutrophication Water'")
 
 
-def traci_2_biogenic_co2(traci, fg, external_ref='gwp_bio_co2', indicator='kg CO2eq incl bio'):
+def traci_2_biogenic_co2(traci, fg, external_ref='gwp_bio_co2', indicator='kg CO2eq incl bio', cache_file=None):
     """
     Duplicate the GWP method, but force the duplicate to compute biogenic CO2: see
     antelope_core.implementations.quantity.do_lcia()
@@ -62,6 +266,7 @@ def traci_2_biogenic_co2(traci, fg, external_ref='gwp_bio_co2', indicator='kg CO
     :param fg:
     :param external_ref:
     :param indicator:
+    :param cache_file: [None] see derive_quantity()
     :return:
     """
     try:
@@ -70,29 +275,24 @@ def traci_2_biogenic_co2(traci, fg, external_ref='gwp_bio_co2', indicator='kg CO
         pass
 
     old_gwp = traci.get('Global Warming Air')
-    new_gwp = fg.new_quantity('Global Warming Air - with biogenic CO2', ref_unit=indicator,
-                              external_ref=external_ref,
-                              Method=old_gwp['Method'], Category='Global Warming Air - including biogenic CO2',
-                              Indicator=indicator,
-                              uuid='64583b7d-bdd0-4d44-ae53-494d5b192606',
-                              Comment='TRACI GWP method with biogenic CO2 enforced',
-                              quell_biogenic_co2=False)
     old_gwp['quell_biogenic_co2'] = True
-
-    for cf in old_gwp.factors():
-        for loc in cf.locations:
-            new_gwp.characterize(flowable=cf.flowable, ref_quantity=cf.ref_quantity, context=cf.context,
-                                 value=cf[loc], location=loc, origin=cf.origin)
-    return new_gwp
+    return derive_quantity(fg, external_ref, 'Global Warming Air - with biogenic CO2', indicator, [old_gwp],
+                           cache_file=cache_file, spec={'builder': 'traci_2_biogenic_co2', 'source': old_gwp.link},
+                           Method=old_gwp['Method'], Category='Global Warming Air - including biogenic CO2',
+                           Indicator=indicator,
+                           uuid='64583b7d-bdd0-4d44-ae53-494d5b192606',
+                           Comment='TRACI GWP method with biogenic CO2 enforced',
+                           quell_biogenic_co2=False)
 
 
-def traci_2_biogenic_co2_only(traci, fg, external_ref='gwp_bio_co2_only', indicator='kg CO2-bio'):
+def traci_2_biogenic_co2_only(traci, fg, external_ref='gwp_bio_co2_only', indicator='kg CO2-bio', cache_file=None):
     """
     Create a new method that *only* includes biogenic CO2 flows
     :param traci:
     :param fg:
     :param external_ref:
     :param indicator:
+    :param cache_file: [None] see derive_quantity()
     :return:
     """
     try:
@@ -101,19 +301,12 @@ def traci_2_biogenic_co2_only(traci, fg, external_ref='gwp_bio_co2_only', indica
         pass
 
     old_gwp = traci.get('Global Warming Air')
-    bio_c_only = fg.new_quantity('Global Warming Air - biogenic CO2 Only', ref_unit=indicator,
-                                 external_ref=external_ref,
-                                 Method=old_gwp['Method'], Category='Global Warming Air - only biogenic CO2',
-                                 Indicator=indicator,
-                                 uuid='2271523e-108f-4216-a65e-dac18ce3e83f',
-                                 Comment='GWP from biogenic CO2 only (no other emissions included)',
-                                 quell_biogenic_co2='only')
     old_gwp['quell_biogenic_co2'] = True
-
-    co2 = fg.flowable('124-38-9')
-    for cf in old_gwp.factors():
-        if fg.flowable(cf.flowable) is co2:
-            for loc in cf.locations:
-                bio_c_only.characterize(flowable=cf.flowable, ref_quantity=cf.ref_quantity, context=cf.context,
-                                        value=cf[loc], location=loc, origin=cf.origin)
-    return bio_c_only
+    return derive_quantity(fg, external_ref, 'Global Warming Air - biogenic CO2 Only', indicator, [old_gwp],
+                           flowables=('124-38-9',), cache_file=cache_file,
+                           spec={'builder': 'traci_2_biogenic_co2_only', 'source': old_gwp.link},
+                           Method=old_gwp['Method'], Category='Global Warming Air - only biogenic CO2',
+                           Indicator=indicator,
+                           uuid='2271523e-108f-4216-a65e-dac18ce3e83f',
+                           Comment='GWP from biogenic CO2 only (no other emissions included)',
+                           quell_biogenic_co2='only')
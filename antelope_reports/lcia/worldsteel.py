@@ -1,8 +1,7 @@
 """
 Synonyms and flowables for the WorldSteel XLSX file
 """
-from synonym_dict import MergeError
-from synonym_dict.synonym_dict import ParentNotFound
+from .synonyms import load_synonym_sets
 
 import re
 
@@ -104,42 +103,16 @@ def ws_syn_finder(_cat, iters):
     return s
 
 
-def _known_unknown(_cat, *terms):
-    uk = set(terms)
-    for t in terms:
-        try:
-            k = _cat.lcia_engine.get_flowable(t)
-            uk.remove(t)
-            return k.name, uk
-        except KeyError:
-            pass
-
-
-def _worldsteel_synonyms(_cat, syns):
-    try:
-        _cat.lcia_engine.add_terms('flow', *syns)
-    except MergeError:
-        k, uk = _known_unknown(_cat, *syns)
-        if k:
-            try:
-                _cat.lcia_engine.merge_flowables(k, *uk)
-                print('merged %s' % (syns,))
-            except ParentNotFound:
-                print('wtf %s' % (syns,))
-        else:
-            print('could not merge %s' % (syns,))
-
-
-def worldsteel_flowables(cat, ws):
+def worldsteel_flowables(cat, ws, cache_file=None, refresh=False):
     """
     Attempts to add flowables with the format "One name, comma-separated (alternate name)",
     with a large set of exclusions.  Adds 'one name, comma-separated' and 'alternative name' as synonyms.
     :param cat: a catalog
     :param ws: a query whose flows() have names matching the above format
+    :param cache_file: [None] JSON file to cache the synonym groups (the ws flows are not read if it exists)
+    :param refresh: [False] ignore an existing cache file
     :return:
     """
     # worldsteel flowables
-    ws_syns = ws_syn_finder(cat, ws.flows())
-
-    for syns in ws_syns:
-        _worldsteel_synonyms(cat, syns)
+    return load_synonym_sets(cat, lambda: sorted(ws_syn_finder(cat, ws.flows())), cache_file=cache_file,
+                             refresh=refresh)
@@ -1,11 +1,55 @@
+import os
+from math import isclose
+
 from antelope import EntityNotFound
 from xlstools.google_sheet_reader import GoogleSheetReader
-from googleapiclient.errors import HttpError
+from pandas import DataFrame
+try:
+    from googleapiclient.errors import HttpError
+except ImportError:
+    class HttpError(Exception):
+        """
+        google-api-python-client is not installed; only local workbooks can be used
+        """
+        pass
+
+from ..unit_conversion import conversion_cache
+from .local_workbook import LocalWorkbook, SnapshotWorkbook, write_snapshot
 
 INDEX_HEADINGS = ('Abbreviation', 'Name', 'ShortName', 'Method', 'Category', 'Indicator', 'unit', 'uuid', 'Comment', 'Notes')
 FACTOR_HEADINGS = ('flowable', 'context', 'ref_quantity', 'ref_unit', 'locale', 'value')
 
 
+def _norm_cell(value):
+    if value is None:
+        return ''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _same_row(a, b):
+    """
+    Compare a sheet row with a computed row, the way a google sheet would read them back (blanks are None, numeric
+    strings are floats)
+    :param a:
+    :param b:
+    :return:
+    """
+    n = max(len(a), len(b))
+    a = list(a) + [None] * (n - len(a))
+    b = list(b) + [None] * (n - len(b))
+    for x, y in zip(a, b):
+        x, y = _norm_cell(x), _norm_cell(y)
+        if isinstance(x, float) and isinstance(y, float):
+            if not isclose(x, y, rel_tol=1e-9):
+                return False
+        elif x != y:
+            return False
+    return True
+
+
 class QdbGSheetClient(object):
     """
     This class allows us to do the following things:
@@ -29,17 +73,65 @@ class QdbGSheetClient(object):
     local quantity is stored as a mapping to the abbreviation of the remote quantity.
 
     The external_ref used for a quantity in a local foreground can vary.  Any time
+
+    Factor sheets are read in bulk (one read per sheet, into a DataFrame) and written back by difference, touching
+    only the rows that changed.  For offline use, any LocalWorkbook (an .xlsx file or a directory of CSVs) can stand
+    in for the google sheet-- see from_file().
+
+    To avoid network access at startup, supply a snapshot filename.  If the snapshot exists, the client loads from it,
+    reading the Quantities index immediately and each factor sheet only when it is first used; the remote sheet is
+    not contacted until refresh_snapshot() is called.  If it does not exist, it is created from the remote sheet.
+    In snapshot mode, writes modify the local copy only; call save_snapshot() to persist them.
     """
-    def __init__(self, fg, sheet_id, json_credential=None, credential_file=None, **kwargs):
+    @classmethod
+    def from_file(cls, fg, path, **kwargs):
+        """
+        Use a local .xlsx file or directory of CSV files in place of the google sheet.  Call client.workbook.save()
+        to persist changes.
+        :param fg:
+        :param path: created on save if it does not exist
+        :param kwargs:
+        :return:
+        """
+        return cls(fg, workbook=LocalWorkbook(path), **kwargs)
+
+    def __init__(self, fg, sheet_id=None, json_credential=None, credential_file=None, workbook=None,
+                 snapshot=None, refresh=False, **kwargs):
+        """
+
+        :param fg:
+        :param sheet_id: google sheet ID
+        :param json_credential:
+        :param credential_file:
+        :param workbook: [None] an xlstools-style writable workbook to use instead of a google sheet
+        :param snapshot: [None] SQLite snapshot file to load from (or to create, if it does not exist)
+        :param refresh: [False] re-create an existing snapshot from the remote sheet
+        :param kwargs:
+        """
         self._fg = fg
-        cred = json_credential or credential_file
-        self._xls = GoogleSheetReader(cred, sheet_id)
+        self._sheet_id = sheet_id
+        self._cred = json_credential or credential_file
+        self._snapshot = snapshot
+        if workbook is None:
+            if snapshot is not None and os.path.exists(snapshot) and not refresh:
+                workbook = SnapshotWorkbook(snapshot)
+            else:
+                workbook = self._remote_workbook()
+        self._xls = workbook
         self._args = kwargs
         self._qsheet = None
         self._qs = []  # list of indicators in sequence
         self._qd = dict()  # dict of ref to indicator
         self._ext_ref_mapping = dict()  # custom mapping of fg external ref to indicator name "item"
         self.load_quantities()
+        if snapshot is not None and not isinstance(self._xls, SnapshotWorkbook):
+            self.save_snapshot()
+            self._xls = SnapshotWorkbook(snapshot)
+
+    def _remote_workbook(self):
+        if self._sheet_id is None:
+            raise ValueError('Either sheet_id or workbook is required')
+        return GoogleSheetReader(self._cred, self._sheet_id)
 
     @property
     def fg(self):
@@ -49,6 +141,42 @@ class QdbGSheetClient(object):
     def static(self):
         return False
 
+    @property
+    def workbook(self):
+        return self._xls
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def save_snapshot(self, filename=None):
+        """
+        Write the Quantities index and every factor sheet in the current workbook to a SQLite snapshot
+        :param filename: [None] defaults to the client's snapshot file
+        :return:
+        """
+        filename = filename or self._snapshot
+        if filename is None:
+            raise ValueError('No snapshot file specified')
+        names = self._xls.sheet_names()
+        sheets = ['Quantities'] + [q for q in self._qs if q in names]
+        write_snapshot(self._xls, filename, sheets=sheets)
+        if self._snapshot is None:
+            self._snapshot = filename
+
+    def refresh_snapshot(self):
+        """
+        Re-read the Quantities index and all factor sheets from the remote google sheet and re-create the snapshot.
+        Any local changes to the snapshot that were not written to the remote sheet are lost.
+        :return:
+        """
+        if self._snapshot is None:
+            raise ValueError('No snapshot file specified')
+        self._xls = self._remote_workbook()
+        self.load_quantities()
+        self.save_snapshot()
+        self._xls = SnapshotWorkbook(self._snapshot)
+
     def load_quantities(self):
         if 'Quantities' not in self._xls.sheet_names():
             self._xls.create_sheet('Quantities')
@@ -171,57 +299,158 @@ class QdbGSheetClient(object):
         return columns
 
     def _create_or_retrieve_cf_sheet(self, item):
+        """
+        Column headings are only written if the sheet is new or its headings do not match
+        :param item:
+        :return:
+        """
         columns = self._factor_headings(item)
         if item not in self._xls.sheet_names():
             self._xls.create_sheet(item)
+        sheet = self._xls.sheet_by_name(item)
+        if sheet.nrows > 0 and _same_row([k.value for k in sheet.row(0)][:len(columns)], columns):
+            return sheet
         try:
             self._xls.write_row(item, 0, columns)
         except HttpError:
             print('No write access; not updating column headings for %s' % item)
         return self._xls.sheet_by_name(item)
 
-    def update_cfs(self, item, external_ref=None):
+    @staticmethod
+    def _sheet_frame(sheet, columns):
         """
-        Appply static gsheet CFs to local quantity
+        Read a factor sheet into a DataFrame in a single pass.  The index is the 0-indexed sheet row.
+        :param sheet:
+        :param columns:
+        :return:
+        """
+        n = len(columns)
+        rows = []
+        index = []
+        for i, row in enumerate(sheet.get_rows()):
+            if i == 0:
+                continue
+            vals = [k.value for k in row[:n]]
+            rows.append(vals + [None] * (n - len(vals)))
+            index.append(i)
+        return DataFrame(rows, index=index, columns=list(columns), dtype=object)
 
+    def factor_table(self, item, external_ref=None):
+        """
+        Return the contents of the remote factor sheet for the given item as a DataFrame
         :param item:
-        :param external_ref: reference for local quantity
+        :param external_ref:
         :return:
         """
         item, external_ref = self._update_mapping(item, external_ref)
-        ent = self.fetch_quantity(item, external_ref)
         sheet = self._create_or_retrieve_cf_sheet(item)
-        for i in range(1, sheet.nrows):
-            cf = sheet.row_dict(i)
+        return self._sheet_frame(sheet, self._factor_headings(item))
+
+    def _resolve_ref_quantities(self, names):
+        rqs = dict()
+        for name in names:
+            if name is None:
+                continue
             try:
-                rq = self.fg.get_canonical(cf['ref_quantity'])
+                rqs[name] = self.fg.get_canonical(name)
             except EntityNotFound:
-                print('Ref quantity %s not found' % cf['ref_quantity'])
-                continue
-            value = cf['value'] * rq.convert(to=cf['ref_unit'])  # check this!  if the CF is 45 points per gram and
-            # the ref unit is kg, then that's 45,000 points per kg
-            ent.characterize(cf['flowable'], rq, value, context=cf['context'], location=cf['locale'],  # why "location"?
-                             overwrite=True)
+                print('Ref quantity %s not found' % name)
+        return rqs
 
-        return ent
+    @staticmethod
+    def _cf_key(flowable, context, ref_quantity, locale):
+        return str(flowable), str(context), ref_quantity.external_ref, str(locale)
 
-    def write_quantity_cfs(self, item, external_ref=None):
+    def update_cfs(self, item, external_ref=None):
         """
-        Write local CFs to the google sheet (destructively-- run update_cfs first to not lose data)
+        Appply static gsheet CFs to local quantity
+
+        The factor sheet is read once; each distinct ref quantity and (ref quantity, unit) conversion is resolved once,
+        and factors that already match the local quantity are not re-applied.
+
         :param item:
-        :param external_ref:
+        :param external_ref: reference for local quantity
         :return:
         """
         item, external_ref = self._update_mapping(item, external_ref)
         ent = self.fetch_quantity(item, external_ref)
+        df = self.factor_table(item, external_ref)
+        df = df[df['flowable'].notnull()]
 
-        self._create_or_retrieve_cf_sheet(item)
+        rqs = self._resolve_ref_quantities(set(df['ref_quantity']))
+        # check this!  if the CF is 45 points per gram and the ref unit is kg, then that's 45,000 points per kg
+        convs = {(rq, unit): conversion_cache.convert(rqs[rq], to=unit)
+                 for rq, unit in set(zip(df['ref_quantity'], df['ref_unit'])) if rq in rqs}
 
+        existing = dict()
+        for cf in ent.factors():
+            for locale in cf.locations:
+                existing[self._cf_key(cf.flowable, cf.context.name, cf.ref_quantity, locale)] = cf[locale]
+
+        applied = unchanged = skipped = 0
+        for flowable, context, rq_name, unit, locale, value in df[list(FACTOR_HEADINGS)].itertuples(index=False):
+            if rq_name not in rqs or value is None:
+                skipped += 1
+                continue
+            rq = rqs[rq_name]
+            value = float(value) * convs[rq_name, unit]
+            known = existing.get(self._cf_key(flowable, context, rq, locale))
+            if known is not None and isclose(known, value, rel_tol=1e-9):
+                unchanged += 1
+                continue
+            ent.characterize(flowable, rq, value, context=context, location=locale,  # why "location"?
+                             overwrite=True)
+            applied += 1
+
+        print('%s: %d factors applied, %d unchanged, %d skipped' % (item, applied, unchanged, skipped))
+        return ent
+
+    @staticmethod
+    def _local_cf_rows(ent):
         data = []
         for cf in sorted(ent.factors(), key=lambda x: (x.flowable, x.context.name)):
             for locale in cf.locations:
                 row = (cf.flowable, cf.context.name, cf.ref_quantity['name'], cf.ref_quantity.unit,
                        locale, cf[locale], ent.unit)
                 data.append(row)
-        self._xls.clear_region(item, start_row=1)
-        self._xls.write_rectangle_by_rows(item, data, start_row=1)
+        return data
+
+    def write_quantity_cfs(self, item, external_ref=None, diff=True):
+        """
+        Write local CFs to the google sheet (destructively-- run update_cfs first to not lose data)
+
+        By default, the sheet is compared with the local CFs and only changed rows are written, as one range update per
+        contiguous block of rows; surplus rows at the end of the sheet are cleared.
+        :param item:
+        :param external_ref:
+        :param diff: [True] if False, clear and rewrite the whole sheet
+        :return:
+        """
+        item, external_ref = self._update_mapping(item, external_ref)
+        ent = self.fetch_quantity(item, external_ref)
+
+        sheet = self._create_or_retrieve_cf_sheet(item)
+        data = self._local_cf_rows(ent)
+        if not diff:
+            self._xls.clear_region(item, start_row=1)
+            self._xls.write_rectangle_by_rows(item, data, start_row=1)
+            return
+
+        n = len(self._factor_headings(item))
+        current = [[k.value for k in row[:n]] for i, row in enumerate(sheet.get_rows()) if i > 0]
+        changed = [i for i, row in enumerate(data) if i >= len(current) or not _same_row(current[i], row)]
+
+        blocks = []
+        for i in changed:
+            if blocks and i == blocks[-1][-1] + 1:
+                blocks[-1].append(i)
+            else:
+                blocks.append([i])
+        for block in blocks:
+            # blank cells must be written as '' to overwrite stale values
+            rows = [['' if v is None else v for v in data[i]] for i in block]
+            self._xls.write_rectangle_by_rows(item, rows, start_row=block[0] + 1)
+        if len(current) > len(data):
+            self._xls.clear_region(item, start_row=len(data) + 1)
+        print('%s: %d rows written in %d blocks; %d rows cleared' % (item, len(changed), len(blocks),
+                                                                     max(len(current) - len(data), 0)))
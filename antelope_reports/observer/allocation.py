@@ -1,4 +1,6 @@
 
+from pandas import DataFrame
+
 from antelope_core.contexts import NullContext
 from antelope import comp_dir
 
@@ -17,11 +19,48 @@ class AllocationEngine(object):
     @classmethod
     def all_flows(cls, fg, spanner, alloc_flow, external_ref=None, scenario=True):
         ae = cls(fg, spanner, alloc_flow, external_ref=external_ref)
-        for c in spanner.cutoffs(scenario):
-            ae.allocate_flow(c.flow, c.direction)
+        ae.allocate_cutoffs(spanner.cutoffs(scenario))
 
         return ae
 
+    @classmethod
+    def allocate_spanners(cls, fg, spanners, alloc_flow, scenario=True, build_products=True, cap_activity=True):
+        """
+        Builds allocators for many spanners with the same allocation flow.  Each spanner is traversed once; the
+        characterization factor of each distinct cutoff flow is computed once across all spanners; and an allocated
+        product is built for every allocatable output.
+        :param fg:
+        :param spanners: iterable of multi-output models
+        :param alloc_flow:
+        :param scenario: [True] passed to cutoffs()
+        :param build_products: [True] build an allocated product for every allocatable output
+        :param cap_activity: [True] passed to build_allocated_product()
+        :return: dict of spanner external_ref -> AllocationEngine, and a DataFrame reporting the allocation shares
+        """
+        cfs = dict()
+        engines = dict()
+        rows = []
+        for spanner in spanners:
+            ae = cls(fg, spanner, alloc_flow)
+            engines[spanner.external_ref] = ae
+            allocs = ae.allocate_cutoffs(spanner.cutoffs(scenario), cfs=cfs)
+            total = sum(amt for c, cf, amt in allocs)
+            for c, cf, amt in allocs:
+                product = None
+                if build_products and c.direction == 'Output':
+                    product = ae.build_allocated_product(c.flow, cap_activity=cap_activity).external_ref
+                rows.append({'spanner': spanner.external_ref,
+                             'flow': c.flow.external_ref,
+                             'direction': c.direction,
+                             'value': c.value,
+                             'cf': cf,
+                             'amount': amt,
+                             'share': amt / total if total else None,
+                             'product': product})
+        print('Allocated %d spanners; %d allocatable flows (%d distinct)' % (len(engines), len(rows),
+                                                                             len([v for v in cfs.values() if v != 0])))
+        return engines, DataFrame(rows)
+
     def __init__(self, fg, spanner, alloc_flow, external_ref=None):
         """
         We store the spanner
@@ -47,7 +86,29 @@ class AllocationEngine(object):
     def allocator(self):
         return self._fg[self._allocator]
 
-    def allocate_flow(self, flow, direction='Output'):
+    def allocate_cutoffs(self, cutoffs, cfs=None):
+        """
+        Allocate a set of cutoff exchanges in one pass over the allocator's child flows.
+        :param cutoffs: iterable of exchanges, e.g. spanner.cutoffs()
+        :param cfs: [None] dict of flow link -> characterization factor, shared across calls (updated in place)
+        :return: list of (cutoff, cf, amount of allocation quantity) for the allocatable cutoffs
+        """
+        if cfs is None:
+            cfs = dict()
+        alloc_qty = self.alloc_flow.reference_entity
+        children = {c.flow.link: c for c in self.allocator.child_flows}
+        allocs = []
+        for c in cutoffs:
+            if c.flow.link not in cfs:
+                cfs[c.flow.link] = c.flow.cf(alloc_qty)
+            cf = cfs[c.flow.link]
+            if cf != 0:
+                children[c.flow.link] = self.allocate_flow(c.flow, c.direction, cf=cf,
+                                                           child=children.get(c.flow.link))
+                allocs.append((c, cf, c.value * cf))
+        return allocs
+
+    def allocate_flow(self, flow, direction='Output', cf=None, child=None):
         """
         Adds a child flow to the allocator, and attaches a balance flow converting it to the allocation flow. If the
         flow is not generated by the embedded model, it will not be driven and will show zero activity.
@@ -59,19 +120,26 @@ class AllocationEngine(object):
         the internal traversal.
         :param flow:
         :param direction: default 'Output'
-        :return:
+        :param cf: [None] the flow's characterization factor in the allocation quantity, if already known
+        :param child: [None] the allocator's existing child flow for the flow, if already known
+        :return: the allocator's child flow, or None if the flow is not allocatable
         """
         alloc_qty = self.alloc_flow.reference_entity
         container = self.allocator
 
-        if flow.cf(alloc_qty) != 0:
-            try:
-                j = next(container.children_with_flow(flow))
-            except StopIteration:
-                j = self._fg.new_fragment(flow, direction, parent=container)
-                self._fg.new_fragment(self.alloc_flow, direction, parent=j, balance=True)
+        if cf is None:
+            cf = flow.cf(alloc_qty)
+        if cf != 0:
+            j = child
+            if j is None:
+                try:
+                    j = next(container.children_with_flow(flow))
+                except StopIteration:
+                    j = self._fg.new_fragment(flow, direction, parent=container)
+                    self._fg.new_fragment(self.alloc_flow, direction, parent=j, balance=True)
 
             j.balance_flow.flow = self.alloc_flow
+            return j
 
     def _build_allocation_container(self):
         """
@@ -2,12 +2,23 @@
 This module provides a routine that generates a list of exchange refs from a properly formatted spreadsheet
 """
 
+import logging
+
 from antelope import check_direction, CatalogRef, ExchangeRef
 from antelope.interfaces import InvalidDirection
 
 from .float_conv import to_float
 
 
+FLOW_KEYS = ('flow', 'flowref', 'flow_ref', 'external_ref')
+DIRECTION_KEYS = ('direction', 'flowdir')
+VALUE_KEYS = ('value', 'amount')
+UNIT_KEYS = ('unit', 'units')
+TERM_KEYS = ('target', 'defaultprovider', 'activitylinkid', 'term', 'termination', 'anchor_node')
+CONTEXT_KEYS = ('context', 'compartment')
+IGNORED_KEYS = ('process', )
+
+
 class EmptyFlowRef(Exception):
     """
     Used to signal a blank entry
@@ -33,69 +44,110 @@ class TermDictDeprecated(Exception):
     pass
 
 
-def _row_dict(sheetlike, row):
-    """
-    Creates a dictionary from the named row of the 'sheetlike' input.
-    :param sheetlike: has row() method returns a list of strings
-    :param row: int
-    :return: dict k: v where k are entry.value.lower() for entry in row(0) and v are entry.value for entry in row(row)
-    """
-    headers = [str(k.value).lower() for k in sheetlike.row(0)]
-    return {headers[i]: k.value for i, k in enumerate(sheetlike.row(row)) if i < len(headers)}
+def _describe_exchange(flow, dirn, value, unit, term):
+    if value is ValueIsBalance:
+        return '%s %s (balance) %s [%s]' % (flow, dirn, unit, term)
+    return '%s %s %g %s [%s]' % (flow, dirn, value, unit, term)
 
 
-def _popanykey(dct, *keys, strict=False):
+class ExchangeColumns(object):
     """
-    Returns the first of the listed keys to be found in the dict
-    :param dct: a dict
-    :param keys:
-    :param strict: [False] if True, raise KeyError if we get to the end of the list and nothing was found
-    :return:
+    The header row of an exchange sheet, read once.  Each set of column aliases is resolved to the indices of the
+    columns that are actually present, in alias order, so that a row can be parsed by position without building a
+    dict for every row.
+
+    Aliases are consumed the way a dict pop would: the columns of a set are taken in order up to and including the
+    first one that is not an empty string, and any later aliases in that set (e.g. a 'context' column alongside a
+    termination) are left in place.  All columns not consumed (except 'process') are passed to the exchange ref as
+    initialization arguments.
     """
-    for key in keys:
-        if key.lower() in dct:
-            k = dct.pop(key.lower())
-            if k == '':
-                continue
-            return k
-    if strict:
-        raise KeyError(keys)
-    return None
-
-
-def _exchange_params(origin, rowdict):
+    def __init__(self, header):
+        """
+        :param header: a list of header cells (or values)
+        """
+        self.headers = [str(getattr(k, 'value', k)).lower() for k in header]
+        index = {h: i for i, h in enumerate(self.headers)}  # the last duplicate header wins
+        self.flow = tuple(index[k] for k in FLOW_KEYS if k in index)
+        self.direction = tuple(index[k] for k in DIRECTION_KEYS if k in index)
+        self.value = tuple(index[k] for k in VALUE_KEYS if k in index)
+        self.unit = tuple(index[k] for k in UNIT_KEYS if k in index)
+        self.term = tuple(index[k] for k in TERM_KEYS if k in index)
+        self.context = tuple(index[k] for k in CONTEXT_KEYS if k in index)
+        self.fields = tuple((h, i) for h, i in index.items() if h not in IGNORED_KEYS)
+
+    @property
+    def missing(self):
+        """
+        Names of required fields for which no column is present
+        :return:
+        """
+        return tuple(k for k, c in (('flow', self.flow), ('direction', self.direction), ('value', self.value))
+                     if len(c) == 0)
+
+    @staticmethod
+    def _take(values, cols, consumed, keys=None):
+        """
+        Return the value of the first column that is present in the row and not an empty string, recording every
+        column examined as consumed.
+        :param values: list of cell values
+        :param cols: column indices, in alias order
+        :param consumed: set of consumed column indices (modified)
+        :param keys: [None] if given, raise KeyError(keys) if no column supplies a value
+        :return:
+        """
+        for c in cols:
+            if c < len(values):
+                consumed.add(c)
+                if values[c] == '':
+                    continue
+                return values[c]
+        if keys is not None:
+            raise KeyError(keys)
+        return None
+
+    def parse(self, origin, values):
+        """
+        Determine the exchange parameters from a row of cell values
+        :param origin:
+        :param values: list of cell values
+        :return: flow, dirn, value, unit, term, kwargs
+        """
+        consumed = set()
+        flow_ref = self._take(values, self.flow, consumed, FLOW_KEYS)
+        if flow_ref is None:
+            raise EmptyFlowRef
+        dirn = check_direction(self._take(values, self.direction, consumed, DIRECTION_KEYS))
+        val = self._take(values, self.value, consumed, VALUE_KEYS)
+        if str(val).lower() == 'balance':
+            value = ValueIsBalance
+        else:
+            value = to_float(val)
+        unit = self._take(values, self.unit, consumed)
+        term = self._take(values, self.term, consumed)
+        if term is None:
+            cx = self._take(values, self.context, consumed)
+            if cx is not None:
+                term = (cx,)  # convert to a context
+        kwargs = {h: values[i] for h, i in self.fields if i < len(values) and i not in consumed}
+        return CatalogRef(origin, flow_ref, entity_type='flow'), dirn, value, unit, term, kwargs
+
+
+def _sheet_rows(sheetlike):
     """
-    This is the excel file parser that specifies how to create an exchange ref heuristically from a varied list of
-    potentially valid column namings.  This could be used equally well with JSON
-    :param rowdict:
-    :return:
+    Bulk read of the sheet's cell values, where the sheet supports it (get_rows() reads an openpyxl sheet in a single
+    pass); otherwise row by row.
+    :param sheetlike:
+    :return: generator of lists of values, starting with the header row
     """
-    rowdict.pop('process', None)
-    flow_ref = _popanykey(rowdict, 'flow', 'flowref', 'flow_ref', 'external_ref', strict=True)
-    if flow_ref is None:
-        raise EmptyFlowRef
-    flow = CatalogRef(origin, flow_ref, entity_type='flow')
-    dirn = check_direction(_popanykey(rowdict, 'direction', 'flowdir', strict=True))
-    val = _popanykey(rowdict, 'value', 'amount', strict=True)
-    if str(val).lower() == 'balance':
-        value = ValueIsBalance
+    if hasattr(sheetlike, 'get_rows'):
+        for r in sheetlike.get_rows():
+            yield [k.value for k in r]
     else:
-        value = to_float(val)
-    unit = _popanykey(rowdict, 'unit', 'units')
-    term = _popanykey(rowdict, 'target', 'defaultprovider', 'activitylinkid', 'term', 'termination', 'anchor_node')
-    if term is None:
-        cx = _popanykey(rowdict, 'context', 'compartment')
-        if cx is not None:
-            term = (cx,)  # convert to a context
-
-    if value is ValueIsBalance:
-        print('%s %s (balance) %s [%s]' % (flow, dirn, unit, term))
-    else:
-        print('%s %s %g %s [%s]' % (flow, dirn, value, unit, term))
-    return flow, dirn, value, unit, term
+        for i in range(sheetlike.nrows):
+            yield [k.value for k in sheetlike.row(i)]
 
 
-def exchanges_from_spreadsheet(sheetlike, term_dict=None, node=None, origin=None):
+def exchanges_from_spreadsheet(sheetlike, term_dict=None, node=None, origin=None, quiet=True):
     """
     A routine to create a list of flat exchanges (all having the same parent node) from an excel table.
 
@@ -138,6 +190,9 @@ def exchanges_from_spreadsheet(sheetlike, term_dict=None, node=None, origin=None
 
     Any remaining fields are passed to the exchange ref as initialization arguments.
 
+    The header row is read once and the column aliases are resolved to fixed positions (see ExchangeColumns); the
+    rows are read in bulk where the sheet supports it.
+
     A 'value' whose string is lowercase-equivalent to 'balance' will add balance=True to the initialization dict and
     set the value to 0.
 
@@ -146,6 +201,8 @@ def exchanges_from_spreadsheet(sheetlike, term_dict=None, node=None, origin=None
     :param node: [None] if present, use as exchange parent node for all exchanges
     :param origin: ['local.spreadsheet'] Should be provided by caller if 'node' is omitted, to give identifying 
       information to the created process
+    :param quiet: [True] log parsed exchanges and skipped rows instead of printing them; a one-line summary is logged
+     at the end.
     :return:
     """
     """
@@ -164,28 +221,50 @@ def exchanges_from_spreadsheet(sheetlike, term_dict=None, node=None, origin=None
     else:
         proc_ref = node
 
+    def _msg(level, msg):
+        if quiet:
+            logging.log(level, '%s: %s' % (sheetlike.name, msg))
+        else:
+            print(msg)
+
+    rows = _sheet_rows(sheetlike)
+    try:
+        columns = ExchangeColumns(next(rows))
+    except StopIteration:
+        return
+    if columns.missing:
+        logging.warning('%s: no column for %s; no exchanges read' % (sheetlike.name, ', '.join(columns.missing)))
+        return
+
     _yield_ref_next = True
+    count = skipped = 0
 
-    for row in range(1, sheetlike.nrows):
-        c_flow = _row_dict(sheetlike, row)
-        if len(c_flow) == 0:
+    for row, values in enumerate(rows, start=1):
+        if all(v is None or v == '' for v in values):
             continue
         try:
-            flow_ref, dirn, value, units, term = _exchange_params(origin, c_flow)
+            flow_ref, dirn, value, units, term, c_flow = columns.parse(origin, values)
         except EmptyFlowRef:
-            print('==Row %02d== SKIP empty flow ref' % (row+1))
+            _msg(logging.INFO, '==Row %02d== SKIP empty flow ref' % (row+1))
+            skipped += 1
             continue
         except KeyError as e:
-            print('==Row %02d== SKIP  missing one of %s' % (row+1, e.args))
+            _msg(logging.WARNING, '==Row %02d== SKIP  missing one of %s' % (row+1, e.args))
+            skipped += 1
             continue
         except InvalidDirection as e:
-            print('==Row %02d== SKIP  invalid direction %s' % (row+1, e.args))
+            _msg(logging.WARNING, '==Row %02d== SKIP  invalid direction %s' % (row+1, e.args))
+            skipped += 1
             continue
 
+        _msg(logging.DEBUG, _describe_exchange(flow_ref, dirn, value, units, term))
+        count += 1
+
         if _yield_ref_next:
             # ref flow is first nonempty record
             if term is not None:
-                print('Note: (%s) Reference flow cannot have specified termination: %s' % (sheetlike.name, term))
+                _msg(logging.WARNING, 'Note: (%s) Reference flow cannot have specified termination: %s' %
+                     (sheetlike.name, term))
             # reference flow is unterminated
             yield ExchangeRef(proc_ref, flow_ref, dirn, value=value, unit=units, is_reference=True, **c_flow)
             _yield_ref_next = False
@@ -196,3 +275,5 @@ def exchanges_from_spreadsheet(sheetlike, term_dict=None, node=None, origin=None
                 value = 0.0
 
             yield ExchangeRef(proc_ref, flow_ref, dirn, value=value, unit=units, termination=term, **c_flow)
+
+    logging.info('%s: %d exchanges read, %d rows skipped' % (sheetlike.name, count, skipped))
@@ -5,8 +5,10 @@ from antelope_foreground.terminations import FlowConversionError
 from .quick_and_easy import QuickAndEasy, AmbiguousResult
 from .float_conv import to_float, try_float
 from .headers import PRODUCTION_HEADER
+from ..unit_conversion import observe_converted
 import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ConsistencyError(Exception):
@@ -128,6 +130,7 @@ class ModelMaker(QuickAndEasy):
 
         self._skips = []
         self._errors = dict()
+        self._flow_summaries = dict()
 
     @property
     def skips(self):
@@ -143,11 +146,24 @@ class ModelMaker(QuickAndEasy):
     def error(self, k):
         return self._errors[k]
 
+    def flow_summary(self, sheetname):
+        """
+        Summary of the last autodetect_flows() run on the named sheet
+        :param sheetname:
+        :return: dict with lists 'new', 'renamed', 'updated', 'skipped', and counts 'rows' and 'unchanged'
+        """
+        return self._flow_summaries[sheetname]
+
     def autodetect_flows(self, sheetname, external_ref=None, ref_quantity=None, ref_unit=None, name=None,
                          context=None, entity_uuid=None, **kwargs):
         """
         Load the designated sheet. iterate through rows, using the arguments as column mappings.
 
+        The sheet is read once and reduced to one spec per distinct flow (the last row for each flow wins).  Each spec
+        is compared with the existing flow: new flows are created, and existing flows are only modified where the
+        name or a property actually differs.  Characterization caches are cleared only for renamed flows.  A summary
+        is available from flow_summary(sheetname).
+
         :param sheetname: name of the source sheet
         :param external_ref:
         :param ref_quantity:
@@ -179,8 +195,8 @@ class ModelMaker(QuickAndEasy):
         if entity_uuid:
             kwargs['entity_uuid'] = entity_uuid
 
-        count = 0
-        new = set()
+        summary = {'rows': 0, 'new': [], 'renamed': [], 'updated': [], 'unchanged': 0, 'skipped': []}
+        specs = dict()
 
         for r in range(1, sheet.nrows):
             ssr = r + 1
@@ -195,21 +211,44 @@ class ModelMaker(QuickAndEasy):
                 ref_q = self._unit_map.get(row.get(ref_unit))
                 if ref_q is None:
                     print('%s:%d Unrecognized unit %s- skipping flow %s' % (sheetname, ssr, row.get(ref_unit), ext_ref))
+                    summary['skipped'].append((ssr, ext_ref))
                     continue
             else:
                 ref_q = row.get(ref_quantity)
-            count += 1
+            summary['rows'] += 1
 
             args = {k: row.get(v) for k, v in kwargs.items() if v is not None and row.get(v) is not None}
-            if self.fg[ext_ref] is None:
-                new.add(ext_ref)
-            f = self.fg.add_or_retrieve(ext_ref, ref_q, the_name, **args)
+            specs[ext_ref] = (ref_q, the_name, args)
+
+        for ext_ref, (ref_q, the_name, args) in specs.items():
+            f = self.fg[ext_ref]
+            if f is None:
+                self.fg.add_or_retrieve(ext_ref, ref_q, the_name, **args)
+                summary['new'].append(ext_ref)
+                continue
             # update the name if it contains new information-- important for LCIA
             if the_name != f['name'] and the_name != ext_ref:
                 f['name'] = the_name
                 f.clear_chars()
-
-        print('Reviewed %d flows (%d new added)' % (count, len(new)))
+                summary['renamed'].append(ext_ref)
+            changed = False
+            for k, v in args.items():
+                try:
+                    if str(f[k]) == str(v):
+                        continue
+                except KeyError:
+                    pass
+                f[k] = v
+                changed = True
+            if changed:
+                summary['updated'].append(ext_ref)
+            elif ext_ref not in summary['renamed']:
+                summary['unchanged'] += 1
+
+        self._flow_summaries[sheetname] = summary
+        print('Reviewed %d flows in %d rows (%d new, %d renamed, %d updated, %d skipped)' % (
+            len(specs), summary['rows'], len(summary['new']), len(summary['renamed']), len(summary['updated']),
+            len(summary['skipped'])))
         return sheet
 
     def detect_spanner_flows(self, spanner_ref, **kwargs):
@@ -219,23 +258,98 @@ class ModelMaker(QuickAndEasy):
     def detect_production_flows(self, production_sheet='production', **kwargs):
         return self.autodetect_flows(production_sheet, external_ref='prod_flow', ref_unit='ref_unit', **kwargs)
 
-    def update_flows(self, sheetname='flows'):
+    @staticmethod
+    def _flow_row(f):
+        cx = f.context.name
+        if cx == 'None':
+            cx = None
+        return [f.external_ref, f.reference_entity['Name'], f['Name'], f['Comment'], cx]
+
+    def update_flows(self, sheetname='flows', incremental=True):
         """
         here we are using the same flows sheet spec as XlsxArchiveUpdater so we don't need to configure column mappings
+
+        In incremental mode (the default), the foreground's local flows are compared with the current contents of the
+        sheet, and only changed rows and new flows are written, as one range update per contiguous block of rows.
         :param sheetname:
+        :param incremental: [True] if False, rewrite the whole sheet
         :return:
         """
+        if not incremental:
+            return self._rewrite_flows(sheetname)
         sheet = self.xlsx[sheetname]
         columns = ('external_ref', 'referenceQuantity', 'Name', 'Comment', 'Compartment')
-        write = [list(columns)]
+        n = len(columns)
+
+        def _norm(_row):
+            _row = ['' if k is None else k for k in _row[:n]]
+            return _row + [''] * (n - len(_row))
+
+        changed = dict()  # sheet row index -> new row
         exis = set()
         error = 0
 
-        def _make_a_row(_f):
-            cx = _f.context.name
-            if cx == 'None':
-                cx = None
-            return [_f.external_ref, _f.reference_entity['Name'], _f['Name'], _f['Comment'], cx]
+        for i in range(1, sheet.nrows):
+            row = [k.value for k in sheet.row(i)]
+            ssr = i + 1
+            if len(row) == 0 or row[0] is None or row[0] == '':
+                continue
+            try:
+                f = self.fg.get(row[0])
+                new_row = self._flow_row(f)
+                exis.add(f.external_ref)
+            except KeyError:
+                logging.warning('unrecognized flow in existing pass (%s row %d %s)' % (sheetname, ssr, row[0]))
+                continue
+            except TypeError:
+                logging.warning('TypeError problem in existing pass (%s row %d %s)' % (sheetname, ssr, row[0]))
+                error += 1
+                continue
+            if _norm(new_row) != _norm(row):
+                changed[i] = new_row
+
+        updated = len(changed)
+        start = max(sheet.nrows, 1)
+        added = []
+        for f in self.fg.flows():
+            if f.origin != self.fg.origin:
+                continue
+            if f.external_ref in exis:
+                continue
+            try:
+                added.append(self._flow_row(f))
+            except TypeError:
+                logging.warning('TypeError problem - skipping new flow %s' % f.external_ref)
+                error += 1
+        for k, row in enumerate(added):
+            changed[start + k] = row
+        if sheet.nrows == 0:
+            changed[0] = list(columns)
+
+        blocks = 0
+        block = []
+        for i in sorted(changed.keys()):
+            if block and i != block[-1] + 1:
+                self.xlsx.write_rectangle_by_rows(sheetname, [changed[k] for k in block], start_row=block[0])
+                blocks += 1
+                block = []
+            block.append(i)
+        if block:
+            self.xlsx.write_rectangle_by_rows(sheetname, [changed[k] for k in block], start_row=block[0])
+            blocks += 1
+
+        msg = 'Updated %d existing and added %d new flows to sheet %s (%d range updates)' % (updated, len(added),
+                                                                                             sheetname, blocks)
+        if error:
+            msg += ' (%d errors)' % error
+        print(msg)
+
+    def _rewrite_flows(self, sheetname='flows'):
+        sheet = self.xlsx[sheetname]
+        columns = ('external_ref', 'referenceQuantity', 'Name', 'Comment', 'Compartment')
+        write = [list(columns)]
+        exis = set()
+        error = 0
 
         # first, existing
         for i in range(1, sheet.nrows):
@@ -246,7 +360,7 @@ class ModelMaker(QuickAndEasy):
                 continue
             try:
                 f = self.fg.get(row[0])
-                write.append(_make_a_row(f))
+                write.append(self._flow_row(f))
                 exis.add(f.external_ref)
             except KeyError:
                 logging.warning('unrecognized flow in existing pass (%s row %d %s)' % (sheetname, ssr, row[0]))
@@ -263,7 +377,7 @@ class ModelMaker(QuickAndEasy):
             if f.external_ref in exis:
                 continue
             try:
-                write.append(_make_a_row(f))
+                write.append(self._flow_row(f))
                 added += 1
             except TypeError:
                 logging.warning('TypeError problem - skipping new flow %s' % f.external_ref)
@@ -331,37 +445,97 @@ class ModelMaker(QuickAndEasy):
                 print('Warning, fragment already named %s' % frag.external_ref)
         return frag
 
-    def _find_reference_exchange(self, row):
-        # first, find termination
+    def _anchor_spec(self, row):
+        """
+        The anchor lookup specified by a production row, as a hashable tuple (origin, external_ref, process_name,
+        flow_name_or_ref, SpatialScope), or None if the row does not specify an anchored flow
+        :param row:
+        :return:
+        """
         org = row.get('target_origin') or row.get('origin')
-        if org:
-            if org == 'here':
-                origin = self.fg.origin
-            else:
-                origin = org
-
-            d = {'external_ref': row.get('target_ref') or row.get('external_ref'),
-                 'process_name': row.get('target_name'),
-                 'flow_name_or_ref': row.get('target_flow') or row.get('term_flow') or row.get('flow_name') or row.get('child_flow'),
-                 'SpatialScope': row.get('locale')}  # default to RoW
+        if not org:
+            return None
+        if org == 'here':
+            origin = self.fg.origin
+        else:
+            origin = org
+        return (origin,
+                row.get('target_ref') or row.get('external_ref'),
+                row.get('target_name'),
+                row.get('target_flow') or row.get('term_flow') or row.get('flow_name') or row.get('child_flow'),
+                row.get('locale'))  # default to RoW
+
+    def _resolve_anchor(self, spec):
+        origin, external_ref, process_name, flow_name_or_ref, locale = spec
+        d = {'external_ref': external_ref,
+             'process_name': process_name,
+             'flow_name_or_ref': flow_name_or_ref,
+             'SpatialScope': locale}
 
-            try:
+        try:
+            rx = self.find_background_rx(origin, **d)
+        except AmbiguousResult:
+            if d['SpatialScope'] is None:
+                d['SpatialScope'] = 'RoW'
                 rx = self.find_background_rx(origin, **d)
-            except AmbiguousResult:
-                if d['SpatialScope'] is None:
-                    d['SpatialScope'] = 'RoW'
-                    rx = self.find_background_rx(origin, **d)
-                else:
-                    if not d['SpatialScope'].startswith('^'):
-                        d['SpatialScope'] = '^%s$' % d['SpatialScope']
-                        try:
-                            rx = self.find_background_rx(origin, **d)
-                        except AmbiguousResult:
-                            raise AmbiguousResult(*d.values())
-                    else:
+            else:
+                if not d['SpatialScope'].startswith('^'):
+                    d['SpatialScope'] = '^%s$' % d['SpatialScope']
+                    try:
+                        rx = self.find_background_rx(origin, **d)
+                    except AmbiguousResult:
                         raise AmbiguousResult(*d.values())
-            except (KeyError, EntityNotFound):
-                raise FailedTermination(*d.values())
+                else:
+                    raise AmbiguousResult(*d.values())
+        except (KeyError, EntityNotFound):
+            raise FailedTermination(*d.values())
+        return rx
+
+    def _resolve_anchor_or_error(self, spec):
+        try:
+            return self._resolve_anchor(spec)
+        except Exception as e:
+            return e
+
+    def resolve_anchors(self, sheet, max_workers=8):
+        """
+        First phase of a concurrent production build: collect every distinct anchor lookup specified in the sheet and
+        resolve them in a bounded thread pool.  Lookups that fail are stored as their exceptions, to be raised (and
+        logged against each row that uses them) when the fragments are built.
+        :param sheet: a production sheet
+        :param max_workers: [8] size of the thread pool
+        :return: dict of anchor spec -> reference exchange or exception
+        """
+        specs = set()
+        for r in range(1, sheet.nrows):
+            row = sheet.row_dict(r)
+            if row.get('prod_flow'):
+                spec = self._anchor_spec(row)
+                if spec is not None:
+                    specs.add(spec)
+        specs = list(specs)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            resolved = dict(zip(specs, pool.map(self._resolve_anchor_or_error, specs)))
+        print('Resolved %d distinct anchors (%d errors)' % (len(resolved),
+                                                            len([v for v in resolved.values()
+                                                                 if isinstance(v, Exception)])))
+        return resolved
+
+    def _find_reference_exchange(self, row, anchors=None):
+        """
+        :param row:
+        :param anchors: [None] pre-resolved anchors from resolve_anchors()
+        :return:
+        """
+        # first, find termination
+        spec = self._anchor_spec(row)
+        if spec is not None:
+            if anchors is not None and spec in anchors:
+                rx = anchors[spec]
+                if isinstance(rx, Exception):
+                    raise rx
+            else:
+                rx = self._resolve_anchor(spec)
         else:
             if row.get('compartment'):
                 # context
@@ -372,7 +546,7 @@ class ModelMaker(QuickAndEasy):
 
         return rx
 
-    def _build_production_row(self, parent, row):
+    def _build_production_row(self, parent, row, anchors=None):
         """
         I probably should break this down a little better--- so many precedence rules + heuristics
         basically, we want to do the following:
@@ -381,10 +555,11 @@ class ModelMaker(QuickAndEasy):
 
         :param parent: parent fragment
         :param row: row_dict
+        :param anchors: [None] pre-resolved anchors from resolve_anchors()
         :return:
         """
 
-        rx = self._find_reference_exchange(row)
+        rx = self._find_reference_exchange(row, anchors=anchors)
 
         if row.get('child_flow'):
             child_flow = self.fg.get(row.get('child_flow'))
@@ -436,15 +611,15 @@ class ModelMaker(QuickAndEasy):
             except (TypeError, ValueError):
                 raise BadExchangeValue(row.get('amount'))
             try:
-                self.fg.observe(c, exchange_value=ev, units=row['units'])
+                observe_converted(self.fg, c, exchange_value=ev, units=row['units'])
             except ConversionError:
                 raise BadExchangeValue(c.flow.reference_entity, row['units'])
             if row.get('amount_lo', None) is not None:
                 ev_lo = to_float(row['amount_lo'])
-                self.fg.observe(c, exchange_value=ev_lo, units=row['units'], scenario=self.sens_lo)
+                observe_converted(self.fg, c, exchange_value=ev_lo, units=row['units'], scenario=self.sens_lo)
             if row.get('amount_lo', None) is not None:
                 ev_hi = to_float(row['amount_hi'])
-                self.fg.observe(c, exchange_value=ev_hi, units=row['units'], scenario=self.sens_hi)
+                observe_converted(self.fg, c, exchange_value=ev_hi, units=row['units'], scenario=self.sens_hi)
         """
         Logic here:
         if descend is specified, set it
@@ -515,13 +690,13 @@ class ModelMaker(QuickAndEasy):
                     continue
                 ru = row.get('ref_unit')
                 try:
-                    self.fg.observe(ref, exchange_value=rv, units=ru)
+                    observe_converted(self.fg, ref, exchange_value=rv, units=ru)
                 except ConversionError:
                     print('%d: Skipping bad unit conversion specification %s [%s]' % (ssr, ru,
                                                                                       ref.flow.reference_entity))
         return len(refs)
 
-    def _make_production_childflows(self, sheet, prefix=None):
+    def _make_production_childflows(self, sheet, prefix=None, anchors=None):
         count = 0
         for r in range(1, sheet.nrows):
             ssr = r + 1
@@ -529,7 +704,7 @@ class ModelMaker(QuickAndEasy):
             if row.get('prod_flow'):
                 try:
                     parent = self.create_or_retrieve_reference(row['prod_flow'], prefix=prefix)
-                    c = self._build_production_row(parent, row)
+                    c = self._build_production_row(parent, row, anchors=anchors)
                     c['_%s_row' % (prefix or sheet.name)] = ssr
                     print('== %03d ==: %s' % (ssr, c))
                     count += 1
@@ -562,7 +737,7 @@ class ModelMaker(QuickAndEasy):
                     print('## %03d ##: flow-conversion termination error %s' % (ssr, e.args))
         return count
 
-    def make_production(self, sheetname='production', prefix='prod', taps=None, detect_flows=True):
+    def make_production(self, sheetname='production', prefix='prod', taps=None, detect_flows=True, max_workers=None):
         """
         Strategy here:
 
@@ -574,6 +749,8 @@ class ModelMaker(QuickAndEasy):
         :param sheetname: default 'production'
         :param prefix: prepend to flow_ref to get frag_ref
         :param taps: [None] if present, load taps from, named sheet after creating references but before child flows
+        :param max_workers: [None] if given, resolve all distinct anchors concurrently with a thread pool of this size
+         before building child flows in series.  Otherwise anchors are resolved row by row.
         :return:
         """
         if self.xlsx is None:
@@ -590,8 +767,13 @@ class ModelMaker(QuickAndEasy):
         if taps:
             self.load_taps_from_spreadsheet(taps)
 
+        if max_workers:
+            anchors = self.resolve_anchors(sheet, max_workers=max_workers)
+        else:
+            anchors = None
+
         # second pass: create child flows
-        count = self._make_production_childflows(sheet, prefix)
+        count = self._make_production_childflows(sheet, prefix, anchors=anchors)
         print('Created %d reference flows with %d child flows (%d errors)' % (refs, count, len(self._errors)))
 
     def make_production_row(self, ssr, sheetname='production', prefix='prod'):
@@ -615,7 +797,7 @@ class ModelMaker(QuickAndEasy):
         parent = self.create_or_retrieve_reference(row['prod_flow'], direction=dirn, prefix=prefix)
         rv = try_float(row['ref_value'])
         ru = row.get('ref_unit')
-        self.fg.observe(parent, exchange_value=rv, units=ru)
+        observe_converted(self.fg, parent, exchange_value=rv, units=ru)
 
         # build child
         c = self._build_production_row(parent, row)
@@ -703,7 +885,7 @@ class ModelMaker(QuickAndEasy):
                 self.fg.delete_fragment(cf)
             output = self.fg.new_fragment(prod, 'Output', parent=beta, name='Displaced %s' % prod.name)
 
-        self.fg.observe(output, 1.0, units=row_dict['dp_refunit'])
+        observe_converted(self.fg, output, exchange_value=1.0, units=row_dict['dp_refunit'])
         return output
 
     def _check_transport_link(self, node, target, distance_km, scenario=None, stage_name='Transport'):
@@ -773,7 +955,7 @@ class ModelMaker(QuickAndEasy):
             node = self.fg.new_fragment(td, 'Input', Name=name, external_ref=ext_ref, StageName='Disposition')
         else:
             node.flow = td  # just to ensure
-        self.fg.observe(node, exchange_value=1.0, units=product_refunit)
+        observe_converted(self.fg, node, exchange_value=1.0, units=product_refunit)
         node['note'] = row.get('note')
 
         if row.get('md_truck'):
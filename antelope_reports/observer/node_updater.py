@@ -2,8 +2,13 @@
 The Upgrade Manager is a bit too heavy-handed and it violates some good design principles.
 
 This tool is meant to perform an update of a single node in a few different ways.
+
+When many nodes are upgraded against the same target, pass indexed=True: the strategies then look up candidates in
+a TargetIndex built once per target origin, instead of querying the target for each node.
 """
-from antelope import enum, MultipleReferences, NoReference  # is this *always* an interactive tool?
+from collections import defaultdict
+
+from antelope import enum, comp_dir, MultipleReferences, NoReference  # is this *always* an interactive tool?
 
 
 class NodeUpgraderException(Exception):
@@ -22,6 +27,78 @@ class TooManyCandidates(NodeUpgraderException):
 nonregexp = str.maketrans('()[]\\/*', '.......')
 
 
+def _norm(name):
+    return str(name).strip().lower()
+
+
+class TargetIndex(object):
+    """
+    An in-memory index of the processes in a target query: normalized name -> processes, (normalized name,
+    spatialscope) -> processes, and reference flow -> (reference direction, process).  Names are compared exactly
+    (case-insensitive) rather than by regex.  The name indexes are built with a single processes() scan; the reference
+    flow index is built on first use, since it requires each process's references.
+    """
+    def __init__(self, query):
+        self._q = query
+        self._by_name = defaultdict(list)
+        self._by_name_scope = defaultdict(list)
+        self._by_ref_flow = None
+        self._processes = list(query.processes())
+        for p in self._processes:
+            n = _norm(p['name'])
+            self._by_name[n].append(p)
+            self._by_name_scope[n, p['spatialscope']].append(p)
+
+    def __len__(self):
+        return len(self._processes)
+
+    def _build_ref_flows(self):
+        self._by_ref_flow = defaultdict(list)
+        for p in self._processes:
+            try:
+                for rx in p.references():
+                    self._by_ref_flow[rx.flow.external_ref].append((rx.direction, p))
+            except NoReference:
+                continue
+
+    def processes_by_name(self, name):
+        return list(self._by_name.get(_norm(name), []))
+
+    def processes_by_name_and_spatial_scope(self, name, spatialscope):
+        return list(self._by_name_scope.get((_norm(name), spatialscope), []))
+
+    def targets(self, flow_ref, direction=None):
+        """
+        Same semantics as query.targets(): processes with a reference exchange of the flow, in the direction
+        complementary to the one given
+        :param flow_ref: flow or external_ref
+        :param direction: [None]
+        :return:
+        """
+        if self._by_ref_flow is None:
+            self._build_ref_flows()
+        flow_ref = getattr(flow_ref, 'external_ref', flow_ref)
+        if direction is None:
+            return [p for d, p in self._by_ref_flow.get(flow_ref, [])]
+        cdir = comp_dir(direction)
+        return [p for d, p in self._by_ref_flow.get(flow_ref, []) if d == cdir]
+
+
+_target_indexes = dict()
+
+
+def target_index(query, refresh=False):
+    """
+    The TargetIndex for a query, built once per origin
+    :param query:
+    :param refresh: [False] rebuild the index
+    :return:
+    """
+    if refresh or query.origin not in _target_indexes:
+        _target_indexes[query.origin] = TargetIndex(query)
+    return _target_indexes[query.origin]
+
+
 class NodeUpdater:
     _strategy = 'match_name_and_spatial_scope'
 
@@ -45,15 +122,22 @@ class NodeUpdater:
             else:
                 print('ignoring unrecognized strategy "%s"' % value)
 
-    def __init__(self, branch, query, strategy=None):
+    def __init__(self, branch, query, strategy=None, indexed=False):
         """
         This accepts a single FragmentBranch, which includes a node (FragmentRef) and an anchor (Anchor), with
         a scenario name.  This branch is SUPPOSED to represent an existing termination.
         :param branch:
         :param query: used to obtain upgrade targets
+        :param indexed: [False] look up candidates in the query's TargetIndex (or pass a TargetIndex)
         """
         self._branch = branch
         self._q = query
+        if isinstance(indexed, TargetIndex):
+            self._index = indexed
+        elif indexed:
+            self._index = target_index(query)
+        else:
+            self._index = None
         self.strategy = strategy
         self._candidates = self._exception = self._rx = self._rxs = None
 
@@ -69,6 +153,8 @@ class NodeUpdater:
         Match the name of the current anchor
         :return:
         """
+        if self._index is not None:
+            return self._index.processes_by_name(self.current.anchor.term_node['name'])
         name = '^%s$' % self.current.anchor.term_node['name'].translate(nonregexp)
         return self._q.processes(name='^%s$' % name)
 
@@ -77,6 +163,9 @@ class NodeUpdater:
         Match the name and spatial scope of the current anchor
         :return:
         """
+        if self._index is not None:
+            return self._index.processes_by_name_and_spatial_scope(self.current.anchor.term_node['name'],
+                                                                   self.current.anchor.term_node['spatialscope'])
         name = '^%s$' % self.current.anchor.term_node['name'].translate(nonregexp)
         return self._q.processes(name='^%s$' % name,
                                  spatialscope='^%s$' % self.current.anchor.term_node['spatialscope'])
@@ -93,6 +182,9 @@ class NodeUpdater:
         Retrieve targets that match the current anchor (flow and direction)
         :return:
         """
+        if self._index is not None:
+            return self._index.targets(self.current.anchor.term_flow.external_ref,
+                                       direction=self.current.node.direction)
         return self._q.targets(self.current.anchor.term_flow.external_ref, direction=self.current.node.direction)
 
     def targets_match_spatial_scope(self):
@@ -100,15 +192,15 @@ class NodeUpdater:
         Retrieve targets that match the current anchor (flow and direction), filter by current anchor's spatial scope
         :return:
         """
-        return filter(lambda x: x['spatialscope'] == self.current.anchor.term_node['spatialscope'],
-                      self._q.targets(self.current.anchor.term_flow.external_ref, direction=self.current.node.direction)
-                      )
+        return filter(lambda x: x['spatialscope'] == self.current.anchor.term_node['spatialscope'], self.targets())
 
     def node_targets(self):
         """
         Retrieve targets that match the current node (flow, disregarding direction)
         :return:
         """
+        if self._index is not None:
+            return self._index.targets(self.current.node.flow)
         return self._q.targets(self.current.node.flow)
 
     def _run_attempt(self, strategy):
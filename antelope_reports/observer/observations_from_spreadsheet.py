@@ -14,7 +14,9 @@ Arguments:
  parameter - new exchange value
  units - units for exchange value
 
-"activity" must refer to a fragment, and is required.
+"activity" must refer to a fragment, and is required.  Child flows are found from an index of (activity, flow) ->
+child fragments, built once for all the activities named in the sheet.  Observations are applied in sheet order, since
+a row may depend on the state left by an earlier row (e.g. an unspecified descend is taken from the current anchor).
 If "child_flow" is omitted, the observation will be applied to the named activity.
 If "scenario" is omitted, the observation will be applied to the default scenario.
 
@@ -23,7 +25,14 @@ special semantics:
 If "child_flow" is "*" and the "descend" specification is not None, then the specification is applied to all child flows
 
 """
+from collections import defaultdict
+
 from .float_conv import to_float
+from ..unit_conversion import observe_converted
+
+
+class AnchorNotFound(Exception):
+    pass
 
 
 def _cutoff(anc):
@@ -68,6 +77,8 @@ class ObservationsFromSpreadsheet(object):
         self.fg = fg
         self.sheet = sheet
         self.quiet = quiet
+        self._index = dict()
+        self.summary = None
 
     def _handle_anchor(self, ssr, obj, row):
         # anchor
@@ -89,8 +100,7 @@ class ObservationsFromSpreadsheet(object):
             else:
                 anchor = self.fg[anc]
                 if anchor is None:
-                    self._errmesg(ssr, 'Anchor %s not found' % anc)
-                    return
+                    raise AnchorNotFound(anc)
             for o in obj:
                 o.clear_termination(scenario=sc)
                 if desc is None:
@@ -120,43 +130,125 @@ class ObservationsFromSpreadsheet(object):
         if ev is not None:
             ev = to_float(ev)
             for o in obj:
-                self.fg.observe(o, scenario=sc, exchange_value=ev, units=units)
+                observe_converted(self.fg, o, scenario=sc, exchange_value=ev, units=units)
                 mesg = 'observing %g' % ev
                 if units is not None:
                     mesg += ' %s' % units
                 self._mesg(o, sc, mesg)
 
-    def apply(self):
+    @staticmethod
+    def _flow_key(flow):
+        return flow.link
+
+    def _index_activity(self, act):
+        """
+        One depth-first traversal of the activity's child flows, in the same order as children_with_flow(recurse=True)
+        :param act:
+        :return: dict of flow key -> list of child fragments
+        """
+        idx = defaultdict(list)
+        stack = list(reversed(list(act.child_flows)))
+        while stack:
+            k = stack.pop()
+            idx[self._flow_key(k.flow)].append(k)
+            stack.extend(reversed(list(k.child_flows)))
+        return dict(idx)
+
+    def _read_rows(self):
         for i in range(1, self.sheet.nrows):
-            ssr = i + 1
-            row = self.sheet.row_dict(i)
+            yield i + 1, self.sheet.row_dict(i)
+
+    def build_index(self, rows):
+        """
+        Retrieve each activity named in the rows once, and index its child flows by flow
+        :param rows: iterable of (ssr, row_dict)
+        :return:
+        """
+        for ssr, row in rows:
+            a = row.get('activity')
+            if a is None or a in self._index:
+                continue
+            act = self.fg[a]
+            if act is None:
+                self._index[a] = None
+            else:
+                self._index[a] = (act, self._index_activity(act))
+
+    def _find_objects(self, ssr, row):
+        """
+        :param ssr:
+        :param row:
+        :return: list of fragments to which the row applies, or a string giving the reason the row is skipped
+        """
+        entry = self._index.get(row['activity'])
+        if entry is None:
+            return 'Activity %s not found' % row['activity']
+        act, idx = entry
+        if row.get('child_flow'):
+            if row['child_flow'] == '*':
+                obj = [cf for cf in act.child_flows]
+                p = row.pop('parameter', None)
+                a = row.pop('anchor', None)
+                if p or a:
+                    self._errmesg(ssr, 'ignoring specs for descend special "*"')
+            else:
+                cf = self.fg[row['child_flow']]
+                if cf is None:
+                    return 'Child flow %s not found' % row['child_flow']
+                if cf.entity_type == 'flow':
+                    obj = list(idx.get(self._flow_key(cf), []))
+                else:
+                    obj = [cf]
+        else:
+            obj = [act]
+        return obj
+
+    def apply(self, rebuild=True):
+        """
+        Apply every observation in the sheet, in sheet order.
+        :param rebuild: [True] re-index the activities first (they may have changed since the last call)
+        :return: a summary dict with lists 'applied': (ssr, scenario, n_fragments), 'skipped': (ssr, reason), and
+         'failed': (ssr, exception); and 'by_scenario': {scenario: [ssr of applied rows]}
+        """
+        rows = [(ssr, row) for ssr, row in self._read_rows()]
+        if rebuild:
+            self._index = dict()
+        self.build_index(rows)
+
+        summary = {'applied': [], 'skipped': [], 'failed': []}
+        by_scenario = defaultdict(list)
+        for ssr, row in rows:
             if row.get('activity') is None:
                 self._errmesg(ssr, 'Skipping blank row')
+                summary['skipped'].append((ssr, 'blank row'))
                 continue
-            act = self.fg[row['activity']]
-            if act is None:
-                self._errmesg(ssr, 'Activity %s not found' % row['activity'])
+            obj = self._find_objects(ssr, row)
+            if isinstance(obj, str):
+                self._errmesg(ssr, obj)
+                summary['skipped'].append((ssr, obj))
                 continue
-            if row.get('child_flow'):
-                if row['child_flow'] == '*':
-                    obj = [cf for cf in act.child_flows]
-                    p = row.pop('parameter', None)
-                    a = row.pop('anchor', None)
-                    if p or a:
-                        self._errmesg(ssr, 'ignoring specs for descend special "*"')
-                else:
-                    cf = self.fg[row['child_flow']]
-                    if cf is None:
-                        self._errmesg(ssr, 'Child flow %s not found' % row['child_flow'])
-                        continue
-                    if cf.entity_type == 'flow':
-                        obj = list(act.children_with_flow(cf, recurse=True))
-                    else:
-                        obj = [cf]
-            else:
-                obj = [act]
-            self._handle_anchor(ssr, obj, row)
-            self._handle_ev(obj, row)
+            sc = row.get('scenario')
+            try:
+                self._handle_anchor(ssr, obj, row)
+                self._handle_ev(obj, row)
+            except AnchorNotFound as e:
+                self._errmesg(ssr, 'Anchor %s not found' % e.args[0])
+                summary['failed'].append((ssr, e))
+                continue
+            except Exception as e:
+                self._errmesg(ssr, '%s %s' % (e.__class__.__name__, e.args))
+                summary['failed'].append((ssr, e))
+                continue
+            summary['applied'].append((ssr, sc, len(obj)))
+            by_scenario[sc].append(ssr)
+
+        summary['by_scenario'] = dict(by_scenario)
+        self.summary = summary
+        print('OBS: %d observations applied in %d scenarios; %d skipped; %d failed' % (len(summary['applied']),
+                                                                                      len(by_scenario),
+                                                                                      len(summary['skipped']),
+                                                                                      len(summary['failed'])))
+        return summary
 
     def __enter__(self):
         return self
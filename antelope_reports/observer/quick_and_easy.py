@@ -7,9 +7,14 @@ from antelope import EntityNotFound, e_, MultipleReferences  # e_ = interactive
 from .observations_from_spreadsheet import ObservationsFromSpreadsheet
 
 from .exchanges_from_spreadsheet import exchanges_from_spreadsheet
+from ..unit_conversion import observe_converted
+from ..util import atomic_write
 
 import re
+import os
+import json
 import logging
+import threading
 from collections import defaultdict
 
 tr = str.maketrans(' ', '_', ',[]()*&^%$#@/\\')
@@ -90,6 +95,7 @@ class QuickAndEasy(object):
      - xlsx - a spreadsheet conforming with the antelope_core.archives.xlsx_updater.XlsxUpdater spec
      - terms - a dictionary of keywords to pre-defined anchors that are used in the model
      - find_background_rx() - a heuristic pathway to convert an open-ended anchor specification into a reference flow
+       (results are memoized; see clear_resolution_cache(), save_resolution_cache(), load_resolution_cache())
      - new_link() - a function to create a new link in a fragment tree
      - to_background() - a utility function that finds an anchor for a fragment link (invokes find_background_rx())
      - add_tap() - a fundamental feature that converts a background exchange into an observable foreground exchange
@@ -172,7 +178,7 @@ class QuickAndEasy(object):
         for u in quantity['unitconversion'].keys():
             self._unit_map[u] = quantity.external_ref
 
-    def __init__(self, fg, terms=None, xlsx=None, quiet=True, taps=None):
+    def __init__(self, fg, terms=None, xlsx=None, quiet=True, taps=None, resolution_cache=None):
         """
         A quick-and-easy model builder.  Pass in a foreground to work with, a dictionary of terms mapping nickname to
         origin + external ref, and an optional XlrdLike spreadsheet
@@ -181,7 +187,7 @@ class QuickAndEasy(object):
         :param xlsx:
         :param quiet: passed to fg archive builder
         :param taps: name of spreadsheet containing flow taps (flow origin + ref tapped to target origin + ref)
-        :param
+        :param resolution_cache: [None] JSON file of anchor and flow resolutions saved from a previous session
         """
         self._fg = fg
         self._terms = {}
@@ -191,6 +197,15 @@ class QuickAndEasy(object):
         self._unit_map = dict()
         self._populate_unit_map()
         self._taps = defaultdict(dict)
+        self._tap_vectors = dict()
+
+        self._rx_cache = dict()
+        self._flow_cache = dict()
+        self._saved_rx = dict()
+        self._saved_flows = dict()
+        self._cache_lock = threading.Lock()  # resolutions may be requested from a thread pool
+        if resolution_cache and os.path.exists(resolution_cache):
+            self.load_resolution_cache(resolution_cache)
 
         if xlsx:
             self.xlsx = xlsx
@@ -254,7 +269,116 @@ class QuickAndEasy(object):
     def terms(self, term):
         return self._terms[term]
 
+    '''
+    Resolution cache
+    The heuristic lookups in find_background_rx() and get_flow_by_name_or_ref() are memoized by their arguments.
+    Failed lookups are not cached, and neither are lookups in the foreground's own origin, whose fragments and flows
+    change as the model is built.  Resolutions can be saved to a JSON file as (origin, external_ref) pairs and loaded
+    in a later session, where they are retrieved directly instead of being searched for again.
+    '''
+    @staticmethod
+    def _rx_key(origin, external_ref, process_name, flow_name_or_ref, strict, kwargs):
+        return (origin, external_ref, process_name, flow_name_or_ref, bool(strict),
+                tuple(sorted((k, v) for k, v in kwargs.items() if v is not None)))
+
+    def _memoized(self, origin):
+        return origin != self.fg.origin
+
+    def clear_resolution_cache(self, origin=None):
+        """
+        Discard memoized resolutions (including any loaded from file), either for one origin or for all
+        :param origin: [None]
+        :return:
+        """
+        with self._cache_lock:
+            for cache in (self._rx_cache, self._flow_cache, self._saved_rx, self._saved_flows):
+                if origin is None:
+                    cache.clear()
+                else:
+                    for k in [k for k in cache.keys() if k[0] == origin]:
+                        cache.pop(k)
+
+    @property
+    def resolution_cache_size(self):
+        return len(self._rx_cache) + len(self._flow_cache)
+
+    def save_resolution_cache(self, filename):
+        """
+        Write memoized resolutions to a JSON file (atomically).  Resolutions loaded from file and not used in this
+        session are retained.
+        :param filename:
+        :return:
+        """
+        with self._cache_lock:
+            rxs = dict(self._saved_rx)
+            rx_cache = dict(self._rx_cache)
+            flows = dict(self._saved_flows)
+            flow_cache = dict(self._flow_cache)
+        for k, rx in rx_cache.items():
+            term = getattr(rx, 'process', None)
+            if term is None:
+                continue
+            rxs[k] = (term.origin, term.external_ref, rx.flow.external_ref)
+        for k, f in flow_cache.items():
+            flows[k] = (f.origin, f.external_ref)
+        j = {'anchors': [[list(k[:5]) + [[list(kv) for kv in k[5]]], list(v)] for k, v in rxs.items()],
+             'flows': [[list(k), list(v)] for k, v in flows.items()]}
+        atomic_write(filename, lambda fp: json.dump(j, fp, indent=2))
+        print('Saved %d anchor and %d flow resolutions to %s' % (len(rxs), len(flows), filename))
+
+    def load_resolution_cache(self, filename):
+        with open(filename) as fp:
+            j = json.load(fp)
+        for k, v in j.get('anchors', []):
+            key = tuple(k[:5]) + (tuple(tuple(kv) for kv in k[5]), )
+            self._saved_rx[key] = tuple(v)
+        for k, v in j.get('flows', []):
+            self._saved_flows[tuple(k)] = tuple(v)
+        print('Loaded %d anchor and %d flow resolutions from %s' % (len(self._saved_rx), len(self._saved_flows),
+                                                                    filename))
+
+    def _retrieve_saved_rx(self, key):
+        with self._cache_lock:
+            saved = self._saved_rx.pop(key, None)
+        if saved is None:
+            return None
+        try:
+            origin, term_ref, flow_ref = saved
+            term = self.fg.cascade(origin).get(term_ref)
+            try:
+                return term.reference()
+            except MultipleReferences:
+                return term.reference(flow_ref)
+        except Exception as e:
+            logging.info('saved resolution %s failed (%s); resolving again' % (key, e))
+            return None
+
+    def _retrieve_saved_flow(self, key):
+        with self._cache_lock:
+            saved = self._saved_flows.pop(key, None)
+        if saved is None:
+            return None
+        try:
+            origin, flow_ref = saved
+            return self.fg.cascade(origin).get(flow_ref)
+        except Exception as e:
+            logging.info('saved flow %s failed (%s); resolving again' % (key, e))
+            return None
+
     def get_flow_by_name_or_ref(self, origin, flow_name_or_ref, strict=True):
+        if not self._memoized(origin):
+            return self._get_flow_by_name_or_ref(origin, flow_name_or_ref, strict=strict)
+        key = (origin, flow_name_or_ref, bool(strict))
+        if key in self._flow_cache:
+            return self._flow_cache[key]
+        flow = self._retrieve_saved_flow(key)
+        if flow is None:
+            flow = self._get_flow_by_name_or_ref(origin, flow_name_or_ref, strict=strict)
+        with self._cache_lock:
+            self._flow_cache[key] = flow
+        return flow
+
+    def _get_flow_by_name_or_ref(self, origin, flow_name_or_ref, strict=True):
         query = self.fg.cascade(origin)
         try:
             flow = query.get(flow_name_or_ref)
@@ -267,6 +391,25 @@ class QuickAndEasy(object):
     def find_background_rx(self, origin, external_ref=None, process_name=None, flow_name_or_ref=None, strict=True,
                            **kwargs):
         """
+        Memoized, except in the foreground's own origin; see _find_background_rx() for the heuristic.
+        """
+        if not self._memoized(origin):
+            return self._find_background_rx(origin, external_ref=external_ref, process_name=process_name,
+                                            flow_name_or_ref=flow_name_or_ref, strict=strict, **kwargs)
+        key = self._rx_key(origin, external_ref, process_name, flow_name_or_ref, strict, kwargs)
+        if key in self._rx_cache:
+            return self._rx_cache[key]
+        rx = self._retrieve_saved_rx(key)
+        if rx is None:
+            rx = self._find_background_rx(origin, external_ref=external_ref, process_name=process_name,
+                                          flow_name_or_ref=flow_name_or_ref, strict=strict, **kwargs)
+        with self._cache_lock:
+            self._rx_cache[key] = rx
+        return rx
+
+    def _find_background_rx(self, origin, external_ref=None, process_name=None, flow_name_or_ref=None, strict=True,
+                            **kwargs):
+        """
         The purpose of this is to retrieve a unique termination from a user specification. 
         Order of preference here is as follows:
         if external_ref is supplied, just get the straight catalog ref: origin + external_ref
@@ -380,7 +523,7 @@ class QuickAndEasy(object):
             external_ref = external_ref or auto_name
 
             frag = self._new_reference_fragment(flow, direction, external_ref)
-            self.fg.observe(frag, exchange_value=amount, units=units)
+            observe_converted(self.fg, frag, exchange_value=amount, units=units)
         else:
             if direction == 'balance':
                 balance = True
@@ -389,7 +532,7 @@ class QuickAndEasy(object):
                 frag = self.fg.new_fragment(flow, direction, parent=parent, balance=True)
             else:
                 frag = self.fg.new_fragment(flow, direction, value=1.0, parent=parent, external_ref=external_ref)
-                self.fg.observe(frag, exchange_value=amount, units=units)
+                observe_converted(self.fg, frag, exchange_value=amount, units=units)
 
         if stage:
             frag['StageName'] = stage
@@ -437,6 +580,54 @@ class QuickAndEasy(object):
             z.terminate(NullContext)  # truncates
     '''
 
+    '''
+    Tap vectors
+    Computing a tap requires the exchange relation between the anchor's reference flow and the tapped flow, and the
+    anchor's reference value.  Rather than querying these separately for every tap on every parent, the anchor's
+    entire inventory is retrieved once and stored as a vector of {(flow_ref, direction): value}, from which every tap
+    value on that anchor is computed.
+    '''
+    @staticmethod
+    def _anchor_key(t):
+        return t.term_node.link, getattr(t.term_flow, 'external_ref', t.term_flow)
+
+    def _tap_vector(self, t):
+        """
+        :param t: a termination with a process anchor
+        :return: (dict of (flow_ref, direction) -> normalized exchange value, reference value), or None if the anchor's
+         inventory cannot be retrieved
+        """
+        key = self._anchor_key(t)
+        if key not in self._tap_vectors:
+            try:
+                vec = defaultdict(float)
+                for x in t.term_node.inventory(t.term_flow):
+                    vec[x.flow.external_ref, x.direction] += x.value
+                self._tap_vectors[key] = dict(vec), t.term_node.reference_value(t.term_flow)
+            except Exception as e:
+                logging.info('no tap vector for %s (%s); using exchange relations' % (t.term_node, e))
+                self._tap_vectors[key] = None
+        return self._tap_vectors[key]
+
+    def _tap_exchange_relation(self, t, child_flow, direction):
+        vec = self._tap_vector(t)
+        if vec is None:
+            return t.term_node.exchange_relation(t.term_flow, child_flow, direction)
+        return vec[0].get((child_flow.external_ref, direction), 0.0)
+
+    def _tap_reference_value(self, t):
+        vec = self._tap_vector(t)
+        if vec is None:
+            return t.term_node.reference_value(t.term_flow)
+        return vec[1]
+
+    def clear_tap_vectors(self):
+        """
+        Discard stored anchor inventories, e.g. after the background data have changed
+        :return:
+        """
+        self._tap_vectors = dict()
+
     def add_tap(self, parent, tap_spec: TapSpec, scenario=None,
                 include_zero=False, invert_direction=None, **kwargs):
         """
@@ -457,6 +648,9 @@ class QuickAndEasy(object):
         by specifying invert_direction=True or False explicitly.  NOTE: this is reinforfced by treatment in the
         TarjanBackground - which reverses the directions of dependencies in the same condition.
 
+        Exchange relations and reference values are taken from the anchor's tap vector (see _tap_vector()), which is
+        retrieved once per anchor.
+
         2a- this deals with the case of dependencies *from* [ecoinvent-style] treatment processes
         (negative reference value) but it doesn't help in the case where the dependency *itself* is negative-valued.
         This can't be detected automatically- so when adding taps in the ecoinvent-style, the direction of the
@@ -491,11 +685,11 @@ class QuickAndEasy(object):
         else:
             ev_units = None
             if _is_ecoinvent:
-                ev = t.term_node.exchange_relation(t.term_flow, tap_spec.child_flow, 'Input')
+                ev = self._tap_exchange_relation(t, tap_spec.child_flow, 'Input')
                 if tap_spec.child_direction == 'Output':
                     ev *= -1
             else:
-                ev = t.term_node.exchange_relation(t.term_flow, tap_spec.child_flow, tap_spec.child_direction)
+                ev = self._tap_exchange_relation(t, tap_spec.child_flow, tap_spec.child_direction)
             if tap_spec.scale_value:
                 ev *= tap_spec.scale_value
 
@@ -510,7 +704,7 @@ class QuickAndEasy(object):
         elif invert_direction is False:
             tgt_dir = tap_spec.child_direction
         else:
-            rv = t.term_node.reference_value(t.term_flow)
+            rv = self._tap_reference_value(t)
             if rv < 0:
                 print('Changing direction for inverted reference activity')
                 tgt_dir = comp_dir(tap_spec.child_direction)
@@ -521,7 +715,7 @@ class QuickAndEasy(object):
             c = next(parent.children_with_flow(tap_spec.child_flow, direction=tgt_dir))
         except StopIteration:
             c = self.fg.new_fragment(tap_spec.child_flow, tgt_dir, parent=parent, **kwargs)
-        self.fg.observe(c, exchange_value=ev, scenario=scenario, units=ev_units)
+        observe_converted(self.fg, c, exchange_value=ev, scenario=scenario, units=ev_units)
         if tap_spec.target is not None:
             if tap_spec.target is True:
                 c.terminate(NullContext)
@@ -540,6 +734,36 @@ class QuickAndEasy(object):
         for tap_spec in self._taps[recipe].values():
             self.add_tap(node, tap_spec, include_zero=False)
 
+    def apply_tap_recipes_batch(self, nodes, recipe=True, scenario=None):
+        """
+        Apply a tap recipe to many nodes.  The nodes are grouped by anchor, and each anchor's tap vector is retrieved
+        once for its whole group before the taps are added.
+        :param nodes: iterable of fragments
+        :param recipe: [True] the default recipe
+        :param scenario: [None]
+        :return: dict of node -> list of created or updated child flows
+        """
+        groups = defaultdict(list)
+        for node in nodes:
+            parent = node
+            if parent.termination(scenario).is_fg and parent.balance_flow:
+                parent = parent.balance_flow
+            t = parent.termination(scenario)
+            if t.is_null or t.is_context:
+                print('%s: no anchor; skipping' % node)
+                continue
+            groups[self._anchor_key(t)].append((node, t))
+
+        results = dict()
+        for key, members in groups.items():
+            self._tap_vector(members[0][1])
+            for node, _ in members:
+                cs = [self.add_tap(node, tap_spec, scenario=scenario, include_zero=False)
+                      for tap_spec in self._taps[recipe].values()]
+                results[node] = [c for c in cs if c is not None]
+        print('Applied %d taps to %d nodes over %d anchors' % (len(self._taps[recipe]), len(results), len(groups)))
+        return results
+
     def store_tap_recipe(self, recipe, tap_spec):
         if recipe is None:
             recipe = True
@@ -627,4 +851,4 @@ class QuickAndEasy(object):
     def apply_observations(self, sheetname='observations'):
         scs = self.xlsx[sheetname]
         with ObservationsFromSpreadsheet(self.fg, scs) as obs:
-            obs.apply()
+            return obs.apply()
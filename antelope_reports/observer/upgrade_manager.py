@@ -7,7 +7,14 @@ We can imagine a number of different use cases:
  - ecoinvent-TO-other: requires a mapping service (this is actually qdb, I think)
 
 for now we will use subclassing
+
+For large foregrounds, run_batch() runs the strategies non-interactively over all pending nodes, applies every
+unambiguous match, and leaves the ambiguous remainder in review_table() for review().
 """
+from concurrent.futures import ThreadPoolExecutor
+
+from pandas import DataFrame
+
 from antelope import e_, MultipleReferences, NoReference  # e_ = interactive list-select input
 from antelope_foreground.models import Anchor
 
@@ -63,6 +70,8 @@ class UpgradeManager(object):
         self._exception = None
         self._completed = [False] * len(self._nodes)
         self._error = [None] * len(self._nodes)
+        self._ambiguous = dict()  # node index -> (strategy, candidates), populated by run_batch()
+        self._strategy_errors = dict()  # node index -> [(strategy, exception)], populated by run_batch()
 
         self.strategy = strategy
 
@@ -165,42 +174,69 @@ class UpgradeManager(object):
 
     """
     different upgrade strategies
+    each one operates on the current node, or on the node supplied as an argument
     """
-    def match_name(self):
+    def match_name(self, node=None):
         """
         Match the name of the current anchor
         :return:
         """
-        return self._q.processes(name='^%s$' % self.current.anchor.term_node['name'])
+        node = node or self.current
+        return self._q.processes(name='^%s$' % node.anchor.term_node['name'])
 
-    def match_name_and_spatial_scope(self):
+    def match_name_and_spatial_scope(self, node=None):
         """
         Match the name and spatial scope of the current anchor
         :return:
         """
-        return self._q.processes(name='^%s$' % self.current.anchor.term_node['name'],
-                                 spatialscope='^%s$' % self.current.anchor.term_node['spatialscope'])
+        node = node or self.current
+        return self._q.processes(name='^%s$' % node.anchor.term_node['name'],
+                                 spatialscope='^%s$' % node.anchor.term_node['spatialscope'])
 
-    def same_id(self):
+    def same_id(self, node=None):
         """
         Retrieve the process with the same external_ref from a different query
         :return:
         """
-        return [self._q.get(self.current.anchor.term_node.external_ref)]
+        node = node or self.current
+        return [self._q.get(node.anchor.term_node.external_ref)]
 
-    def targets(self):
+    def targets(self, node=None):
         """
         Retrieve targets that match the current anchor (flow and direction)
         :return:
         """
-        return self._q.targets(self.current.anchor.term_flow, direction=self.current.anchor.direction)
+        node = node or self.current
+        return self._q.targets(node.anchor.term_flow, direction=node.anchor.direction)
 
-    def node_targets(self):
+    def node_targets(self, node=None):
         """
         Retrieve targets that match the current node (flow, disregarding direction)
         :return:
         """
-        return self._q.targets(self.current.node.flow)
+        node = node or self.current
+        return self._q.targets(node.node.flow)
+
+    def _strategy_key(self, strategy, x):
+        """
+        Nodes whose strategy queries have the same key get the same candidates, so each query is only run once in
+        batch mode.  Strategies not known here are keyed by node.
+        :param strategy:
+        :param x: node index
+        :return:
+        """
+        anchor = self._nodes[x].anchor
+        if strategy == 'match_name':
+            return strategy, anchor.term_node['name']
+        elif strategy == 'match_name_and_spatial_scope':
+            return strategy, anchor.term_node['name'], anchor.term_node['spatialscope']
+        elif strategy == 'same_id':
+            return strategy, anchor.term_node.external_ref
+        elif strategy == 'targets':
+            return strategy, anchor.term_flow.external_ref, anchor.direction
+        elif strategy == 'node_targets':
+            return strategy, self._nodes[x].node.flow.external_ref
+        return strategy, x
 
     def _run_attempt(self, strategy):
         """
@@ -225,6 +261,12 @@ class UpgradeManager(object):
             print(e)
             return False
 
+    def _run_query(self, strategy, node):
+        try:
+            return list(getattr(self, strategy)(node))
+        except Exception as e:
+            return e
+
     def rxs(self, n=0):
         return self._candidates[n].references()
 
@@ -236,18 +278,19 @@ class UpgradeManager(object):
         :return:
         """
         self._rxs = tuple(self._candidates[n].references())
+        self._rx = self._pick_rx(self._candidates[n], self.current, ref_flow=ref_flow)
+
+    @staticmethod
+    def _pick_rx(candidate, node, ref_flow=None):
         try:
-            self._rx = self._candidates[n].reference(ref_flow)  # if ref flow is None and len(rx) is 1, will return it
+            return candidate.reference(ref_flow)  # if ref flow is None and len(rx) is 1, will return it
         except MultipleReferences as m:
             if ref_flow is None:
                 try:
-                    self._rx = self._candidates[n].reference(self.current.anchor.term_flow)
-                    return
+                    return candidate.reference(node.anchor.term_flow)
                 except NoReference:
                     pass
             raise m
-        except NoReference:
-            raise
 
     def pick_rx(self, k=0):
         if self._rxs is None:
@@ -289,6 +332,7 @@ class UpgradeManager(object):
         return True
 
     def finish(self):
+        self._ambiguous.pop(self._working, None)
         self._completed[self._working] = True
         self._pending.remove(self._working)
         self.next()
@@ -325,5 +369,153 @@ class UpgradeManager(object):
                 self.fail()
         print('%d success\n%d fail' % (sum(self._completed), len(list(self.errored))))
 
+    def _already_observed(self, x):
+        return self._to_scenario is not None and \
+            self._to_scenario in self._nodes[x].node.scenarios(recurse=False)
+
+    def run_batch(self, to_scenario=None, descend=None, strategies=None, max_workers=8, **kwargs):
+        """
+        Non-interactive upgrade of all pending nodes.  Each strategy is run in turn over the nodes that remain
+        unresolved; candidate queries are de-duplicated (see _strategy_key()) and run concurrently.  A node with
+        exactly one candidate is observed immediately.  Nodes for which no strategy produces a single candidate
+        are left pending: those with several candidates are listed in review_table(); the rest are marked with an
+        error.  A strategy that raises an exception for a node (rather than finding no candidates) is also listed in
+        review_table(), with the exception.
+        :param to_scenario: as in observe_current_node()
+        :param descend: as in observe_current_node()
+        :param strategies: [all] sequence of strategy names to try, in order
+        :param max_workers: [8] size of the query thread pool
+        :param kwargs: passed to fg.observe()
+        :return: dict of counts
+        """
+        if to_scenario is None:
+            if self._scenario is None and self._to_scenario is None:
+                raise ValueError("supply 'default' if you want to rewrite the default scenario")
+            to_scenario = self._to_scenario
+        if strategies is None:
+            strategies = self._strategies
+        self._working = None
+
+        unresolved = []
+        for x in self._pending:
+            if self._already_observed(x) and self._autoskip:
+                continue
+            unresolved.append(x)
+        if self._autoskip:
+            self._pending = list(unresolved)
+
+        self._ambiguous = dict()
+        self._strategy_errors = dict()
+        applied = 0
+        for strategy in strategies:
+            if len(unresolved) == 0:
+                break
+            groups = dict()
+            for x in unresolved:
+                try:
+                    key = self._strategy_key(strategy, x)
+                except Exception as e:
+                    self._error[x] = e
+                    self._strategy_errors.setdefault(x, []).append((strategy, e))
+                    continue
+                groups.setdefault(key, []).append(x)
+            keys = list(groups.keys())
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(lambda k: self._run_query(strategy, self._nodes[groups[k][0]]), keys))
+            print('%s: %d queries for %d nodes' % (strategy, len(keys), sum(len(v) for v in groups.values())))
+
+            n_err = sum(len(groups[k]) for k, c in zip(keys, results) if isinstance(c, Exception))
+            if n_err:
+                print('%s: query raised an exception for %d nodes (see review_table())' % (strategy, n_err))
+
+            resolved = set()
+            for key, cands in zip(keys, results):
+                for x in groups[key]:
+                    if isinstance(cands, Exception):
+                        self._error[x] = cands
+                        self._strategy_errors.setdefault(x, []).append((strategy, cands))
+                    elif len(cands) == 0:
+                        self._error[x] = NoCandidates()
+                    elif len(cands) > 1:
+                        self._ambiguous.setdefault(x, (strategy, cands))
+                        self._error[x] = TooManyCandidates()
+                    elif self._observe_node(x, cands[0], to_scenario, descend, **kwargs):
+                        self._ambiguous.pop(x, None)
+                        resolved.add(x)
+                        applied += 1
+            unresolved = [x for x in unresolved if x not in resolved]
+
+        self.next()
+        counts = {'applied': applied, 'ambiguous': len(self._ambiguous),
+                  'failed': len(unresolved) - len(self._ambiguous)}
+        print('%(applied)d applied\n%(ambiguous)d ambiguous\n%(failed)d failed' % counts)
+        return counts
+
+    def _observe_node(self, x, candidate, to_scenario, descend=None, **kwargs):
+        node = self._nodes[x]
+        try:
+            rx = self._pick_rx(candidate, node)
+            if descend is None:
+                descend = node.anchor.descend
+            self._fg.observe(node.node, scenario=to_scenario,
+                             anchor_node=rx.process, anchor_flow=rx.flow, descend=descend, **kwargs)
+        except Exception as e:
+            self._error[x] = e
+            return False
+        self._completed[x] = True
+        self._error[x] = None
+        self._pending.remove(x)
+        return True
+
+    def _review_row(self, x, strategy):
+        n = self._nodes[x]
+        try:
+            anchor, anchor_ss = n.anchor.term_node['name'], n.anchor.term_node['spatialscope']
+        except Exception:  # the anchor itself may be what the strategy choked on
+            anchor = anchor_ss = None
+        return {'node': x,
+                'fragment': n.node.name,
+                'anchor': anchor,
+                'anchor_spatialscope': anchor_ss,
+                'strategy': strategy}
+
+    def review_table(self):
+        """
+        One row per candidate for each node left ambiguous by run_batch(); plus, for nodes that remain unresolved,
+        one row per strategy that raised an exception, with the exception in the 'error' column
+        :return: a DataFrame
+        """
+        rows = []
+        for x, (strategy, cands) in sorted(self._ambiguous.items()):
+            for i, c in enumerate(cands):
+                row = self._review_row(x, strategy)
+                row.update({'candidate': i,
+                            'name': c['name'],
+                            'spatialscope': c['spatialscope'],
+                            'origin': c.origin,
+                            'external_ref': c.external_ref})
+                rows.append(row)
+        for x, errs in sorted(self._strategy_errors.items()):
+            if self._completed[x]:
+                continue
+            for strategy, e in errs:
+                row = self._review_row(x, strategy)
+                row['error'] = '%s: %s' % (e.__class__.__name__, e)
+                rows.append(row)
+        return DataFrame(rows, columns=['node', 'fragment', 'anchor', 'anchor_spatialscope', 'strategy', 'candidate',
+                                        'name', 'spatialscope', 'origin', 'external_ref', 'error'])
+
+    def review(self, x):
+        """
+        Make an ambiguous node from run_batch() the current node, with its candidates loaded for pick() and
+        observe_current_node()
+        :param x: node index
+        :return:
+        """
+        strategy, cands = self._ambiguous[x]
+        self.next(x)
+        self._candidates = cands
+        self.candidates()
+
     def reset_pending(self):
         self._pending = [k for k in range(len(self._nodes)) if not self.is_completed(k)]
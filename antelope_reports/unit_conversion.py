@@ -0,0 +1,111 @@
+"""
+Unit Conversion Cache
+
+Spreadsheet-driven model building converts the same handful of units over and over again-- every row of a
+parameters, production, or observations sheet that specifies units triggers a lookup in the quantity's unit conversion
+table, which may be a remote query.  The conversion cache memoizes those factors by (quantity, from_unit, to_unit).
+
+A single shared instance is provided:
+> from antelope_reports.unit_conversion import conversion_cache
+> conversion_cache.convert(mass, from_unit='lb')
+> conversion_cache.stats
+"""
+from antelope import ConversionError
+
+
+def _unit_key(unit):
+    if unit is None:
+        return None
+    unit = str(unit)
+    if len(unit) == 0:
+        return None
+    return unit
+
+
+class UnitConversionCache(object):
+    """
+    Memoizes quantity.convert(from_unit, to) results.  Conversion errors are not cached, so that a unit conversion
+    table that is updated in the course of a session will be picked up.
+    """
+    def __init__(self):
+        self._factors = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _qkey(quantity):
+        return quantity.link
+
+    def convert(self, quantity, from_unit=None, to=None):
+        """
+        Same semantics as quantity.convert(): returns the number of `to` units in one `from_unit`. None or blank
+        means the quantity's reference unit.
+        :param quantity:
+        :param from_unit:
+        :param to:
+        :return:
+        """
+        from_unit = _unit_key(from_unit)
+        to = _unit_key(to)
+        key = (self._qkey(quantity), from_unit, to)
+        try:
+            value = self._factors[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        self.misses += 1
+        value = quantity.convert(from_unit=from_unit, to=to)
+        self._factors[key] = value
+        return value
+
+    def clear(self, quantity=None):
+        """
+        Discard cached factors, either for a single quantity or for all quantities.  Counters are reset when the whole
+        cache is cleared.
+        :param quantity: [None]
+        :return:
+        """
+        if quantity is None:
+            self._factors = dict()
+            self.hits = self.misses = 0
+        else:
+            q = self._qkey(quantity)
+            for k in [k for k in self._factors.keys() if k[0] == q]:
+                self._factors.pop(k)
+
+    def __len__(self):
+        return len(self._factors)
+
+    @property
+    def stats(self):
+        return {'factors': len(self._factors), 'hits': self.hits, 'misses': self.misses}
+
+    def __str__(self):
+        return '%s: %d factors (%d hits, %d misses)' % (self.__class__.__name__, len(self._factors), self.hits,
+                                                        self.misses)
+
+
+conversion_cache = UnitConversionCache()
+
+
+def observe_converted(fg, fragment, exchange_value=None, units=None, **kwargs):
+    """
+    A drop-in for fg.observe(fragment, exchange_value=..., units=...) that converts the exchange value into the
+    fragment flow's reference unit using the shared conversion cache.  If the conversion fails, the units are passed
+    through to fg.observe() untouched, so that the foreground reports (or handles) the error exactly as it would have.
+    :param fg: a foreground
+    :param fragment:
+    :param exchange_value:
+    :param units:
+    :param kwargs: passed to fg.observe()
+    :return:
+    """
+    if exchange_value is not None and _unit_key(units) is not None:
+        try:
+            cf = conversion_cache.convert(fragment.flow.reference_entity, from_unit=units)
+            exchange_value = float(exchange_value) * cf
+            units = None
+        except ConversionError:
+            pass
+    return fg.observe(fragment, exchange_value=exchange_value, units=units, **kwargs)
@@ -0,0 +1,33 @@
+"""
+Small file-handling utilities shared across the package
+"""
+import os
+import tempfile
+
+
+def atomic_write(filename, writer, mode='w', newline=None):
+    """
+    Write a file by way of a temp file in the same directory, which is moved into place only when the writer
+    completes.  An interrupted write cannot leave a truncated file behind; the temp file is removed on failure.
+    :param filename: destination file
+    :param writer: function that writes the content.  It receives an open file object, or if mode is None, the path
+     of the temp file (for writers that open the file themselves, e.g. openpyxl or sqlite3)
+    :param mode: ['w'] mode in which to open the temp file, or None
+    :param newline: [None] passed to the file object, e.g. '' for csv writers
+    :return: whatever writer returns
+    """
+    d = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=d, suffix='.tmp')
+    try:
+        if mode is None:
+            os.close(fd)
+            result = writer(tmp)
+        else:
+            with os.fdopen(fd, mode, newline=newline) as fp:
+                result = writer(fp)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return result